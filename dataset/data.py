@@ -1,37 +1,78 @@
 import copy
+import json
 import os
 import random
+from bisect import bisect_right
 
 import numpy as np
 import torch
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import IterableDataset
+from torch.utils.data import Dataset, IterableDataset
 from dataset.tenhou import TenhouData
-
-def collate_fn_discard(batch):
-    features = []
-    labels = []
-    for (f, lb) in batch:
-        features.append(f)
-        labels.append(lb)
-    features = torch.from_numpy(np.array(features)).float()
-    labels = torch.from_numpy(np.array(labels))
-    labels = labels // 4
-    return features, labels
-
-def process_data(one_batch, label_trans=None):
+from model.models import riichi_channels
+
+MANIFEST = 'manifest.json'
+
+
+def pack_features(features):
+    """
+    特征按位打包保存
+    (N, C, 34)的局面特征中四家立直情况的通道取值为0/1/2，拆成>=1和>=2两个bit，后者排在所有特征之后；其他特征全部是0/1
+    :param features: (N, ...)
+    :return: (N, ceil(bit数 / 8))的uint8数组
+    """
+    features = np.array(features, dtype=np.uint8)
+    bits = [features.reshape(len(features), -1)]
+    channels = riichi_channels(features.shape[1:])
+    if channels is not None:
+        high = features[:, channels[0]:channels[1]] > 1
+        features[:, channels[0]:channels[1]] -= high
+        bits.append(high.reshape(len(features), -1))
+    if features.size and features.max() > 1:
+        raise ValueError('只能打包0/1特征(立直情况的通道为0/1/2)')
+    return np.packbits(np.concatenate(bits, axis=1), axis=1)
+
+
+def unpack_features(packed, shape):
+    """pack_features的逆操作，返回(N, *shape)的uint8数组"""
+    packed = np.asarray(packed)
+    size = int(np.prod(shape))
+    channels = riichi_channels(shape)
+    extra = 0 if channels is None else (channels[1] - channels[0]) * int(np.prod(shape[1:]))
+    bits = np.unpackbits(packed, axis=-1, count=size + extra)
+    features = bits[..., :size].reshape(*packed.shape[:-1], *shape)
+    if extra:
+        high = bits[..., size:].reshape(*packed.shape[:-1], channels[1] - channels[0], *shape[1:])
+        features[..., channels[0]:channels[1], :] += high
+    return features
+
+
+def collate_fn_discard(batch, packed=False):
+    return process_data(batch, label_trans=lambda x: x // 4, packed=packed)
+
+
+def process_data(one_batch, label_trans=None, packed=False):
+    """
+    :param packed: 特征是pack_features打包的uint8时保持uint8，由模型的Unpack在设备上展开
+    """
     features = []
     labels = []
     for f, lb in one_batch:
         features.append(f)
         labels.append(lb)
-    features = torch.from_numpy(np.array(features)).float()
+    features = torch.from_numpy(np.array(features))
+    if not packed:
+        features = features.float()
     labels = torch.from_numpy(np.array(labels))
     if callable(label_trans):
         labels = label_trans(labels)
     return features, labels
 
 
+def collate_fn_binary(batch, packed=False):
+    return process_data(batch, label_trans=lambda x: x.float(), packed=packed)
+
+
 def process_reward_data(one_batch):
     features = []
     labels = []
@@ -51,7 +92,7 @@ class TenhouDataset(object):
         self.data_files = os.listdir(data_dir)
         random.shuffle(self.data_files)
         self.data_buffer = []
-        self.func = f'parse_{mode}_data'
+        self.mode = mode
         self.target = slice(0, target_length)
 
     def reset(self):
@@ -69,8 +110,9 @@ class TenhouDataset(object):
         self.used_data.append(data_file)
         playback = TenhouData(os.path.join(self.data_dir, data_file))
         targets = playback.get_rank()[self.target]
+        samples = playback.parse_data([self.mode], targets)[self.mode]  # 一次回放生成所有目标玩家的数据
         for target in targets:
-            features, labels = playback.__getattribute__(self.func)(target=target)
+            features, labels = samples[target]
             if isinstance(features, list):
                 data = list(zip(features, labels))
                 random.shuffle(data)
@@ -109,7 +151,6 @@ class TenhouIterableDataset(IterableDataset):
         self.transform = transform
         self.data_files = os.listdir(data_dir)
         self.shuffle = shuffle
-        self.func_name = f'parse_{mode}_data'  # e.g. parse_discard_data
 
     def _sample_generator_for_file(self, data_file):
         if data_file in self.exclude_files:
@@ -118,13 +159,13 @@ class TenhouIterableDataset(IterableDataset):
             full_path = os.path.join(self.data_dir, data_file)
             playback = TenhouData(full_path)
             targets = playback.get_rank()[0 : self.target_length]
-        except Exception as e:  # corrupted file, e.g. `.root` doesn't exist
+            samples = playback.parse_data([self.mode], targets)[self.mode]
+        except Exception as e:  # corrupted file, e.g. `.events` doesn't exist
             return
 
-        parse_func = getattr(playback, self.func_name, None)
         for target in targets:
             try:
-                features, labels = parse_func(target=target)
+                features, labels = samples[target]
                 if isinstance(features, list):
                     pairs = list(zip(features, labels))
                     # random.shuffle(pairs)  # files shuffled
@@ -145,3 +186,53 @@ class TenhouIterableDataset(IterableDataset):
             random.shuffle(file_list)
         for data_file in file_list:
             yield from self._sample_generator_for_file(data_file)
+
+
+class TenhouShardDataset(Dataset):
+    """
+    读取dataset/preprocess.py生成的分片数据，支持随机访问
+    分片用mmap打开，每个epoch只有读盘开销，不需要再回放牌谱
+    """
+    def __init__(self, cache_dir, mode='discard', split='train', packed=False):
+        """
+        :param packed: 为True时直接返回打包的uint8特征，不在这里展开
+        """
+        super().__init__()
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.packed = packed
+        with open(os.path.join(cache_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.shape = tuple(manifest['shape'][mode])
+        self.row_size = pack_features(np.zeros((1, *self.shape))).shape[1]
+        self.shards = manifest['tasks'][mode][split]
+        self.offsets = np.cumsum([0] + [shard['length'] for shard in self.shards]).tolist()
+        self.arrays = None  # DataLoader的每个worker各自打开mmap
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def load_shards(self):
+        self.arrays = []
+        for shard in self.shards:
+            path = os.path.join(self.cache_dir, shard['name'])
+            features = np.load(path + '-features.npy', mmap_mode='r')
+            if features.shape[1] != self.row_size:  # 立直情况的通道改为两个bit之前生成的分片
+                raise ValueError(f'{path}: 每行{features.shape[1]}字节，应为{self.row_size}字节，请重新运行dataset/preprocess.py')
+            labels = np.load(path + '-labels.npy', mmap_mode='r')
+            rows = np.load(path + '-rows.npy', mmap_mode='r') if self.mode == 'reward' else None
+            self.arrays.append((features, labels, rows))
+
+    def __getitem__(self, index):
+        if self.arrays is None:
+            self.load_shards()
+        i = bisect_right(self.offsets, index) - 1
+        j = index - self.offsets[i]
+        features, labels, rows = self.arrays[i]
+        if rows is None:
+            features = features[j]
+        else:  # reward任务每个样本是不定长的每局特征序列，rows[j]:rows[j + 1]为第j个样本的行
+            features = features[rows[j]:rows[j + 1]]
+        if self.packed:
+            return np.array(features), int(labels[j])
+        return unpack_features(features, self.shape), int(labels[j])
@@ -0,0 +1,68 @@
+"""
+天凤牌谱(mjlog XML)的流式解析
+不建DOM，用一个正则在整个文件的bytes上依次匹配标签，直接产生(类型, 玩家, 值)的整数事件：
+    DRAW/DISCARD: 值为牌的编号，例如<T80/>为(DRAW, 0, 80)，<F18/>为(DISCARD, 2, 18)
+    MELD: 值为鸣牌的m编码
+    REACH: 值为step(1为宣言，2为立直成立)
+    DORA: 值为新的宝牌指示牌，玩家为-1
+    GO: 值为对局类型type，玩家为-1
+    INIT/AGARI/RYUUKYOKU: 每局只出现一两次，值为属性字典(str)，INIT的玩家为oya，其余为-1
+其他标签(UN、TAIKYOKU、SHUFFLE、BYE等)回放用不到，直接跳过
+"""
+import re
+
+GO, INIT, DRAW, DISCARD, MELD, REACH, DORA, AGARI, RYUUKYOKU = range(9)
+
+TAG_PATTERN = re.compile(rb'<([A-Z]+)(\d*)([^>]*)>')
+ATTR_PATTERN = re.compile(rb'(\w+)="([^"]*)"')
+SEAT_TAGS = {
+    **{tag: (DRAW, who) for who, tag in enumerate([b'T', b'U', b'V', b'W'])},
+    **{tag: (DISCARD, who) for who, tag in enumerate([b'D', b'E', b'F', b'G'])},
+}
+END_TAG = b'</mjloggm>'
+
+
+class MjlogError(ValueError):
+    pass
+
+
+def parse_attrs(attrs):
+    return {key.decode(): value.decode() for key, value in ATTR_PATTERN.findall(attrs)}
+
+
+def tokenize(data: bytes):
+    """
+    :param data: 整个牌谱文件的内容
+    :return: 事件的生成器
+    """
+    if not data.rstrip().endswith(END_TAG):  # 下载中断等原因不完整的牌谱
+        raise MjlogError('mjlog is truncated')
+    seat_tags = SEAT_TAGS
+    for name, number, attrs in TAG_PATTERN.findall(data):
+        if number:
+            if name in seat_tags:
+                kind, who = seat_tags[name]
+                yield kind, who, int(number)
+        elif name == b'N':
+            attrs = parse_attrs(attrs)
+            yield MELD, int(attrs['who']), int(attrs['m'])
+        elif name == b'REACH':
+            attrs = parse_attrs(attrs)
+            yield REACH, int(attrs['who']), int(attrs['step'])
+        elif name == b'DORA':
+            yield DORA, -1, int(parse_attrs(attrs)['hai'])
+        elif name == b'INIT':
+            attrs = parse_attrs(attrs)
+            yield INIT, int(attrs['oya']), attrs
+        elif name == b'AGARI':
+            yield AGARI, -1, parse_attrs(attrs)
+        elif name == b'RYUUKYOKU':
+            yield RYUUKYOKU, -1, parse_attrs(attrs)
+        elif name == b'GO':
+            yield GO, -1, int(parse_attrs(attrs)['type'])
+
+
+def read_events(log_file):
+    """:return: 整个牌谱的事件列表"""
+    with open(log_file, 'rb') as f:
+        return list(tokenize(f.read()))
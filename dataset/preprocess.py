@@ -0,0 +1,159 @@
+"""
+把data目录下的天凤牌谱一次性回放成训练数据，按任务、训练/测试集分片保存，并写入manifest.json
+训练脚本通过TenhouShardDataset读取分片，之后每个epoch不再需要解析XML和回放牌谱
+
+$ python dataset/preprocess.py --data_dir data --output_dir cache
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import signal
+from multiprocessing import Pool
+
+import numpy as np
+import tqdm
+
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+from dataset.tenhou import TenhouData
+from dataset.data import MANIFEST, pack_features
+from mahjong.game import FEATURE_CHANNELS
+
+# 各任务取顺位前几名玩家的数据
+TARGET_LENGTH = {
+    'discard': 2,
+    'riichi': 2,
+    'chi': 2,
+    'pon': 2,
+    'kan': 2,
+    'reward': 4,
+}
+SHAPE = {
+    'discard': (FEATURE_CHANNELS, 34),
+    'riichi': (FEATURE_CHANNELS, 34),
+    'chi': (FEATURE_CHANNELS + 22, 34),
+    'pon': (FEATURE_CHANNELS + 22, 34),
+    'kan': (FEATURE_CHANNELS + 22, 34),
+    'reward': (74,),
+}
+
+
+def parse_file(path):
+    """
+    回放一个牌谱文件
+    :return: ({task: [(打包后的特征, 标签), ...]}, None)，reward任务的特征为打包后的每局特征序列；
+             回放或打包出错时返回(None, 异常)
+    """
+    try:
+        playback = TenhouData(path)
+        ranks = playback.get_rank()
+        targets = set(ranks[:max(TARGET_LENGTH.values())])
+        data = playback.parse_data(TARGET_LENGTH.keys(), targets)
+        ret = {}
+        for task, per_target in data.items():
+            samples = []
+            for target in ranks[:TARGET_LENGTH[task]]:
+                features, labels = per_target[target]
+                if task == 'reward':
+                    if labels is not None and len(features):
+                        samples.append((pack_features(features), labels))
+                elif len(features):
+                    samples.extend(zip(pack_features(features), labels))
+            ret[task] = samples
+    except Exception as e:
+        return None, e
+    return ret, None
+
+
+class ShardWriter(object):
+    """攒够shard_size个样本写一个分片"""
+    def __init__(self, output_dir, task, split, shard_size):
+        self.output_dir = output_dir
+        self.task = task
+        self.split = split
+        self.shard_size = shard_size
+        self.samples = []
+        self.shards = []
+
+    def add(self, samples):
+        self.samples.extend(samples)
+        while len(self.samples) >= self.shard_size:
+            self.flush(self.samples[:self.shard_size])
+            self.samples = self.samples[self.shard_size:]
+
+    def flush(self, samples):
+        if not samples:
+            return
+        name = f'{self.task}-{self.split}-{len(self.shards):04d}'
+        path = os.path.join(self.output_dir, name)
+        features, labels = zip(*samples)
+        if self.task == 'reward':
+            rows = np.cumsum([0] + [len(f) for f in features])
+            np.save(path + '-rows.npy', rows.astype(np.int64))
+            features = np.concatenate(features)
+        else:
+            features = np.stack(features)
+        np.save(path + '-features.npy', features)
+        np.save(path + '-labels.npy', np.array(labels, dtype=np.int32))
+        self.shards.append({'name': name, 'length': len(samples)})
+
+    def close(self):
+        self.flush(self.samples)
+        self.samples = []
+        return self.shards
+
+
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', '-d', default='data', type=str)
+    parser.add_argument('--output_dir', '-o', default='cache', type=str)
+    parser.add_argument('--shard_size', '-s', default=50000, type=int)
+    parser.add_argument('--test_ratio', '-t', default=0.2, type=float)
+    parser.add_argument('--num_workers', '-j', default=os.cpu_count(), type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    data_files = sorted(os.listdir(args.data_dir))
+    random.Random(args.seed).shuffle(data_files)
+    len_test = int(len(data_files) * args.test_ratio)
+    splits = {'test': data_files[:len_test], 'train': data_files[len_test:]}
+
+    manifest = {
+        'shape': SHAPE,
+        'files': splits,
+        'tasks': {task: {} for task in TARGET_LENGTH},
+    }
+    pool = Pool(args.num_workers, initializer=init_worker)
+    skipped = []
+    try:
+        for split, files in splits.items():
+            writers = {task: ShardWriter(args.output_dir, task, split, args.shard_size) for task in TARGET_LENGTH}
+            paths = [os.path.join(args.data_dir, f) for f in files]
+            results = pool.imap(parse_file, paths, chunksize=16)
+            for path, (data, error) in zip(paths, tqdm.tqdm(results, total=len(paths), desc=split)):
+                if error is not None:  # 损坏的牌谱，或者回放出的特征有问题
+                    skipped.append(path)
+                    tqdm.tqdm.write(f'skip {path}: {error!r}')
+                    continue
+                for task, samples in data.items():
+                    writers[task].add(samples)
+            for task, writer in writers.items():
+                manifest['tasks'][task][split] = writer.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        raise
+    else:
+        pool.close()
+        pool.join()
+    with open(os.path.join(args.output_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    for task, shards in manifest['tasks'].items():
+        print(task, {split: sum(shard['length'] for shard in shards[split]) for split in shards})
+    print(f'{len(skipped)} of {len(data_files)} files skipped')
@@ -1,35 +1,30 @@
 import os
 import warnings
-import xml.etree.ElementTree as ET
 import numpy as np
-import re
-import tqdm
 
 from mahjong.game import MahjongGame
-from mahjong.utils import YAKU_LIST
-from mahjong.check_agari import is_agari
-from collections import Counter
+from dataset.mjlog import GO, INIT, DRAW, DISCARD, MELD, REACH, DORA, AGARI, RYUUKYOKU, MjlogError, read_events
 
 
 class TenhouData(object):
     def __init__(self, log_file):
         self.file = log_file
         try:
-            tree = ET.parse(log_file)
-        except ET.ParseError as e:
+            events = read_events(log_file)
+        except MjlogError as e:
             print(log_file)
             print(e)
             os.remove(log_file)
             return
-        self.root = tree.getroot()
+        self.events = events  # dataset/mjlog.py的(类型, 玩家, 值)
         self.type = self.game_type()
         if not self.is_four_player_game():
             raise RuntimeError('暂不支持三人麻将')
 
     def get_rank(self):
-        for child in self.root:
-            if 'owari' in child.attrib:
-                owari = list(map(float, child.attrib['owari'].split(',')))[1::2]
+        for kind, _, attrs in self.events:
+            if kind in (AGARI, RYUUKYOKU) and 'owari' in attrs:
+                owari = list(map(float, attrs['owari'].split(',')))[1::2]
                 return np.array(owari).argsort().tolist()[::-1]
 
     def print_info(self, info_int):
@@ -62,398 +57,145 @@ class TenhouData(object):
             print('上级桌')
 
     def game_type(self):
-        for child in self.root:
-            if child.tag == 'GO':
-                return int(child.attrib['type'])
+        for kind, _, value in self.events:
+            if kind == GO:
+                return value
 
     def is_four_player_game(self):
         return not bool(self.type & 0x10)
 
-    def parse_discard_data(self, target=0):
-        features = []
-        labels = []
-        game = MahjongGame(is_playback=True)
-        has_aka = True
-        draw_pattern = re.compile('[TUVW]\\d+')
-        discard_pattern = re.compile('[DEFG]\\d+')
-        iteration = iter(self.root)
-        child = next(iteration)
-        while 1:
-            try:
-                if child.tag == 'GO':
-                    has_aka = not bool(int(child.attrib['type']) & 0x02)
-                elif child.tag == 'INIT':
-                    info = child.attrib
-                    game.init_from_info(info, has_aka)
-                elif child.tag == 'AGARI':
-                    ...
-                elif child.tag == 'N':
-                    who = int(child.attrib['who'])
-                    code = int(child.attrib['m'])
-                    game.declare_furo(who, code)
-                elif child.tag == 'RYUUKYOKU':
-                    ...
-                elif child.tag == 'REACH':
-                    who = int(child.attrib['who'])
-                    step = child.attrib['step']
-                    if step == '1':
-                        game.agents[who].declare_riichi = 1
-                    else:
-                        game.riichi(who)
-                elif child.tag == 'DORA':
-                    game.new_dora(int(child.attrib['hai']))
-                elif draw_pattern.match(child.tag):
-                    game.draw('TUVW'.index(child.tag[0]), int(child.tag[1:]))
-                elif discard_pattern.match(child.tag):
-                    who = 'DEFG'.index(child.tag[0])
-                    if who == target and not game.agents[target].riichi_status:
-                        features.append(game.get_feature(target))
-                        labels.append(int(child.tag[1:]))
-                    game.discard(who, int(child.tag[1:]))
-                child = next(iteration)
-            except StopIteration:
-                break
-        return features, labels
+    TASKS = ('discard', 'pon', 'kan', 'chi', 'riichi', 'reward')
 
-    def parse_pon_data(self, target=0):
-        features = []
-        labels = []
+    def parse_data(self, tasks=TASKS, targets=range(4)):
+        """
+        单次回放牌谱，同时生成多个任务、多个玩家的数据
+        同一时刻同一玩家的get_feature只计算一次，由各个任务共享
+        鸣牌、立直的标签看下一条log
+        :return: {task: {target: (features, labels)}}, reward任务为{target: (features, label)}
+        """
+        tasks = set(tasks)
+        targets = set(targets)
+        data = {task: {target: ([], []) for target in targets} for task in tasks}
+        reward_label = dict.fromkeys(targets)
         game = MahjongGame(is_playback=True)
         has_aka = True
-        draw_pattern = re.compile('[TUVW]\\d+')
-        discard_pattern = re.compile('[DEFG]\\d+')
-        iteration = iter(self.root)
-        child = next(iteration)
-        while 1:
-            try:
-                if child.tag == 'GO':
-                    has_aka = not bool(int(child.attrib['type']) & 0x02)
-                elif child.tag == 'INIT':
-                    info = child.attrib
-                    game.init_from_info(info, has_aka)
-                elif child.tag == 'AGARI':
-                    ...
-                elif child.tag == 'N':
-                    who = int(child.attrib['who'])
-                    code = int(child.attrib['m'])
-                    game.declare_furo(who, code)
-                elif child.tag == 'RYUUKYOKU':
-                    ...
-                elif child.tag == 'REACH':
-                    who = int(child.attrib['who'])
-                    step = child.attrib['step']
-                    if step == '1':
-                        game.agents[who].declare_riichi = 1
-                    else:
-                        game.riichi(who)
-                elif child.tag == 'DORA':
-                    game.new_dora(int(child.attrib['hai']))
-                elif draw_pattern.match(child.tag):
-                    game.draw('TUVW'.index(child.tag[0]), int(child.tag[1:]))
-                elif discard_pattern.match(child.tag):
-                    who = 'DEFG'.index(child.tag[0])
-                    tile_id = int(child.tag[1:])
-                    game.discard(who, tile_id)
-                    if who != target:
+        cache = {}
+
+        def get_feature(seat):
+            if seat not in cache:
+                cache[seat] = game.get_feature(seat)
+            return cache[seat]
+
+        events = self.events
+        for i, (kind, who, value) in enumerate(events):
+            cache.clear()
+            nxt = events[i + 1] if i + 1 < len(events) else None
+            if nxt is not None and nxt[0] == MELD:  # 下一条log是鸣牌时的鸣牌者
+                _, naki_who, naki_code = nxt
+            else:
+                naki_who, naki_code = None, 0
+            if kind == DRAW:
+                tile_id = value
+                game.draw(who, tile_id)
+                if who not in targets or nxt is None:
+                    continue
+                if 'riichi' in tasks and game.can_declare_riichi(who):
+                    features, labels = data['riichi'][who]
+                    features.append(get_feature(who))
+                    labels.append(int(nxt[0] == REACH))
+                if 'kan' in tasks:
+                    can_ankan, ankan_patterns = game.check_kan(who, tile_id, mode=0)
+                    can_addkan, addkan_patterns = game.check_kan(who, tile_id, mode=2)
+                    if can_ankan or can_addkan:
+                        pattern = None
+                        if naki_who is not None:  # 自摸之后的鸣牌操作，必定是暗杠或者加杠
+                            if naki_code & (1 << 4):  # 加杠
+                                pattern = ((naki_code & 0xfe00) >> 9) // 3
+                            else:  # 暗杠
+                                pattern = ((naki_code & 0xff00) >> 8) // 4
+                        features, labels = data['kan'][who]
+                        for kan_pattern in ankan_patterns + addkan_patterns:
+                            kan_feature = game.get_kan_feature(who, pattern=kan_pattern)
+                            features.append(np.concatenate([kan_feature, get_feature(who)], axis=0))
+                            labels.append(int(kan_pattern[1] == pattern))
+            elif kind == DISCARD:
+                tile_id = value
+                if 'discard' in tasks and who in targets and not game.agents[who].riichi_status:
+                    features, labels = data['discard'][who]
+                    features.append(get_feature(who))
+                    labels.append(tile_id)
+                game.discard(who, tile_id)
+                if nxt is None:
+                    continue
+                cache.clear()
+                for target in targets - {who}:
+                    if 'pon' in tasks:
                         can_pon, pon_pattern = game.check_pon(target, tile_id)
                         if can_pon:
-                            """如果能碰牌,则判断该玩家是否碰了"""
-                            child = next(iteration)
-                            feature = game.get_feature(target)
+                            features, labels = data['pon'][target]
                             pon_feature = game.get_pon_feature(target, pattern=pon_pattern, kui_tile=tile_id)
-                            feature = np.concatenate([pon_feature, feature], axis=0)
-                            features.append(feature)
-                            if child.tag != 'N':  # 下一条log并非鸣牌
-                                labels.append(0)
-                            else:
-                                who = int(child.attrib['who'])
-                                code = int(child.attrib['m'])
-                                if who != target:  # 鸣牌者并非目标
-                                    labels.append(0)
-                                else:
-                                    if code & (1 << 3):
-                                        labels.append(1)
-                                    else:
-                                        labels.append(0)
-                            continue  # 重新回到循环开头，让前面的逻辑来处理这条记录
-                child = next(iteration)
-            except StopIteration:
-                break
-        return features, labels
-
-    def parse_kan_data(self, target=0):
-        features = []
-        labels = []
-        game = MahjongGame(is_playback=True)
-        has_aka = True
-        draw_pattern = re.compile('[TUVW]\\d+')
-        discard_pattern = re.compile('[DEFG]\\d+')
-        iteration = iter(self.root)
-        child = next(iteration)
-        while 1:
-            try:
-                if child.tag == 'GO':
-                    has_aka = not bool(int(child.attrib['type']) & 0x02)
-                elif child.tag == 'INIT':
-                    info = child.attrib
-                    game.init_from_info(info, has_aka)
-                elif child.tag == 'AGARI':
-                    ...
-                elif child.tag == 'N':
-                    who = int(child.attrib['who'])
-                    code = int(child.attrib['m'])
-                    game.declare_furo(who, code)
-                elif child.tag == 'RYUUKYOKU':
-                    ...
-                elif child.tag == 'REACH':
-                    who = int(child.attrib['who'])
-                    step = child.attrib['step']
-                    if step == '1':
-                        game.agents[who].declare_riichi = 1
-                    else:
-                        game.riichi(who)
-                elif child.tag == 'DORA':
-                    game.new_dora(int(child.attrib['hai']))
-                elif draw_pattern.match(child.tag):
-                    who = 'TUVW'.index(child.tag[0])
-                    tile_id = int(child.tag[1:])
-                    game.draw(who, tile_id)
-                    if who == target:
-                        can_ankan, ankan_patterns = game.check_kan(target, tile_id, mode=0)
-                        can_addkan, addkan_patterns = game.check_kan(target, tile_id, mode=2)
-                        can_kan = can_ankan or can_addkan
-                        kan_patterns = ankan_patterns + addkan_patterns
-                        if can_kan:
-                            """如果能杠牌,则判断该玩家是否杠了"""
-                            child = next(iteration)
-                            feature = game.get_feature(target)
-                            if child.tag != 'N':  # 下一条log并非鸣牌
-                                for kan_pattern in kan_patterns:
-                                    kan_feature = game.get_kan_feature(target, pattern=kan_pattern)
-                                    features.append(np.concatenate([kan_feature, feature], axis=0))
-                                    labels.append(0)
-                            else:  # 因为是自摸之后的鸣牌操作，则必定是暗杠或者加杠
-                                code = int(child.attrib['m'])
-                                if code & (1 << 4):  # 鸣了加杠
-                                    pattern = ((code & 0xfe00) >> 9) // 3
-                                else:  # 鸣了暗杠
-                                    pattern = ((code & 0xff00) >> 8) // 4
-                                for kan_pattern in kan_patterns:
-                                    kan_feature = game.get_kan_feature(target, pattern=kan_pattern)
-                                    features.append(np.concatenate([kan_feature, feature], axis=0))
-                                    if kan_pattern[1] == pattern:
-                                        labels.append(1)
-                                    else:
-                                        labels.append(0)
-                            continue  # 重新回到循环开头，让前面的逻辑来处理这条记录
-                elif discard_pattern.match(child.tag):
-                    who = 'DEFG'.index(child.tag[0])
-                    tile_id = int(child.tag[1:])
-                    game.discard(who, tile_id)
-                    # if who == target:
-                    #     """天凤平台居然可以自己先打出去再声明加杠。。。大意了。但这种数据还是不要了，没必要为极少数据写一堆代码"""
-                    if who != target:
-                        can_kan, kan_pattern = game.check_kan(target, tile_id, mode=1)  # 检查明杠
+                            features.append(np.concatenate([pon_feature, get_feature(target)], axis=0))
+                            labels.append(int(naki_who == target and bool(naki_code & (1 << 3))))
+                    if 'kan' in tasks:
+                        # 天凤平台可以自己先打出去再声明加杠，这种数据不要
+                        can_kan, kan_pattern = game.check_kan(target, tile_id, mode=1)  # 明杠
                         if can_kan:
-                            """如果能杠牌,则判断该玩家是否杠了"""
-                            child = next(iteration)
-                            feature = game.get_feature(target)
+                            features, labels = data['kan'][target]
                             kan_feature = game.get_kan_feature(target, pattern=kan_pattern)
-                            features.append(np.concatenate([kan_feature, feature], axis=0))
-                            if child.tag != 'N':  # 下一条log并非鸣牌
-                                labels.append(0)
-                            else:
-                                who = int(child.attrib['who'])
-                                code = int(child.attrib['m'])
-                                if who != target:  # 鸣牌者并非目标
-                                    labels.append(0)
-                                else:
-                                    if not code & 0b111100:
-                                        labels.append(1)
-                                    else:
-                                        labels.append(0)
-                            continue  # 重新回到循环开头，让前面的逻辑来处理这条记录
-                child = next(iteration)
-            except StopIteration:
-                break
-        return features, labels
-
-    def parse_chi_data(self, target=0):
-        features = []
-        labels = []
-        game = MahjongGame(is_playback=True)
-        has_aka = True
-        draw_pattern = re.compile('[TUVW]\\d+')
-        discard_pattern = re.compile('[DEFG]\\d+')
-        iteration = iter(self.root)
-        child = next(iteration)
-        while 1:
-            try:
-                if child.tag == 'GO':
-                    has_aka = not bool(int(child.attrib['type']) & 0x02)
-                elif child.tag == 'INIT':
-                    info = child.attrib
-                    game.init_from_info(info, has_aka)
-                elif child.tag == 'AGARI':
-                    ...
-                elif child.tag == 'N':
-                    who = int(child.attrib['who'])
-                    code = int(child.attrib['m'])
-                    game.declare_furo(who, code)
-                elif child.tag == 'RYUUKYOKU':
-                    ...
-                elif child.tag == 'REACH':
-                    who = int(child.attrib['who'])
-                    step = child.attrib['step']
-                    if step == '1':
-                        game.agents[who].declare_riichi = 1
-                    else:
-                        game.riichi(who)
-                elif child.tag == 'DORA':
-                    game.new_dora(int(child.attrib['hai']))
-                elif draw_pattern.match(child.tag):
-                    game.draw('TUVW'.index(child.tag[0]), int(child.tag[1:]))
-                elif discard_pattern.match(child.tag):
-                    who = 'DEFG'.index(child.tag[0])
-                    tile_id = int(child.tag[1:])
-                    game.discard(who, tile_id)
-                    if who == (target - 1) % 4:
+                            features.append(np.concatenate([kan_feature, get_feature(target)], axis=0))
+                            labels.append(int(naki_who == target and not naki_code & 0b111100))
+                    if 'chi' in tasks and target == (who + 1) % 4:
                         can_chi, chi_pattern = game.check_chi(target, tile_id)
                         if can_chi:
-                            """如果能吃牌,则判断该玩家是否吃了"""
-                            child = next(iteration)
-                            feature = game.get_feature(target)
+                            t = None
+                            if naki_who == target and naki_code & (1 << 2):
+                                t = (naki_code & 0xfc00) >> 10
+                                t = t // 3
+                                t = t // 7 * 9 + t % 7
+                            features, labels = data['chi'][target]
                             for ptn in chi_pattern:
                                 chi_feature = game.get_chi_feature(target, pattern=ptn, kui_tile=tile_id)
-                                features.append(np.concatenate([chi_feature, feature], axis=0))
-                            if child.tag != 'N':  # 下一条log并非鸣牌
-                                labels.extend([0] * len(chi_pattern))
-                            else:
-                                who = int(child.attrib['who'])
-                                code = int(child.attrib['m'])
-                                if who != target:  # 鸣牌者并非目标
-                                    labels.extend([0] * len(chi_pattern))
-                                else:
-                                    if code & (1 << 2):
-                                        t = (code & 0xfc00) >> 10
-                                        t = t // 3
-                                        t = t // 7 * 9 + t % 7
-                                        for ptn in chi_pattern:
-                                            if ptn == t:
-                                                labels.append(1)
-                                            else:
-                                                labels.append(0)
-                                    else:
-                                        labels.extend([0] * len(chi_pattern))
-                            continue  # 重新回到循环开头，让前面的逻辑来处理这条记录
-                child = next(iteration)
-            except StopIteration:
-                break
-        return features, labels
+                                features.append(np.concatenate([chi_feature, get_feature(target)], axis=0))
+                                labels.append(int(ptn == t))
+            elif kind == MELD:
+                game.declare_furo(who, value)
+            elif kind == REACH:
+                if value == 1:
+                    game.agents[who].declare_riichi = 1
+                else:
+                    game.riichi(who)
+            elif kind == DORA:
+                game.new_dora(value)
+            elif kind == INIT:
+                game.init_from_info(value, has_aka)
+            elif kind in (AGARI, RYUUKYOKU):
+                if 'reward' in tasks:
+                    sc = value['sc'].split(',')[1::2]
+                    for target in targets:
+                        data['reward'][target][0].append(game.get_game_feature(int(sc[target]), game.agents[target].score))
+                        if 'owari' in value:
+                            reward_label[target] = int(value['owari'].split(',')[::2][target])
+            elif kind == GO:
+                has_aka = not bool(value & 0x02)
+        if 'reward' in tasks:
+            data['reward'] = {target: (np.array(features), reward_label[target])
+                              for target, (features, _) in data['reward'].items()}
+        return data
+
+    def parse_discard_data(self, target=0):
+        return self.parse_data(['discard'], [target])['discard'][target]
+
+    def parse_pon_data(self, target=0):
+        return self.parse_data(['pon'], [target])['pon'][target]
+
+    def parse_kan_data(self, target=0):
+        return self.parse_data(['kan'], [target])['kan'][target]
+
+    def parse_chi_data(self, target=0):
+        return self.parse_data(['chi'], [target])['chi'][target]
 
     def parse_riichi_data(self, target=0):
-        features = []
-        labels = []
-        game = MahjongGame(is_playback=True)
-        has_aka = True
-        draw_pattern = re.compile('[TUVW]\\d+')
-        discard_pattern = re.compile('[DEFG]\\d+')
-        iteration = iter(self.root)
-        child = next(iteration)
-        while 1:
-            try:
-                if child.tag == 'GO':
-                    has_aka = not bool(int(child.attrib['type']) & 0x02)
-                elif child.tag == 'INIT':
-                    info = child.attrib
-                    game.init_from_info(info, has_aka)
-                elif child.tag == 'AGARI':
-                    ...
-                elif child.tag == 'N':
-                    who = int(child.attrib['who'])
-                    code = int(child.attrib['m'])
-                    game.declare_furo(who, code)
-                elif child.tag == 'RYUUKYOKU':
-                    ...
-                    # print('流局')
-                elif child.tag == 'REACH':
-                    who = int(child.attrib['who'])
-                    step = child.attrib['step']
-                    if step == '1':
-                        ...
-                        game.agents[who].declare_riichi = 1
-                        # if who == target:
-                        #     print(game.players[who].hand_tile_counter)
-                        #     print(game.players[who].display_tiles())
-                    else:
-                        game.riichi(who)
-                elif child.tag == 'DORA':
-                    game.new_dora(int(child.attrib['hai']))
-                elif draw_pattern.match(child.tag):
-                    who = 'TUVW'.index(child.tag[0])
-                    game.draw(who, int(child.tag[1:]))
-                    if who == target:
-                        if game.can_declare_riichi(who):
-                            features.append(game.get_feature(target))
-                            child = next(iteration)
-                            if child.tag == 'REACH':
-                                labels.append(1)
-                            else:
-                                labels.append(0)
-                            continue
-                elif discard_pattern.match(child.tag):
-                    game.discard('DEFG'.index(child.tag[0]), int(child.tag[1:]))
-                child = next(iteration)
-            except StopIteration:
-                break
-        return features, labels
+        return self.parse_data(['riichi'], [target])['riichi'][target]
 
     def parse_reward_data(self, target):
-        features = []
-        label = None
-        game = MahjongGame(is_playback=True)
-        has_aka = True
-        draw_pattern = re.compile('[TUVW]\\d+')
-        discard_pattern = re.compile('[DEFG]\\d+')
-        iteration = iter(self.root)
-        child = next(iteration)
-        while 1:
-            try:
-                if child.tag == 'GO':
-                    has_aka = not bool(int(child.attrib['type']) & 0x02)
-                elif child.tag == 'INIT':
-                    info = child.attrib
-                    game.init_from_info(info, has_aka)
-                elif child.tag == 'AGARI':
-                    sc = child.attrib['sc']
-                    target_sc = int(sc.split(',')[1::2][target])
-                    features.append(game.get_game_feature(target_sc, game.agents[target].score))
-                    if 'owari' in child.attrib:
-                        label = int(child.attrib['owari'].split(',')[::2][target])
-                elif child.tag == 'N':
-                    who = int(child.attrib['who'])
-                    code = int(child.attrib['m'])
-                    game.declare_furo(who, code)
-                elif child.tag == 'RYUUKYOKU':
-                    sc = child.attrib['sc']
-                    target_sc = int(sc.split(',')[1::2][target])
-                    features.append(game.get_game_feature(target_sc, game.agents[target].score))
-                    if 'owari' in child.attrib:
-                        label = int(child.attrib['owari'].split(',')[::2][target])
-                elif child.tag == 'REACH':
-                    who = int(child.attrib['who'])
-                    step = child.attrib['step']
-                    if step == '1':
-                        game.agents[who].declare_riichi = 1
-                    else:
-                        game.riichi(who)
-                elif child.tag == 'DORA':
-                    game.new_dora(int(child.attrib['hai']))
-                elif draw_pattern.match(child.tag):
-                    game.draw('TUVW'.index(child.tag[0]), int(child.tag[1:]))
-                elif discard_pattern.match(child.tag):
-                    game.discard('DEFG'.index(child.tag[0]), int(child.tag[1:]))
-                child = next(iteration)
-            except StopIteration:
-                break
-        return np.array(features), label
+        return self.parse_data(['reward'], [target])['reward'][target]
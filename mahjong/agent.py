@@ -1,15 +1,16 @@
 from typing import List, Set, Tuple, Dict, Union
 import random
 import os
-import torch
-import logging
+import asyncio
+from copy import copy
 from collections import OrderedDict
 from itertools import product, combinations
 from .utils import *
-from .check_agari import check_riichi, check_machi, machi, is_agari
+from .check_agari import check_riichi, machi, is_agari
+from .shanten import discard_shanten
 from .display import *
-
-from model.models import DiscardModel, RiichiModel, FuroModel
+from .inference import InferenceServer
+from .registry import registry, load_policy_model, load_multi_head_model, load_quantized_model
 
 
 class Agent(object):
@@ -22,7 +23,7 @@ class Agent(object):
         """
         self.score = score
         self.tiles = tiles
-        self.hand_tile_counter = AutoCleanCounter(map(lambda x: x // 4, tiles))
+        self.hand_tile_counter = TileCounter(map(lambda x: x // 4, tiles))
         self.hand_tile_counter_bak = copy(self.hand_tile_counter)
         self.discard_tiles = []
         self.river = []  # 没有被鸣走的牌河
@@ -46,8 +47,7 @@ class Agent(object):
         self.is_playback = is_playback
         if is_playback:
             return
-        if machi(self.hand_tile_counter):
-            self.machi = machi(self.hand_tile_counter)
+        self.machi = machi(self.hand_tile_counter)
 
     @property
     def furiten(self):
@@ -87,12 +87,8 @@ class Agent(object):
             return
         self.hand_tile_counter_bak = copy(self.hand_tile_counter)
         if not self.riichi_status:
-            if check_machi(self.hand_tile_counter):
-                self.machi = machi(self.hand_tile_counter)
-                self.discard_furiten = bool(self.machi.intersection(set(map(lambda x: x // 4, self.discard_tiles))))
-            else:
-                self.machi.clear()
-                self.discard_furiten = False
+            self.machi = machi(self.hand_tile_counter)
+            self.discard_furiten = bool(self.machi.intersection(set(map(lambda x: x // 4, self.discard_tiles))))
 
     def riichi(self, double_riichi=False):
         if self.riichi_status:
@@ -156,13 +152,15 @@ class Agent(object):
             if patterns:
                 return True, patterns
             return False, []
+        left_suji = self.hand_tile_counter[tile - 3] if d >= 3 else 0  # 筋牌需与被吃的牌同花色
+        right_suji = self.hand_tile_counter[tile + 3] if d <= 5 else 0
         if self.hand_tile_counter[tile - 1] and self.hand_tile_counter[tile - 2]:
-            if self.hand_tile_counter[tile] + self.hand_tile_counter[tile - 3] != tile_count - 2:
+            if self.hand_tile_counter[tile] + left_suji != tile_count - 2:
                 patterns.append(tile - 2)
         if self.hand_tile_counter[tile - 1] and self.hand_tile_counter[tile + 1]:
             patterns.append(tile - 1)
         if self.hand_tile_counter[tile + 1] and self.hand_tile_counter[tile + 2]:
-            if self.hand_tile_counter[tile] + self.hand_tile_counter[tile + 3] != tile_count - 2:
+            if self.hand_tile_counter[tile] + right_suji != tile_count - 2:
                 patterns.append(tile)
         if patterns:
             return True, patterns
@@ -303,94 +301,78 @@ class Agent(object):
 
 
 class AiAgent(object):
-    def __init__(self):
-        self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-
-        self.discard_model = None
-        self.riichi_model = None
-        self.chi_model = None
-        self.pon_model = None
-        self.kan_model = None
-
-        self.riichi_threshold = self.chi_threshold = self.pon_threshold = self.kan_threshold = None
-
-        self.load_discard_model('model/saved/discard-model/best.pt')
-        self.load_riichi_model('model/saved/riichi-model/best.pt')
-        self.load_chi_model('model/saved/chi-model/best.pt')
-        self.load_pon_model('model/saved/pon-model/best.pt')
-        self.load_kan_model('model/saved/kan-model/best.pt')
-
-    def load_discard_model(self, model_path):
-        if os.path.isfile(model_path):
-            params = torch.load(model_path, map_location=self.device)
-            state_dict = params['state_dict']
-            num_layers = params['num_layers']
-            in_channels = params['in_channels']
-            self.discard_model = DiscardModel(num_layers=num_layers, in_channels=in_channels)
-            self.discard_model.load_state_dict(state_dict)
-            self.discard_model.to(self.device)
-            self.discard_model.eval()
-            logging.debug(yellow('Discard model loaded'))
-
-    def load_riichi_model(self, model_path):
-        if os.path.isfile(model_path):
-            params = torch.load(model_path, map_location=self.device)
-            state_dict = params['state_dict']
-            num_layers = params['num_layers']
-            in_channels = params['in_channels']
-            self.riichi_threshold = params['threshold']
-            self.riichi_model = RiichiModel(num_layers=num_layers, in_channels=in_channels)
-            self.riichi_model.load_state_dict(state_dict)
-            self.riichi_model.to(self.device)
-            self.riichi_model.eval()
-            logging.debug(yellow('Riichi model loaded'))
-
-    def load_chi_model(self, model_path):
-        if os.path.isfile(model_path):
-            params = torch.load(model_path, map_location=self.device)
-            state_dict = params['state_dict']
-            num_layers = params['num_layers']
-            in_channels = params['in_channels']
-            self.chi_threshold = params['threshold']
-            self.chi_model = FuroModel(num_layers=num_layers, in_channels=in_channels)
-            self.chi_model.load_state_dict(state_dict)
-            self.chi_model.to(self.device)
-            self.chi_model.eval()
-            logging.debug(yellow('Chi model loaded'))
-
-    def load_pon_model(self, model_path):
-        if os.path.isfile(model_path):
-            params = torch.load(model_path, map_location=self.device)
-            state_dict = params['state_dict']
-            num_layers = params['num_layers']
-            in_channels = params['in_channels']
-            self.pon_threshold = params['threshold']
-            self.pon_model = FuroModel(num_layers=num_layers, in_channels=in_channels)
-            self.pon_model.load_state_dict(state_dict)
-            self.pon_model.to(self.device)
-            self.pon_model.eval()
-            logging.debug(yellow('Pon model loaded'))
-
-    def load_kan_model(self, model_path):
-        if os.path.isfile(model_path):
-            params = torch.load(model_path, map_location=self.device)
-            state_dict = params['state_dict']
-            num_layers = params['num_layers']
-            in_channels = params['in_channels']
-            self.kan_threshold = params['threshold']
-            self.kan_model = FuroModel(num_layers=num_layers, in_channels=in_channels)
-            self.kan_model.load_state_dict(state_dict)
-            self.kan_model.to(self.device)
-            self.kan_model.eval()
-            logging.debug(yellow('Kan model loaded'))
+    def __init__(self, model_dir='model/saved', max_batch_size=64, max_delay=0.005, registry=registry):
+        """
+        所有座位、所有牌桌可以共用一个AiAgent，推理请求由InferenceServer攒成batch统一处理
+        模型由ModelRegistry在第一次用到时加载，多个AiAgent共用同一份模型，checkpoint更新后自动换成新模型
+        """
+        self.model_dir = model_dir
+        self.registry = registry
+        self.device = registry.device
+        self.server = InferenceServer(
+            lambda name: self.model(name)[0],
+            self.device,
+            max_batch_size=max_batch_size,
+            max_delay=max_delay
+        )
+
+    def candidates(self, name):
+        """
+        按优先级依次给出可用的(model, threshold)：共用主干的多head模型 > CPU上的量化模型 > 单独的模型
+        多head模型中没有训练或测试数据的head没有阈值，跳过多head模型，使用该任务单独的模型
+        量化模型比同目录的best.pt旧时(重新训练后还没有重新量化)跳过，直接使用新的best.pt
+        """
+        model, meta = self.registry.get(os.path.join(self.model_dir, 'multi-head-model', 'best.pt'), load_multi_head_model)
+        if model is not None and name in meta.get('heads', ['discard', *meta['thresholds']]):
+            yield model, meta['thresholds'].get(name)
+        checkpoint = os.path.join(self.model_dir, f'{name}-model', 'best.pt')
+        if self.device.type == 'cpu':
+            quantized = os.path.join(self.model_dir, f'{name}-model', 'quantized.pt')
+            model, meta = self.registry.get(quantized, load_quantized_model, source=checkpoint)
+            if model is not None:
+                yield model, meta.get('threshold')
+        model, meta = self.registry.get(checkpoint, load_policy_model(name))
+        if model is not None:
+            yield model, meta.get('threshold')
+
+    def model(self, name):
+        """
+        :param name: discard、riichi、chi、pon、kan
+        :return: (model, threshold)，没有模型时为(None, None)
+        """
+        return next(self.candidates(name), (None, None))
+
+    def submit(self, name, state, extra=None):
+        """提交给推理服务，返回Future"""
+        return self.server.submit(name, state, extra)
 
     def discard(self, state, tiles):
         if len(tiles) == 1:
             return tiles[0], 1
-        if self.discard_model is None:
-            return random.choice(tiles), 1 / len(tiles)
-        state = torch.from_numpy(state).float()[None].to(self.device)
-        output = self.discard_model(state).softmax(1)[0]
+        if self.model('discard')[0] is None:
+            return self.shanten_discard(state, tiles)
+        return self.pick_discard(self.submit('discard', state).result(), tiles)
+
+    async def discard_async(self, state, tiles):
+        """discard的协程版本，等待推理结果时不占用线程"""
+        if len(tiles) == 1:
+            return tiles[0], 1
+        if self.model('discard')[0] is None:
+            return self.shanten_discard(state, tiles)
+        return self.pick_discard(await asyncio.wrap_future(self.submit('discard', state)), tiles)
+
+    @staticmethod
+    def shanten_discard(state, tiles):
+        """没有模型时打出向听数最小的牌"""
+        hand_tile_counter = TileCounter.from_counts(state[:4].sum(0).astype('uint8').tobytes())  # 前4个通道为手牌
+        shanten = discard_shanten(hand_tile_counter)
+        min_shanten = min(shanten[_ // 4] for _ in tiles)
+        candidates = [_ for _ in tiles if shanten[_ // 4] == min_shanten]
+        return random.choice(candidates), 1 / len(candidates)
+
+    @staticmethod
+    def pick_discard(output, tiles):
+        output = output.softmax(0)
         available = list(set([_ // 4 for _ in tiles]))
         prob = output[available]
         pred = available[prob.argmax().item()]
@@ -398,29 +380,128 @@ class AiAgent(object):
         discard_id = max(candidates)  # 取max可以确保不优先打赤牌（虽然也偶尔有需要优先打赤牌的需求，但可以忽略不计）
         return discard_id, max(prob)
 
+    def decisions(self, requests):
+        """
+        同一决策点的所有候选行为一次提交，在同一个batch中推理；共用主干时state只算一次主干
+        :param requests: [(name, state, furo_feature), ...]，name为riichi、chi、pon、kan，立直的furo_feature为None
+        :return: 各请求的行为意愿，大于0.5时执行
+        """
+        resolved, futures = self.submit_decisions(requests)
+        return self.decision_scores(requests, resolved, [future.result() for future in futures])
+
+    async def decisions_async(self, requests):
+        """decisions的协程版本"""
+        resolved, futures = self.submit_decisions(requests)
+        outputs = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+        return self.decision_scores(requests, resolved, outputs)
+
+    def submit_decisions(self, requests):
+        """:return: (各请求的(model, threshold), 有模型的请求的Future)"""
+        resolved, submitted = self.resolve_decisions(requests)
+        return resolved, self.server.submit_many(submitted) if submitted else []
+
+    def resolve_decisions(self, requests):
+        """:return: (各请求的(model, threshold), 有模型、需要推理的请求)"""
+        resolved = [self.model(name) for name, _, _ in requests]
+        submitted = [request for request, (model, _) in zip(requests, resolved) if model is not None]
+        return resolved, submitted
+
+    def infer(self, requests):
+        """
+        不经过推理线程，在当前线程中直接推理一批样本
+        :param requests: [(name, state, extra), ...]
+        :return: 各样本的输出
+        """
+        return self.server.infer(requests)
+
+    @staticmethod
+    def decision_scores(requests, resolved, outputs):
+        outputs = iter(outputs)
+        scores = []
+        for (name, _, _), (model, threshold) in zip(requests, resolved):
+            if model is None:  # 没有模型时立直、随机鸣牌
+                scores.append(True if name == 'riichi' else random.random())
+            else:
+                scores.append(next(outputs)[0].sigmoid().item() / threshold / 2)
+        return scores
+
+    def decision_requests(self, game, who, actions):
+        """
+        整理一个决策点的候选行为：和牌、九种九牌直接给出意愿，立直、吃、碰、杠需要推理
+        同一种吃、碰只推理一次，有赤牌时优先考虑将赤牌鸣出去的操作
+        :param game: MahjongGame
+        :return: ({行为下标: 意愿}, [(行为下标, 模型名, state, furo_feature), ...])，所有请求共用同一个state
+        """
+        state = game.get_feature(who)
+        pon_action = None
+        chi_actions = {}
+        kan_actions = []
+        pon_feature = None
+        action_score_dict = {}
+        requests = []
+
+        for i, action in enumerate(actions):
+            if action['type'] == 'agari':
+                if self.agari_decision(game.agents, action):
+                    action_score_dict[i] = 1
+            elif action['type'] == 'riichi':
+                requests.append((i, 'riichi', state, None))
+            elif action['type'] == 'ryuukyoku':
+                if action['kyuuhai_type_count'] == 9:
+                    if game.agents[who].score >= 100:  # 只有9种9牌且分数没那么低时还是流了吧
+                        action_score_dict[i] = 1
+            elif action['type'] == 'pon':
+                pattern = action['pattern']
+                if pon_feature is None:
+                    pon_feature = game.get_pon_feature(who, pattern[0] // 4, action['kui'])
+                if pon_action is None:
+                    pon_action = i, pon_feature
+                else:  # 有多种碰的方法，则一定存在赤牌，方便起见，优先考虑将赤牌碰出去的操作
+                    if {16, 52, 88}.intersection(pattern):
+                        pon_action = i, pon_feature
+            elif action['type'] == 'chi':
+                pattern = action['pattern']
+                chi_ptn = min(pattern) // 4
+                chi_feature = chi_actions.get(chi_ptn, (i, game.get_chi_feature(who, chi_ptn, action['kui'])))[1]
+                if chi_ptn not in chi_actions:
+                    chi_actions[chi_ptn] = i, chi_feature
+                else:  # 同一种顺子pattern有多种吃的方法，则一定存在赤牌，方便起见，优先考虑将赤牌吃出去的操作
+                    if {16, 52, 88}.intersection(pattern):
+                        chi_actions[chi_ptn] = i, chi_feature
+            elif action['type'] == 'kan':
+                pattern = action['pattern']
+                kan_feature = game.get_kan_feature(who, pattern)
+                kan_actions.append((i, kan_feature))
+        if pon_action:
+            i, pon_feature = pon_action
+            requests.append((i, 'pon', state, pon_feature))
+        for i, chi_feature in chi_actions.values():
+            requests.append((i, 'chi', state, chi_feature))
+        for i, kan_feature in kan_actions:
+            requests.append((i, 'kan', state, kan_feature))
+        return action_score_dict, requests
+
+    @staticmethod
+    def choose_action(actions, action_score_dict):
+        """意愿最高且不低于0.5的行为，否则pass(actions[0])"""
+        if action_score_dict:
+            i, score = max(action_score_dict.items(), key=lambda x: x[1])
+            if score >= 0.5:
+                return actions[i]
+        return actions[0]
+
     def riichi_decision(self, state):
-        if self.riichi_model is None:
-            return True
-        state = torch.from_numpy(state).float()[None].to(self.device)
-        return self.riichi_model(state)[0].sigmoid().item() / self.riichi_threshold / 2
+        return self.decisions([('riichi', state, None)])[0]
 
     def agari_decision(self, agents, agari_action):
         return True
 
+    # 以下鸣牌决策的state为concatenate([furo_feature, state])，前22个通道为furo_feature
     def chi_decision(self, state):
-        if self.chi_model is None:
-            return random.random()
-        state = torch.from_numpy(state).float()[None].to(self.device)
-        return self.chi_model(state)[0].sigmoid().item() / self.chi_threshold / 2
+        return self.decisions([('chi', state[22:], state[:22])])[0]
 
     def pon_decision(self, state):
-        if self.pon_model is None:
-            return random.random()
-        state = torch.from_numpy(state).float()[None].to(self.device)
-        return self.pon_model(state)[0].sigmoid().item() / self.pon_threshold / 2
+        return self.decisions([('pon', state[22:], state[:22])])[0]
 
     def kan_decision(self, state):
-        if self.kan_model is None:
-            return random.random()
-        state = torch.from_numpy(state).float()[None].to(self.device)
-        return self.kan_model(state)[0].sigmoid().item() / self.kan_threshold / 2
\ No newline at end of file
+        return self.decisions([('kan', state[22:], state[:22])])[0]
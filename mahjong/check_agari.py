@@ -1,86 +1,203 @@
-import copy
-import pickle
 from typing import List
 import os
-from collections import Counter
+from collections import Counter, namedtuple
+from functools import lru_cache
 from itertools import combinations
 from .make_agari_table_2 import AGARI_TABLE, calc_key, to_pattern
+from .table import CompactTable
 
-with open(os.path.join(os.path.dirname(__file__), AGARI_TABLE), 'rb') as f:
-    agari_table = pickle.loads(f.read())
+agari_table = CompactTable(os.path.join(os.path.dirname(__file__), AGARI_TABLE))
 
-MACHI_TABLE = 'MACHI_TABLE.pkl'
-with open(os.path.join(os.path.dirname(__file__), MACHI_TABLE), 'rb') as f:
-    machi_table = pickle.loads(f.read())
+MACHI_TABLE = 'MACHI_TABLE.bin'
+machi_table = CompactTable(os.path.join(os.path.dirname(__file__), MACHI_TABLE))
 
 
+AgariInfo = namedtuple('AgariInfo', ['num_kotsu', 'num_shuntsu', 'atama', 'mentsu', 'chitoi', 'cyuren', 'ikki', 'ryanpeikou', 'ippeikou'])
+
+
+@lru_cache(maxsize=None)
 def parse_agari_info(value):
-    num_kotsu = value & 0b111
-    num_shuntsu = (value & (0b111 << 3)) >> 3
-    atama = (value & (0b1111 << 6)) >> 6
-    m1 = (value & (0b1111 << 10)) >> 10
-    m2 = (value & (0b1111 << 14)) >> 14
-    m3 = (value & (0b1111 << 18)) >> 18
-    m4 = (value & (0b1111 << 22)) >> 22
-    chitoi = (value & (1 << 26)) >> 26
-    cyuren = (value & (1 << 27)) >> 27
-    ikki = (value & (1 << 28)) >> 28
-    ryanpeikou = (value & (1 << 29)) >> 29
-    ippeikou = (value & (1 << 30)) >> 30
-    return locals()
+    """
+    解析和牌表中的一种拆解方式, 同一个值只解析一次
+    mentsu: 4个面子在tiles_pos中的下标, 前num_kotsu个为刻子, 之后num_shuntsu个为顺子
+    """
+    return AgariInfo(
+        num_kotsu=value & 0b111,
+        num_shuntsu=value >> 3 & 0b111,
+        atama=value >> 6 & 0b1111,
+        mentsu=(value >> 10 & 0b1111, value >> 14 & 0b1111, value >> 18 & 0b1111, value >> 22 & 0b1111),
+        chitoi=value >> 26 & 1,
+        cyuren=value >> 27 & 1,
+        ikki=value >> 28 & 1,
+        ryanpeikou=value >> 29 & 1,
+        ippeikou=value >> 30 & 1
+    )
 
 
 def is_agari(counter):
     """
-    一般形、七对子返回一个或多个16进制数，国士无双返回True，没和返回None
+    一般形、七对子返回所有拆解方式组成的tuple(可用parse_agari_info解析)，国士无双返回True，没和返回None
     """
     pattern = to_pattern(counter)
     key = calc_key(pattern)
-    if key in agari_table[0]:
-        return agari_table[0][key]
-    if key in agari_table[1]:
-        if sum(counter[i] for i in [0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]) == 14:
-            return True
+    value = agari_table.get(key)
+    if value is None:
+        return None
+    if value:
+        return tuple(value)
+    if sum(counter[i] for i in [0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]) == 14:  # 国士无双的值为空
+        return True
     return None
 
 
 def check_machi(counter):
     ptn = to_pattern(counter)
     key = calc_key(ptn)
-    if key in machi_table[0]:
+    value = machi_table.get(key)
+    if value is None:
+        return False
+    if value[0] == 0:
+        return True
+    if sum(counter[i] for i in [0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]) == 13:  # 国士无双听牌
         return True
-    if key in machi_table[1]:
-        if sum(counter[i] for i in [0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]) == 13:  # 国士无双听牌
-            return True
     return False
 
 
+@lru_cache(maxsize=None)
+def _suit_agari(suit):
+    """
+    单一花色的和牌形状
+    :param suit: 该花色每种牌的张数(bytes)，数牌长度为9，字牌长度为7（字牌不能组成顺子）
+    :return: 位掩码, 1: 能全部拆成面子, 2: 能拆成面子加一个雀头
+    """
+    for i, c in enumerate(suit):
+        if c:
+            break
+    else:
+        return 1
+    ret = 0
+    rest = bytearray(suit)
+    if c >= 3:
+        rest[i] -= 3
+        ret |= _suit_agari(bytes(rest))
+        rest[i] += 3
+    if c >= 2:
+        rest[i] -= 2
+        if _suit_agari(bytes(rest)) & 1:
+            ret |= 2
+        rest[i] += 2
+    if len(suit) == 9 and i <= 6 and suit[i + 1] and suit[i + 2]:
+        rest[i] -= 1
+        rest[i + 1] -= 1
+        rest[i + 2] -= 1
+        ret |= _suit_agari(bytes(rest))
+    return ret
+
+
+@lru_cache(maxsize=None)
+def _suit_machi(suit):
+    """
+    单一花色加一张牌后的和牌形状
+    :return: (加入后能拆成面子加雀头的牌, 加入后能全部拆成面子的牌), 均为花色内的下标
+    """
+    pair_machi = []
+    mentsu_machi = []
+    rest = bytearray(suit)
+    for i, c in enumerate(suit):
+        if c == 4:
+            continue
+        rest[i] += 1
+        ret = _suit_agari(bytes(rest))
+        rest[i] -= 1
+        if ret & 2:
+            pair_machi.append(i)
+        if ret & 1:
+            mentsu_machi.append(i)
+    return tuple(pair_machi), tuple(mentsu_machi)
+
+
+def _split_suits(counts):
+    return [counts[0:9], counts[9:18], counts[18:27], counts[27:34]]
+
+
+def _standard_machi(suits, flags):
+    """
+    一般形的听牌，其他花色只需查和牌形状，缺牌的那一种花色再查听牌
+    :param suits: 万、筒、索、字四种花色的张数(bytes)
+    :param flags: 四种花色的_suit_agari结果
+    """
+    broken = [k for k, f in enumerate(flags) if not f & 1]  # 不能全部拆成面子的花色
+    if len(broken) > 2:
+        return []
+    res = []
+    for k, suit in enumerate(suits):
+        others = [j for j in broken if j != k]
+        if not others:  # 其他花色都是面子，雀头可以由这种花色提供，也可以由其他花色提供
+            need_atama = True
+            has_atama = any(flags[j] & 2 for j in range(4) if j != k)
+        elif len(others) == 1:  # 其他花色中恰好有一个雀头
+            need_atama = False
+            has_atama = flags[others[0]] & 2
+        else:
+            continue
+        pair_machi, mentsu_machi = _suit_machi(suit)
+        if need_atama:
+            res.extend(k * 9 + i for i in pair_machi)
+        if has_atama:
+            res.extend(k * 9 + i for i in mentsu_machi)
+    return res
+
+
+def _special_machi(counts):
+    """七对子、国士无双的听牌"""
+    zeros = counts.count(0)
+    if zeros == 27:  # 七对子: 6个对子加1张单牌
+        if counts.count(2) == 6 and counts.count(1) == 1:
+            return [counts.index(1)]
+    elif zeros == 21 or zeros == 22:  # 国士无双: 13种幺九牌, 或12种幺九牌且其中一种成对
+        yaochu = [counts[i] for i in [0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]]
+        if sum(yaochu) == 13 == sum(counts):
+            if zeros == 21:
+                return [0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]
+            return [[0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33][yaochu.index(0)]]
+    return []
+
+
+def riichi_machi(counter):
+    """
+    一次性计算打出手中每一种牌以后的听牌，打出的牌只会改变一种花色，其他花色的结果均可复用
+    :return: {打出的牌: 听牌集合}, 只包含打出后能听牌的项
+    """
+    counts = bytearray(counter)
+    suits = _split_suits(bytes(counts))
+    flags = [_suit_agari(suit) for suit in suits]
+    res = {}
+    for tile, c in enumerate(counts):
+        if not c:
+            continue
+        k = min(tile // 9, 3)
+        suit = bytearray(suits[k])
+        suit[tile - k * 9] -= 1
+        suit = bytes(suit)
+        counts[tile] -= 1
+        waits = set(_standard_machi(suits[:k] + [suit] + suits[k + 1:], flags[:k] + [_suit_agari(suit)] + flags[k + 1:]))
+        waits.update(_special_machi(counts))
+        counts[tile] += 1
+        if waits:
+            res[tile] = waits
+    return res
+
+
 def check_riichi(counter, return_riichi_hai=False):
-    counter = copy.copy(counter)
-    hai = []
-    for t, c in list(counter.items()):
-        if c > 0:
-            counter[t] -= 1
-            if check_machi(counter):
-                if not return_riichi_hai:
-                    return True
-                hai.append(t)
-            counter[t] += 1
-    if hai:
-        return hai
+    hai = list(riichi_machi(counter))
     if return_riichi_hai:
-        return []
-    return False
+        return hai
+    return bool(hai)
 
 
 def machi(counter):
-    counter = copy.copy(counter)
-    res = set()
-    for i in range(34):
-        if counter[i] == 4:
-            continue
-        counter[i] += 1
-        if is_agari(counter) is not None:
-            res.add(i)
-        counter[i] -= 1
+    counts = bytes(counter)
+    suits = _split_suits(counts)
+    res = set(_standard_machi(suits, [_suit_agari(suit) for suit in suits]))
+    res.update(_special_machi(counts))
     return res
@@ -1,6 +1,8 @@
 import numpy as np
 from typing import List
 import random
+from copy import copy
+from bisect import bisect_right
 from .agent import Agent
 from .utils import *
 from .check_agari import is_agari, check_riichi
@@ -9,6 +11,49 @@ from .check_agari import is_agari, check_riichi
 if hasattr(random, 'SystemRandom'):
     random = random.SystemRandom()
 
+# get_feature中各部分特征的通道数，按顺序排列
+FEATURE_LAYOUT = [
+    ('hand', 4),  # 手牌
+    ('seat', 4),  # 自家座位
+    ('rank', 4),  # 自家顺位
+    ('discard', 4 * 24),  # 四家舍牌
+    ('visible', 4),  # 可见牌
+    ('dora', 5),  # 宝牌
+    ('aka', 3),  # 赤牌
+    ('wind', 2),  # 自风、场风
+    ('left_num', 5),  # 剩余牌数
+    ('furo', 16 * 4),  # 四家副露
+    ('round', 16),  # 局顺
+    ('honba', 20),  # 本场棒
+    ('riichi_ba', 20),  # 立直棒
+    ('score', 9 * 4),  # 四家的分数
+    ('riichi', 4),  # 四家的立直情况
+    ('oya', 4),  # 亲家
+]
+FEATURE_OFFSET = {}
+FEATURE_CHANNELS = 0
+for _name, _channels in FEATURE_LAYOUT:
+    FEATURE_OFFSET[_name] = FEATURE_CHANNELS
+    FEATURE_CHANNELS += _channels  # 291
+LEFT_NUM_BINS = [5, 10, 22, 46]
+SCORE_BINS = list(range(50, 450, 50))
+LEVELS = np.arange(4)
+AKA = [16, 52, 88]
+
+
+def get_batch_feature(requests, out=None):
+    """
+    一次性计算多局游戏、多个座位的特征
+    :param requests: [(game, target), ...]
+    :param out: 预先分配的(N, FEATURE_CHANNELS, 34)缓冲区，为None时新建
+    :return: (N, FEATURE_CHANNELS, 34)
+    """
+    if out is None:
+        out = np.zeros(shape=(len(requests), FEATURE_CHANNELS, 34))
+    for i, (game, target) in enumerate(requests):
+        game.get_feature(target, out=out[i])
+    return out
+
 
 class MahjongGame(object):
     def __init__(self, has_aka=True, is_playback=False):
@@ -27,9 +72,12 @@ class MahjongGame(object):
         self.kang_num = [0] * 4  # 每个玩家的开杠数
         self.agents: List[Agent] = [Agent(250, set(), i, is_playback=is_playback) for i in range(4)]  # 玩家
         self.ranks = list(range(4))
-        self.public_visible_tiles = Counter()  # 所有玩家均可见的牌的数量
+        self.public_visible_tiles = TileCounter()  # 所有玩家均可见的牌的数量
         self.first_round = True  # 第一巡，用来判定天地和、九九流局等
         self.is_playback = is_playback
+        self.observations = None  # 四个座位的观测缓冲区(4, FEATURE_CHANNELS, 34)，由各事件增量更新
+        self.observation_rows = None  # 各座位观测中当前为1的类别特征通道
+        self.reset_observations()
 
     def get_rank(self):
         scores = [(i, p.score) for i, p in enumerate(self.agents)]
@@ -61,7 +109,8 @@ class MahjongGame(object):
         index_scores = list(enumerate(scores))
         index_scores.sort(key=lambda x: x[1], reverse=True)
         self.ranks = [index_scores.index((i, p.score)) for i, p in enumerate(self.agents)]
-        self.public_visible_tiles = Counter([dora_indicator // 4])
+        self.public_visible_tiles = TileCounter([dora_indicator // 4])
+        self.reset_observations()
 
     def new_game(self, game_round, honba, riichi_ba):
         dice1, dice2 = random.randint(1, 6), random.randint(1, 6)
@@ -96,7 +145,8 @@ class MahjongGame(object):
         index_scores = list(enumerate([p.score for p in self.agents]))
         index_scores.sort(key=lambda x: x[1], reverse=True)
         self.ranks = [index_scores.index((i, p.score)) for i, p in enumerate(self.agents)]
-        self.public_visible_tiles = Counter([dora_indicator // 4])
+        self.public_visible_tiles = TileCounter([dora_indicator // 4])
+        self.reset_observations()
 
     def new_dora(self, dora=None):
         if dora is None:
@@ -107,6 +157,9 @@ class MahjongGame(object):
         self.dora_indicator.append(dora)
         self.dora.append(get_dora(dora))
         self.public_visible_tiles[dora // 4] += 1
+        if len(self.dora) <= 5:
+            self.observations[:, FEATURE_OFFSET['dora'] + len(self.dora) - 1, self.dora[-1]] = 1
+        self.update_tile_observations([dora // 4])
 
     def declare_furo(self, who, meld_code):
         """for playback only"""
@@ -141,12 +194,14 @@ class MahjongGame(object):
     def pon(self, who, tile_id_list, kui_tile, from_who=None):
         self.agents[who].pon(tile_id_list, kui_tile, from_who)
         self.public_visible_tiles[kui_tile // 4] += 2
+        self.update_furo_observations(who, tile_id_list)
 
     def chi(self, who, tile_id_list, kui_tile, from_who=None):
         for tile_id in tile_id_list:
             if tile_id != kui_tile:
                 self.public_visible_tiles[tile_id // 4] += 1
         self.agents[who].chi(tile_id_list, kui_tile, from_who)
+        self.update_furo_observations(who, tile_id_list)
 
     def kan(self, who, tile_id_list, add=None, kui_tile=None, from_who=None, mode=0):
         """
@@ -155,6 +210,7 @@ class MahjongGame(object):
         self.agents[who].kan(tile_id_list, add=add, kui_tile=kui_tile, from_who=from_who, mode=mode)
         self.kang_num[who] += 1
         self.public_visible_tiles[tile_id_list[0] // 4] = 4
+        self.update_furo_observations(who, tile_id_list)
 
     def draw(self, who, tile_id=None, where=0):
         if tile_id is None:
@@ -163,11 +219,20 @@ class MahjongGame(object):
             tile_id = self.yama.pop(where)
         self.agents[who].draw(tile_id)
         self.left_num -= 1
+        self.update_tile_observations([tile_id // 4])
+        if tile_id in AKA:
+            self.update_aka_observation(who)
         return tile_id
 
     def discard(self, who, tile_id):
         self.agents[who].discard(tile_id)
         self.public_visible_tiles[tile_id // 4] += 1
+        n = len(self.agents[who].discard_tiles)
+        if n <= 24:
+            self.observations[:, FEATURE_OFFSET['discard'] + who * 24 + n - 1, tile_id // 4] = 1
+        self.update_tile_observations([tile_id // 4])
+        if tile_id in AKA:
+            self.update_aka_observation(who)
 
     def can_declare_riichi(self, who):
         if self.left_num < 4:
@@ -177,50 +242,72 @@ class MahjongGame(object):
     def riichi(self, who, double_riichi=False):
         if self.agents[who].riichi(double_riichi):
             self.riichi_ba += 1
+            self.observations[:, FEATURE_OFFSET['riichi'] + who] = self.agents[who].riichi_status
+
+    def reset_observations(self):
+        """按当前局面重建四个座位的观测缓冲区，之后由draw、discard、pon、chi、kan、new_dora、riichi增量更新"""
+        self.observations = np.zeros(shape=(4, FEATURE_CHANNELS, 34))
+        for i in range(4):
+            self.build_feature(i, out=self.observations[i])
+        self.observation_rows = [self.get_category_rows(i) for i in range(4)]
+
+    def update_tile_observations(self, tiles):
+        """某几种牌的张数变化后，更新四个座位的手牌、可见牌通道中对应的列"""
+        hand, visible = FEATURE_OFFSET['hand'], FEATURE_OFFSET['visible']
+        for tile in tiles:
+            counts = np.array([[p.hand_tile_counter[tile]] for p in self.agents])
+            self.observations[:, hand:hand + 4, tile] = counts > LEVELS
+            self.observations[:, visible:visible + 4, tile] = counts + self.public_visible_tiles[tile] > LEVELS
+
+    def update_aka_observation(self, who):
+        for i, aka in enumerate(AKA):
+            self.observations[who, FEATURE_OFFSET['aka'] + i] = aka in self.agents[who].tiles
+
+    def update_furo_observations(self, who, tile_id_list):
+        start = FEATURE_OFFSET['furo'] + who * 16
+        self.observations[:, start:start + 16] = self.get_furo_feature(self.agents[who].furo.keys())
+        self.update_tile_observations({_ // 4 for _ in tile_id_list})
+        self.update_aka_observation(who)
 
     @staticmethod
-    def get_hand_tile_feature(counter):
+    def get_hand_tile_feature(counter, out=None):
         """
         自家手牌
-        :param counter: Counter
+        :param counter: TileCounter
+        :param out: 写入的(4, 34)缓冲区，为None时新建
         :return: (4, 34)
         """
-        feature = np.zeros(shape=(4, 34))
-        upper_triangle = np.tril(np.ones(4))
-        for tile, c in counter.items():
-            if c > 0:
-                feature[:, tile] = upper_triangle[c - 1]
-        return feature
+        counts = np.frombuffer(counter, dtype=np.uint8)
+        if out is None:
+            return (counts > np.arange(4)[:, None]).astype(np.float64)
+        np.greater(counts, np.arange(4)[:, None], out=out)
+        return out
 
     @staticmethod
-    def get_furo_feature(furo_keys):
+    def get_furo_feature(furo_keys, out=None):
         """
         副露,每个副露4通道,共16通道
+        :param out: 写入的(16, 34)缓冲区，为None时新建
         :return: (4 * 4, 34)
         """
-        total_feature = []
-        for furo_type, ptn in furo_keys:
-            feature = np.zeros(shape=(4, 34))
+        if out is None:
+            out = np.zeros(shape=(16, 34))
+        else:
+            out.fill(0)
+        for i, (furo_type, ptn) in enumerate(furo_keys):
             if furo_type == 0:  # 吃
                 ptn = ptn[0]
-                feature[0, [ptn, ptn + 1, ptn + 2]] = 1
+                out[i * 4, ptn:ptn + 3] = 1
             elif furo_type == 1:  # 碰
-                feature[[0, 1, 2], ptn] = 1
+                out[i * 4:i * 4 + 3, ptn] = 1
             else:  # 杠
-                feature[:, ptn] = 1
-            total_feature.append(feature)
-        total_feature = np.concatenate([*total_feature, np.zeros(shape=(16 - len(total_feature) * 4, 34))], axis=0)
-        return total_feature
+                out[i * 4:i * 4 + 4, ptn] = 1
+        return out
 
     def get_visible_tiles_feature(self, target):
         visible = copy(self.public_visible_tiles)
         visible.update([_ // 4 for _ in self.agents[target].tiles])
-        feature = np.zeros(shape=(4, 34))
-        upper_triangle = np.tril(np.ones(4))
-        for tile, c in visible.items():
-            if c > 0:
-                feature[:, tile] = upper_triangle[c - 1]
-        return feature
+        return self.get_hand_tile_feature(visible)
         # visible = copy(self.public_visible_tiles)
         # upper_triangle = np.tril(np.ones(4))
         # feature1 = np.zeros(shape=(4, 34))  # 全场的可见牌
@@ -325,10 +412,16 @@ class MahjongGame(object):
         feature[1, self.round_wind] = 1
         return feature
 
-    def get_reach_feature(self):
-        feature = np.zeros(shape=(4, 34))
-        for i, p in enumerate(self.agents):
-            feature[i].fill(p.riichi_status)
+    def get_furo_decision_feature(self, hand_tile_counter, furo_keys, is_dora, tile_id):
+        """
+        鸣牌决策的附加特征
+        :return: (22, 34)
+        """
+        feature = np.zeros(shape=(22, 34))
+        feature[0] = is_dora  # 1
+        feature[1] = tile_id in [16, 52, 88]  # 1
+        self.get_hand_tile_feature(hand_tile_counter, out=feature[2:6])  # 4
+        self.get_furo_feature(furo_keys, out=feature[6:22])  # 16
         return feature
 
     def get_pon_feature(self, who, pattern, kui_tile):
@@ -337,16 +430,7 @@ class MahjongGame(object):
         furo = copy(player.furo)
         hand_tile_counter[pattern] -= 2
         furo[(1, pattern)] = []
-        hand_tile_feature = self.get_hand_tile_feature(hand_tile_counter)
-        furo_feature = self.get_furo_feature(furo.keys())
-        is_dora = np.ones(shape=(1, 34)) * (pattern in self.dora)
-        is_aka = np.ones(shape=(1, 34)) * (kui_tile in [16, 52, 88])
-        return np.concatenate([
-            is_dora,  # 1
-            is_aka,  # 1
-            hand_tile_feature,  # 4
-            furo_feature  # 16
-        ], axis=0)  # 22
+        return self.get_furo_decision_feature(hand_tile_counter, furo.keys(), pattern in self.dora, kui_tile)
 
     def get_chi_feature(self, who, pattern, kui_tile):
         player = self.agents[who]
@@ -363,16 +447,7 @@ class MahjongGame(object):
             hand_tile_counter[kui_ptn - 2] -= 1
             hand_tile_counter[kui_ptn - 1] -= 1
         furo[(0, (pattern, len(furo)))] = []
-        hand_tile_feature = self.get_hand_tile_feature(hand_tile_counter)
-        furo_feature = self.get_furo_feature(furo.keys())
-        is_dora = np.ones(shape=(1, 34)) * (kui_ptn in self.dora)
-        is_aka = np.ones(shape=(1, 34)) * (kui_tile in [16, 52, 88])
-        return np.concatenate([
-            is_dora,  # 1
-            is_aka,  # 1
-            hand_tile_feature,  # 4
-            furo_feature  # 16
-        ], axis=0)  # 22
+        return self.get_furo_decision_feature(hand_tile_counter, furo.keys(), kui_ptn in self.dora, kui_tile)
 
     def get_kan_feature(self, who, pattern):
         player = self.agents[who]
@@ -387,65 +462,89 @@ class MahjongGame(object):
         else:
             furo[(2, kan_ptn)] = []
         hand_tile_counter[kan_ptn] = 0
-        hand_tile_feature = self.get_hand_tile_feature(hand_tile_counter)
-        furo_feature = self.get_furo_feature(furo.keys())
-        is_dora = np.ones(shape=(1, 34)) * (tile_id // 4 in self.dora)
-        is_aka = np.ones(shape=(1, 34)) * (tile_id in [16, 52, 88])
-        return np.concatenate([
-            is_dora,  # 1
-            is_aka,  # 1
-            hand_tile_feature,  # 4
-            furo_feature  # 16
-        ], axis=0)  # 22
-
-    def get_feature(self, target, hidden_info_mask=0):
-        """ Oracle Agent能获取的全局信息 """
-        # hand_features = []
-        # for i in range(4):
-        #     if i == target:
-        #         hand_features.append(self.get_hand_tile_feature(self.agents[i].hand_tile_counter))
-        #     elif hidden_info_mask == 0:
-        #         hand_features.append(np.zeros(shape=(4, 34)))
-        #     else:
-        #         hand_features.append(self.get_hand_tile_feature(self.agents[i].hand_tile_counter) * hidden_info_mask)
-        # hand_feature = np.concatenate(hand_features)
+        return self.get_furo_decision_feature(hand_tile_counter, furo.keys(), tile_id // 4 in self.dora, tile_id)
+
+    def get_category_rows(self, target):
+        """整个通道为1、每次取特征时重新计算的类别特征"""
+        offset = FEATURE_OFFSET
+        rows = [
+            offset['seat'] + target,  # 自家座位
+            offset['rank'] + self.ranks[target],  # 自家顺位
+            offset['left_num'] + bisect_right(LEFT_NUM_BINS, self.left_num),  # 剩余牌数（分为5个区间）
+            offset['round'] + self.round,  # 局顺
+            offset['honba'] + min(self.honba, 19),  # 本场棒
+            offset['riichi_ba'] + min(self.riichi_ba, 19),  # 立直棒
+            offset['oya'] + self.oya,  # 亲家
+        ]
+        for i, p in enumerate(self.agents):  # 四家的分数，分为9个区间
+            rows.append(offset['score'] + i * 9 + bisect_right(SCORE_BINS, p.score))
+        return rows
+
+    def build_feature(self, target, out=None):
+        """
+        根据当前局面从头计算特征
+        各部分特征按FEATURE_OFFSET写入同一块(FEATURE_CHANNELS, 34)的缓冲区，布局见FEATURE_LAYOUT
+        :param out: 预先分配的缓冲区，为None时新建
+        """
+        if out is None:
+            out = np.zeros(shape=(FEATURE_CHANNELS, 34))
+        else:
+            out.fill(0)
+        player = self.agents[target]
+        offset = FEATURE_OFFSET
+        # 整个通道为1的类别特征
+        rows = self.get_category_rows(target)
+        for i, aka in enumerate(AKA):  # 赤牌
+            if aka in player.tiles:
+                rows.append(offset['aka'] + i)
+        out[rows] = 1
+        # 单张牌的特征
+        rows = [offset['wind'], offset['wind'] + 1]  # 自风、场风
+        cols = [player.menfon, self.round_wind]
+        for i, tile in enumerate(self.dora[:5]):  # 宝牌
+            rows.append(offset['dora'] + i)
+            cols.append(tile)
+        for i, p in enumerate(self.agents):  # 四家舍牌
+            start = offset['discard'] + i * 24
+            rows.extend(range(start, start + min(len(p.discard_tiles), 24)))
+            cols.extend(tile // 4 for tile in p.discard_tiles[:24])
+        out[rows, cols] = 1
+        # 手牌、可见牌
+        hand = np.frombuffer(player.hand_tile_counter, dtype=np.uint8)
+        visible = np.frombuffer(self.public_visible_tiles, dtype=np.uint8) + hand
+        np.greater(hand, LEVELS[:, None], out=out[offset['hand']:offset['hand'] + 4])
+        np.greater(visible, LEVELS[:, None], out=out[offset['visible']:offset['visible'] + 4])
+        for i, p in enumerate(self.agents):  # 四家副露
+            start = offset['furo'] + i * 16
+            if p.furo:
+                self.get_furo_feature(p.furo.keys(), out=out[start:start + 16])
+        out[offset['riichi']:offset['riichi'] + 4] = [[p.riichi_status] for p in self.agents]  # 四家的立直情况
+        return out
+
+    def get_feature(self, target, hidden_info_mask=0, out=None):
+        """
+        Oracle Agent能获取的全局信息
+        直接取增量维护的观测缓冲区，只需刷新局顺、分数等类别特征
+        :param out: 预先分配的(FEATURE_CHANNELS, 34)缓冲区，为None时返回一份拷贝
+        """
         # wall_feature = self.get_wall_feature() * hidden_info_mask if hidden_info_mask > 0 else np.zeros(shape=(70, 34))
-        hand_feature = self.get_hand_tile_feature(self.agents[target].hand_tile_counter)  # 手牌
-        seat_feature = self.get_category_feature(target, 4)  # 自家座位
-        rank_feature = self.get_category_feature(self.ranks[target], 4)  # 自家顺位
-        discard_feature = self.get_discard_tile_feature(discard_length=24)  # 四家舍牌
-        visible_tiles_feature = self.get_visible_tiles_feature(target)  # 可见牌特征
-        dora_feature = self.get_dora_feature()  # 宝牌
-        aka_feature = self.get_aka_feature(target)  # 赤牌
-        wind_feature = self.get_wind_feature(target)  # 自风、场风
-        left_num_feature = self.get_bucket_feature([self.left_num], bins=[5, 10, 22, 46])  # 剩余牌数（分为5个区间）
-        furo_feature = [self.get_furo_feature(p.furo.keys()) for p in self.agents]  # 四家副露
-        round_feature = self.get_category_feature(self.round, 16)  # 局顺
-        honba_feature = self.get_category_feature(self.honba, 20)  # 本场棒
-        riichi_ba_feature = self.get_category_feature(self.riichi_ba, 20)  # 立直棒
-        score_feature = self.get_bucket_feature([_.score for _ in self.agents], bins=list(range(50, 450, 50)))  # 四家的分数，分为9个区间
-        riichi_feature = self.get_reach_feature()  # 四家的立直情况
-        oya_feature = self.get_category_feature(self.oya, 4)  # 亲家
-        features = np.concatenate([
-            hand_feature,  # 16
-            # wall_feature,  # 70
-            seat_feature,  # 4
-            rank_feature,  # 4
-            discard_feature,  # 4 * 24
-            visible_tiles_feature,  # 4
-            dora_feature,  # 5
-            aka_feature,  # 3
-            wind_feature,  # 2
-            left_num_feature,  # 5
-            *furo_feature,  # 16 * 4
-            round_feature,  # 16
-            honba_feature,  # 20
-            riichi_ba_feature,  # 20
-            score_feature,  # 9 * 4
-            riichi_feature,  # 4
-            oya_feature  # 4
-        ], axis=0)  # 373
-        return features
+        observation = self.observations[target]
+        rows = self.get_category_rows(target)
+        if rows != self.observation_rows[target]:
+            observation[self.observation_rows[target]] = 0
+            observation[rows] = 1
+            self.observation_rows[target] = rows
+        if out is None:
+            return observation.copy()
+        out[...] = observation
+        return out
+
+    def get_batch_feature(self, targets=range(4), out=None):
+        """
+        多个座位的特征
+        :return: (len(targets), FEATURE_CHANNELS, 34)
+        """
+        return get_batch_feature([(self, target) for target in targets], out)
 
     def get_game_feature(self, round_score, target_score):
         round_score_feature = self.get_bucket_feature([round_score], bins=list(range(-200, 200, 20)), one_dim=True)
@@ -0,0 +1,131 @@
+"""
+批量推理服务
+所有牌桌、所有AI座位的推理请求先放进队列，后台线程把max_delay时间内到达的请求攒成一个batch，
+按模型分组后在inference_mode下统一推理，结果通过Future返回
+同一决策点的所有候选行为通过submit_many一起入队，保证落在同一个batch里；
+共用主干的模型对同一个state对象只算一次主干，多出来的候选行为只需要计算head
+"""
+import time
+import threading
+from queue import Queue, Empty
+from collections import defaultdict
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+
+class InferenceServer(object):
+    def __init__(self, models, device, max_batch_size=64, max_delay=0.005):
+        """
+        :param models: {模型名: nn.Module}或者按模型名返回模型的函数(模型可以热更新)，多个名字可以对应同一个带forward_heads的多head模型
+        :param max_batch_size: 一个batch最多包含的请求数
+        :param max_delay: 第一个请求到达后最多等待多少秒再开始推理
+        """
+        self.get_model = models.__getitem__ if isinstance(models, dict) else models
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, name, state, extra=None):
+        """
+        提交一个样本
+        :param state: 不带batch维的特征
+        :param extra: 鸣牌模型的附加特征(furo_feature)，模型输入为concatenate([extra, state])
+        :return: Future，结果为模型对该样本的输出(cpu上的tensor)
+        """
+        return self.submit_many([(name, state, extra)])[0]
+
+    def submit_many(self, requests):
+        """
+        一次提交同一决策点的多个样本，它们一定在同一个batch中推理
+        :param requests: [(name, state, extra), ...]，候选行为之间共用的state传同一个对象
+        :return: [Future, ...]
+        """
+        requests = [(name, state, extra, Future()) for name, state, extra in requests]
+        self.queue.put(requests)
+        return [future for *_, future in requests]
+
+    def infer(self, requests):
+        """
+        在调用者的线程中直接推理一批样本，不经过队列、不等待max_delay
+        调用者已经攒好了batch(例如VectorEnv同步推进的多个对局)，同样按模型分组，每个模型一次前向
+        :return: [output, ...]
+        """
+        requests = [(name, state, extra, Future()) for name, state, extra in requests]
+        self.process(requests)
+        return [future.result() for *_, future in requests]
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            requests = self.queue.get()
+            if requests is None:
+                return
+            batch = list(requests)
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    requests = self.queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if requests is None:  # 处理完当前batch再退出
+                    self.queue.put(None)
+                    break
+                batch.extend(requests)  # 同一决策点的请求不拆开，batch可能略超过max_batch_size
+            self.process(batch)
+
+    def to_tensor(self, state):
+        state = torch.from_numpy(state).to(self.device)
+        if state.dtype == torch.uint8:  # 打包的特征，由模型展开
+            return state
+        return state.float()
+
+    def shared_tensors(self, arrays):
+        """同一个numpy对象只转换、拷贝一次，得到的tensor也是同一个对象，模型据此复用主干"""
+        tensors = {}
+        for x in arrays:
+            if x is not None and id(x) not in tensors:
+                tensors[id(x)] = self.to_tensor(x)
+        return [None if x is None else tensors[id(x)] for x in arrays]
+
+    def process(self, batch):
+        models = {}  # 一个batch内每个名字只取一次模型，热更新不会把一个batch拆到新旧两个模型上
+        groups = defaultdict(list)  # 多个名字可以对应同一个多head模型，按模型分组
+        for name, state, extra, future in batch:
+            if future.set_running_or_notify_cancel():
+                if name not in models:
+                    try:
+                        models[name] = self.get_model(name)
+                    except Exception as e:  # 例如热更新的checkpoint与模型结构不符，只让这个名字的请求失败，推理线程继续运行
+                        models[name] = e
+                if isinstance(models[name], Exception):
+                    future.set_exception(models[name])
+                    continue
+                groups[id(models[name])].append((name, state, extra, future))
+        with torch.inference_mode():
+            for requests in groups.values():
+                names, states, extras, futures = zip(*requests)
+                model = models[names[0]]
+                try:
+                    if hasattr(model, 'forward_heads'):  # 共用主干的模型一次算完所有head
+                        outputs = model.forward_heads(names, self.shared_tensors(states), self.shared_tensors(extras))
+                        outputs = [output.cpu() for output in outputs]
+                    else:
+                        inputs = [state if extra is None else np.concatenate([extra, state]) for state, extra in zip(states, extras)]
+                        outputs = model(self.to_tensor(np.stack(inputs))).cpu()
+                except Exception as e:
+                    for future in futures:
+                        future.set_exception(e)
+                    continue
+                for future, output in zip(futures, outputs):
+                    future.set_result(output)
@@ -4,7 +4,6 @@
 
 import copy
 from itertools import permutations
-import pickle
 
 import tqdm
 
@@ -155,11 +154,10 @@ def find_hai_pos(a):
                         ret_array.append(ret)
             p_atama += 1
     if len(ret_array) > 0:
-        ret_array = list(set(ret_array))
-        return ','.join(map(hex, ret_array))
+        return tuple(set(ret_array))
     t = sum(a, [])
     if sum(t) == 14 and all(_ in [0, 2] for _ in t):
-        return hex(1 << 26)
+        return (1 << 26,)
 
 
 def to_pattern(counter):
@@ -183,8 +181,10 @@ def to_pattern(counter):
     return pattern
 
 
-AGARI_TABLE = 'AGARI_TABLE_2.pkl'
+AGARI_TABLE = 'AGARI_TABLE_2.bin'
 if __name__ == '__main__':
+    from table import save_table
+
     agari_table = {0: {}, 1: {}}
 
     chitoi = ptn([[2], [2], [2], [2], [2], [2], [2]])
@@ -223,5 +223,7 @@ if __name__ == '__main__':
         p.pop(i)
 
     print('和牌pattern数:', len(agari_table[0]))
-    with open(AGARI_TABLE, 'wb') as f:
-        f.write(pickle.dumps(agari_table))
\ No newline at end of file
+    # 一般形、七对子的值为拆解方式，国士无双的值为空
+    table = {key: () for key in agari_table[1]}
+    table.update(agari_table[0])
+    save_table(AGARI_TABLE, table)
\ No newline at end of file
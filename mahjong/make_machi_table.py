@@ -3,6 +3,7 @@
 """
 
 from make_agari_table_2 import *
+from table import save_table
 
 
 def remove_one_from_ptn(a):
@@ -42,7 +43,7 @@ def remove_one_from_ptn(a):
     return ptns
 
 
-MACHI_TABLE = 'MACHI_TABLE.pkl'
+MACHI_TABLE = 'MACHI_TABLE.bin'
 if __name__ == '__main__':
     machi_table = {0: set(), 1: set()}
 
@@ -86,5 +87,7 @@ if __name__ == '__main__':
         machi_table[1].add(key)
 
     print('听牌pattern数:', len(machi_table[0]))
-    with open(MACHI_TABLE, 'wb') as f:
-        f.write(pickle.dumps(machi_table))
\ No newline at end of file
+    # 值为1表示国士无双听牌
+    table = {key: [0] for key in machi_table[0]}
+    table.update({key: [1] for key in machi_table[1]})
+    save_table(MACHI_TABLE, table, value_fmt='B', width=1)
\ No newline at end of file
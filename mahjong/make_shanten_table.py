@@ -0,0 +1,62 @@
+"""
+该文件用于打向听数表
+对每一种花色（数牌9种、字牌7种）的每一种张数分布（总张数不超过14），
+记录凑出m个面子(0-4)、p个雀头(0-1)最少还需要摸进几张该花色的牌
+"""
+
+from itertools import product
+
+import numpy as np
+
+
+def calc_distance(counts):
+    """
+    :param counts: (N, 9)或(N, 7)的张数数组，长度为7时视为字牌（不能组成顺子）
+    :return: (N, 10)的uint8数组，第p * 5 + m项为凑出m个面子、p个雀头最少还需要摸的张数
+    """
+    counts = np.asarray(counts, dtype=np.int8)
+    n, length = counts.shape
+    # 状态: (从上一张开始的顺子数, 从上上张开始的顺子数, 已有面子数, 已有雀头数)
+    states = {(0, 0, 0, 0): np.zeros(n, dtype=np.int8)}
+    for i in range(length):
+        miss = [np.maximum(req - counts[:, i], 0).astype(np.int8) for req in range(5)]
+        max_shuntsu = 4 if length == 9 and i <= length - 3 else 0
+        new_states = {}
+        for (a, b, m, p), cost in states.items():
+            for t, q, s in product(range(2), range(2 - p), range(max_shuntsu + 1)):
+                req = a + b + 3 * t + 2 * q + s
+                if m + t + s > 4 or req > 4:
+                    continue
+                key = (s, a, m + t + s, p + q)
+                if key in new_states:
+                    np.minimum(new_states[key], cost + miss[req], out=new_states[key])
+                else:
+                    new_states[key] = cost + miss[req]
+        states = new_states
+    ret = np.full((n, 10), 99, dtype=np.int8)
+    for (a, b, m, p), cost in states.items():
+        np.minimum(ret[:, p * 5 + m], cost, out=ret[:, p * 5 + m])
+    return ret.astype(np.uint8)
+
+
+DIGITS = bytes.maketrans(bytes(range(5)), b'01234')
+
+
+def suit_key(suit):
+    """把花色的张数(bytes)当作5进制数作为键，最高位补1以区分数牌和字牌"""
+    return int(b'1' + suit.translate(DIGITS), 5)
+
+
+def make_table(length):
+    suits = np.array([s for s in product(range(5), repeat=length) if sum(s) <= 14], dtype=np.uint8)
+    distance = calc_distance(suits)
+    return {suit_key(bytes(s)): d for s, d in zip(suits, distance)}
+
+
+SHANTEN_TABLE = 'SHANTEN_TABLE.bin'
+if __name__ == '__main__':
+    from table import save_table
+
+    number_table, honor_table = make_table(9), make_table(7)
+    print('数牌pattern数:', len(number_table), '字牌pattern数:', len(honor_table))
+    save_table(SHANTEN_TABLE, {**number_table, **honor_table}, key_fmt='I', value_fmt='B', width=10)
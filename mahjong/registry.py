@@ -0,0 +1,197 @@
+"""
+进程内共享的模型表
+每个checkpoint第一次用到时才加载，之后所有房间、AiAgent、线程共用同一份只读的模型；
+state_dict以mmap方式读取，在CPU上直接使用映射的内存，多个进程加载同一个文件时共享page cache(需要torch>=2.1，更早的版本照常读入内存)；
+checkpoint文件被覆盖(例如训练脚本保存了新的best.pt)后，下一次取用时重新加载并替换，不需要重启服务
+"""
+import os
+import json
+import atexit
+import time
+import inspect
+import zipfile
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+import torch
+
+from model.models import DiscardModel, RiichiModel, FuroModel, MultiHeadModel, RewardPredictor
+from .display import yellow
+
+SNAPSHOT_DIR = os.path.join(tempfile.gettempdir(), 'mahjong-ai-models')
+MODEL_CLASSES = {
+    'discard': DiscardModel,
+    'riichi': RiichiModel,
+    'chi': FuroModel,
+    'pon': FuroModel,
+    'kan': FuroModel,
+}
+MMAP_SUPPORTED = 'mmap' in inspect.signature(torch.load).parameters and \
+    'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters  # torch>=2.1
+
+
+def snapshot(path, mtime):
+    """
+    cp、torch.save覆盖文件时会先把原文件截断，正在mmap使用的参数会因此SIGBUS
+    所以先把checkpoint复制成一个不会再被修改的快照再mmap，同一版本的checkpoint在多个进程间共用同一个快照
+    快照名以checkpoint路径的hash开头，生成新版本的快照时删除同一checkpoint旧版本的快照
+    """
+    prefix = hashlib.md5(os.path.abspath(path).encode()).hexdigest()
+    name = f'{prefix}-{mtime}-{os.path.basename(path)}'
+    target = os.path.join(SNAPSHOT_DIR, name)
+    if not os.path.exists(target):
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        tmp = f'{target}.{os.getpid()}.tmp'
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, target)
+    for other in os.listdir(SNAPSHOT_DIR):
+        if other.startswith(f'{prefix}-') and other != name and not other.endswith('.tmp'):
+            remove_snapshot(os.path.join(SNAPSHOT_DIR, other))
+    return target
+
+
+def check_complete(path):
+    """torch.save、torch.jit.save都是zip格式，中央目录最后写入，没写完的文件会抛BadZipFile"""
+    zipfile.ZipFile(path).close()
+
+
+def remove_snapshot(path):
+    """删除后仍在mmap使用它的模型(包括其他进程的)不受影响，最后一个映射释放后空间才回收"""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def read_checkpoint(path):
+    if MMAP_SUPPORTED:
+        return torch.load(path, map_location='cpu', mmap=True)
+    return torch.load(path, map_location='cpu')
+
+
+def assign_state_dict(model, params, device):
+    """把checkpoint中的state_dict装进模型，返回其余参数"""
+    params = dict(params)
+    if MMAP_SUPPORTED:
+        model.load_state_dict(params.pop('state_dict'), assign=True)  # assign=True时参数直接使用mmap的内存
+    else:
+        model.load_state_dict(params.pop('state_dict'))
+    model.to(device)
+    return params
+
+
+def load_policy_model(name):
+    """弃牌、立直、吃、碰、杠的单独模型"""
+    def loader(path, device):
+        params = read_checkpoint(path)
+        model = MODEL_CLASSES[name](num_layers=params['num_layers'], in_channels=params['in_channels'])
+        return model, assign_state_dict(model, params, device)
+    return loader
+
+
+def load_multi_head_model(path, device):
+    params = read_checkpoint(path)
+    model = MultiHeadModel(
+        in_channels=params['in_channels'],
+        furo_channels=params['furo_channels'],
+        num_layers=params['num_layers'],
+        head_layers=params['head_layers']
+    )
+    return model, assign_state_dict(model, params, device)
+
+
+def load_reward_model(path, device):
+    params = read_checkpoint(path)
+    model = RewardPredictor(74, params['hidden_dims'], params['num_layers'])
+    return model, assign_state_dict(model, params, device)
+
+
+def load_quantized_model(path, device):
+    """sl_train/quantize_model.py导出的TorchScript模型"""
+    extra_files = {'meta.json': ''}
+    model = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    meta = json.loads(extra_files['meta.json'])
+    if meta['engine'] in torch.backends.quantized.supported_engines:  # int8权重按导出时的后端打包
+        torch.backends.quantized.engine = meta['engine']
+    return model, meta
+
+
+def is_older(path, other):
+    """path的修改时间早于other，任一文件不存在时为False"""
+    try:
+        return os.stat(path).st_mtime_ns < os.stat(other).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+class ModelRegistry(object):
+    def __init__(self, device=None, check_interval=5.):
+        """
+        :param check_interval: 两次检查checkpoint是否更新之间至少间隔的秒数
+        """
+        self.device = device or (torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu'))
+        self.check_interval = check_interval
+        self.entries = {}  # {path: {'model', 'meta', 'mtime', 'snapshot', 'failed': 加载失败的mtime, 'checked': 上次检查的时间}}
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def close(self):
+        """删除本进程用到的快照，进程退出时自动调用"""
+        with self.lock:
+            for entry in self.entries.values():
+                if entry['snapshot'] is not None:
+                    remove_snapshot(entry['snapshot'])
+                    entry['snapshot'] = None
+
+    def get(self, path, loader, source=None):
+        """
+        :param loader: (path, device) -> (model, meta)
+        :param source: 生成path的文件(例如量化模型对应的best.pt)，path比它旧时当作不存在
+        :return: (model, meta)，文件不存在时为(None, None)
+        """
+        entry = self.entries.get(path)
+        now = time.monotonic()
+        if entry is not None and now - entry['checked'] < self.check_interval:
+            return entry['model'], entry['meta']
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and now - entry['checked'] < self.check_interval:  # 其他线程刚检查过
+                return entry['model'], entry['meta']
+            if entry is None:
+                entry = self.entries[path] = {'model': None, 'meta': None, 'mtime': None, 'snapshot': None, 'failed': None, 'checked': now}
+            entry['checked'] = now
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if source is not None and is_older(path, source):  # 已经过时，不再使用该模型
+                mtime = None
+            if mtime == entry['mtime'] or mtime is not None and mtime == entry['failed']:
+                return entry['model'], entry['meta']
+            if mtime is None:  # checkpoint被删除，不再使用该模型
+                model, meta, snapshot_path = None, None, None
+            else:
+                snapshot_path = None
+                try:
+                    snapshot_path = snapshot(path, mtime)
+                    check_complete(snapshot_path)
+                    model, meta = loader(snapshot_path, self.device)
+                except Exception as e:  # 文件可能正在写入或与模型不匹配，保留旧模型，文件再次修改后才重试
+                    logging.warning(f'Failed to load {path}: {e!r}')
+                    if snapshot_path is not None:
+                        remove_snapshot(snapshot_path)
+                    entry['failed'] = mtime
+                    return entry['model'], entry['meta']
+                model.eval()
+                model.requires_grad_(False)
+                logging.debug(yellow(f'{path} {"reloaded" if entry["model"] is not None else "loaded"}'))
+            if entry['snapshot'] is not None:
+                remove_snapshot(entry['snapshot'])
+            entry.update(model=model, meta=meta, mtime=mtime, snapshot=snapshot_path, failed=None)
+            return model, meta
+
+
+registry = ModelRegistry()
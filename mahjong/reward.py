@@ -0,0 +1,76 @@
+"""
+逐局计算reward
+reward = 本局结束后RewardPredictor对终局分数的估值 - 上一局结束后的估值(第一局之前为250)
+每个玩家保存GRU的隐状态和上一次的估值，新的一局只需推进一步，不需要把之前所有局的特征重新算一遍；
+多个玩家(四家、多个对局)同一时刻提交的局面合成一个batch推进
+"""
+import numpy as np
+import torch
+
+from .registry import registry, load_reward_model
+
+REWARD_MODEL = 'model/saved/reward-model/best.pt'
+
+
+class RewardEvaluator(object):
+    def __init__(self, path=REWARD_MODEL, registry=registry):
+        self.path = path
+        self.registry = registry
+        self.model = None  # 隐状态由哪个模型算出，模型热更新后需要重算
+        self.states = {}  # {key: (隐状态(num_layers, hidden_dims), 上一次的估值, 之前各局的特征)}
+        self.pending = []  # [(key, 新一局的特征, callback), ...]
+
+    def submit(self, key, feature, callback):
+        """
+        :param key: 玩家的标识，同一个玩家在一个半庄中的各局要使用同一个key
+        :param feature: MahjongGame.get_game_feature
+        :param callback: flush时以该局的reward调用
+        """
+        if any(key == pending_key for pending_key, _, _ in self.pending):  # 同一个玩家的两局必须先后推进
+            self.flush()
+        self.pending.append((key, feature, callback))
+
+    def reset(self, key):
+        """半庄结束，丢弃该玩家的状态"""
+        self.states.pop(key, None)
+
+    def get_model(self):
+        model, _ = self.registry.get(self.path, load_reward_model)
+        if model is None:
+            raise FileNotFoundError(self.path)
+        if model is not self.model:
+            self.model = model
+            self.states = {key: self.restore(history) for key, (_, _, history) in self.states.items()}
+        return model
+
+    @torch.inference_mode()
+    def restore(self, history):
+        """用新模型重新计算之前各局的隐状态和估值"""
+        features = torch.from_numpy(np.stack(history)).float().to(self.registry.device)[None]
+        out, h_n = self.model.gru(features)
+        value = self.model.fc(out[:, -1, :]).item() * 500
+        return h_n[:, 0], value, history
+
+    @torch.inference_mode()
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        model = self.get_model()
+        keys, features, callbacks = zip(*pending)
+        states = [self.states.get(key) for key in keys]
+        x = torch.from_numpy(np.stack(features)).float().to(self.registry.device)
+        if all(state is None for state in states):
+            h = None
+        else:
+            h = torch.stack([
+                model.gru.weight_hh_l0.new_zeros(model.gru.num_layers, model.gru.hidden_size) if state is None else state[0]
+                for state in states
+            ], 1)
+        values, h_n = model.step(x, h)
+        values = (values[:, 0] * 500).tolist()
+        for i, (key, feature, callback, state, value) in enumerate(zip(keys, features, callbacks, states, values)):
+            last_value, history = (250, []) if state is None else state[1:]
+            history.append(feature)
+            self.states[key] = h_n[:, i], value, history
+            callback(value - last_value)
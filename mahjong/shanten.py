@@ -0,0 +1,119 @@
+import os
+from functools import lru_cache
+from .make_shanten_table import SHANTEN_TABLE, calc_distance, suit_key
+from .table import CompactTable
+
+shanten_table = CompactTable(os.path.join(os.path.dirname(__file__), SHANTEN_TABLE))
+
+YAOCHU = [0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]
+
+
+@lru_cache(maxsize=None)
+def _suit_distance(suit):
+    """
+    查表得到单一花色凑出m个面子、p个雀头最少还需要摸的张数, 第p * 5 + m项
+    表中只有总张数不超过14的情况，其余情况现算
+    """
+    i = shanten_table.index(suit_key(suit))
+    if i < 0:
+        return bytes(calc_distance([list(suit)])[0])
+    return shanten_table.value(i).tobytes()
+
+
+@lru_cache(maxsize=None)
+def _merge(x, y):
+    """
+    两组花色的距离做(min, +)卷积
+    不同的距离组合只有一百多种，卷积结果直接缓存
+    """
+    ret = [99] * 10
+    for p1 in range(2):
+        for m1 in range(5):
+            a = x[p1 * 5 + m1]
+            for p2 in range(2 - p1):
+                for m2 in range(5 - m1):
+                    k = (p1 + p2) * 5 + m1 + m2
+                    if a + y[p2 * 5 + m2] < ret[k]:
+                        ret[k] = a + y[p2 * 5 + m2]
+    return bytes(ret)
+
+
+def _split_suits(counts):
+    return [counts[0:9], counts[9:18], counts[18:27], counts[27:34]]
+
+
+def standard_shanten(counter, num_mentsu=None):
+    """
+    一般形向听数，-1表示已和牌
+    :param num_mentsu: 还需要凑的面子数，默认按手牌张数推算(副露后手牌张数减少)
+    """
+    counts = bytes(counter)
+    if num_mentsu is None:
+        num_mentsu = sum(counts) // 3
+    man, pin, sou, ji = map(_suit_distance, _split_suits(counts))
+    return _merge(_merge(man, pin), _merge(sou, ji))[5 + num_mentsu] - 1
+
+
+def chiitoi_shanten(counter):
+    counts = bytes(counter)
+    kinds = 34 - counts.count(0)
+    pairs = kinds - counts.count(1)
+    return 6 - pairs + max(0, 7 - kinds)
+
+
+def kokushi_shanten(counter):
+    yaochu = [counter[i] for i in YAOCHU]
+    return yaochu.count(0) - any(c >= 2 for c in yaochu)
+
+
+def shanten(counter):
+    """
+    向听数，取一般形、七对子、国士无双中的最小值，-1表示已和牌
+    七对子、国士无双只在门清(13张或14张)时计算
+    """
+    ret = standard_shanten(counter)
+    if sum(counter) >= 13:
+        ret = min(ret, chiitoi_shanten(counter), kokushi_shanten(counter))
+    return ret
+
+
+def discard_shanten(counter):
+    """
+    一次性计算打出手中每一种牌以后的向听数，打出的牌只改变一种花色，其他三种花色的卷积结果可复用
+    :return: {打出的牌: 向听数}
+    """
+    counts = bytes(counter)
+    num_mentsu = (sum(counts) - 1) // 3
+    suits = _split_suits(counts)
+    man, pin, sou, ji = map(_suit_distance, suits)
+    man_pin, sou_ji = _merge(man, pin), _merge(sou, ji)
+    others = [_merge(pin, sou_ji), _merge(man, sou_ji), _merge(man_pin, ji), _merge(man_pin, sou)]  # 除去第k种花色以外的卷积结果
+
+    menzen = sum(counts) >= 14
+    if menzen:
+        kinds = 34 - counts.count(0)
+        pairs = kinds - counts.count(1)
+        yaochu = [counts[i] for i in YAOCHU]
+        yaochu_kinds = 13 - yaochu.count(0)
+        yaochu_pairs = 13 - yaochu.count(0) - yaochu.count(1)
+
+    res = {}
+    for tile, c in enumerate(counts):
+        if not c:
+            continue
+        k = min(tile // 9, 3)
+        suit = bytearray(suits[k])
+        suit[tile - k * 9] -= 1
+        ret = _merge(_suit_distance(bytes(suit)), others[k])[5 + num_mentsu] - 1
+        if menzen:
+            # 七对子
+            p, n = pairs - (c == 2), kinds - (c == 1)
+            ret = min(ret, 6 - p + max(0, 7 - n))
+            # 国士无双
+            if tile in YAOCHU:
+                y, yp = yaochu_kinds - (c == 1), yaochu_pairs - (c == 2)
+            else:
+                y, yp = yaochu_kinds, yaochu_pairs
+            ret = min(ret, 13 - y - (yp > 0))
+        res[tile] = ret
+    return res
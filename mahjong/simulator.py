@@ -0,0 +1,969 @@
+"""
+无网络的对局引擎
+摸牌、和牌/立直/鸣牌判定、切牌、结算等规则流程写成协程，需要玩家决策的地方await self.decide / self.select_tile
+1. 直接使用时不需要事件循环: begin()开始一个半庄并返回第一个Request，step(结果)推进到下一个决策点，半庄结束时返回None
+2. online_game/server.py的GameEnvironment继承它，把决策交给真人或AI，并把各事件发给客户端
+3. VectorEnv同步推进多个对局，每一步所有对局的决策点合成一个batch推理；play_games在进程池中并行自我对局
+"""
+import os
+import logging
+import multiprocessing
+from typing import List
+from functools import partial
+from collections import defaultdict
+
+import torch
+
+from .game import MahjongGame
+from .agent import AiAgent
+from .reward import RewardEvaluator
+from .yaku import Yaku, YakuList
+from .check_agari import check_riichi
+from .display import *
+
+
+class Request(object):
+    """
+    等待玩家决策的请求，await时交给驱动者，驱动者send回的值就是决策结果
+    kind为'discard'时options为可以打出的牌，banned为食替不能打出的牌种，结果为打出的牌
+    kind为'decision'时options为候选行为(第一个为pass)，结果为其中一个行为
+    """
+    __slots__ = ('kind', 'who', 'options', 'banned', 'after_tsumo')
+
+    def __init__(self, kind, who, options, banned=None, after_tsumo=True):
+        self.kind = kind
+        self.who = who
+        self.options = options
+        self.banned = banned or []
+        self.after_tsumo = after_tsumo
+
+    def __await__(self):
+        result = yield self
+        return result
+
+
+class Simulator(object):
+    def __init__(self, has_aka=True, min_score=0, train=False, reward_evaluator=None):
+        """
+        :param train: 收集AI的弃牌数据，每条为[state, 打出的牌种, 该局的reward]
+        :param reward_evaluator: 多个Simulator共用的RewardEvaluator，由使用者统一flush；为None时自己创建，每局结算时立即计算reward
+        """
+        self.game = MahjongGame(has_aka, is_playback=False)
+        self.agents = self.game.agents
+        self.round = 0
+        self.honba = 0
+        self.riichi_ba = 0
+        self.has_aka = has_aka
+        self.current_player = 0
+        self.game_start = False
+        self.min_score = min_score
+        self.coroutine = None  # 直接驱动时正在进行的半庄
+        self.num_rounds = 0
+        self.ranks = None  # 半庄结束后的[(座位, 分数), ...]
+        self.train = train
+        if train:
+            self.collected_data = defaultdict(list)
+            self.reward_evaluator = reward_evaluator or RewardEvaluator()
+            self.flush_rewards = reward_evaluator is None
+
+    def player_name(self, who):
+        return f'玩家{who}'
+
+    # 以下事件通知由GameEnvironment发给客户端，无网络时忽略
+    def update(self, key, value, who=None):
+        pass
+
+    def send_seat(self, who, message):
+        pass
+
+    def send_multiply(self, message, exception=-1, exception_ob=-1):
+        pass
+
+    async def decide(self, who, actions, after_tsumo):
+        """从actions中选择一个行为"""
+        return await Request('decision', who, actions, after_tsumo=after_tsumo)
+
+    async def select_tile(self, who, tiles, banned=None, tsumo=None, riichi=False, is_riichi_tile=False):
+        """:return: (打出的牌, 是否为摸切)"""
+        if tiles == 'all':
+            tiles = list(self.agents[who].tiles)
+        tile_id = await Request('discard', who, tiles, banned=banned)
+        return tile_id, tile_id == tsumo  # 如果banned为空，则tsumo为自摸的牌，否则tsumo为被鸣的牌，则必定不是摸切
+
+    async def gather(self, jobs):
+        """其他三家对打出的牌的响应，依次询问"""
+        results = []
+        try:
+            for job in jobs:
+                results.append(await job)
+        finally:
+            for job in jobs[len(results):]:
+                job.close()  # 对局被中途放弃时，还没有开始的协程也要关闭
+        return results
+
+    async def pause(self, seconds):
+        """客户端播放动画的停顿"""
+        pass
+
+    def start(self):
+        self.game.new_game(self.round, self.honba, self.riichi_ba)
+
+    def reset(self):
+        self.game = MahjongGame(self.has_aka, is_playback=False)
+        self.agents = self.game.agents
+        self.round = 0
+        self.honba = 0
+        self.riichi_ba = 0
+        self.current_player = 0
+        self.game_start = False
+        if self.train:
+            # self.collected_data.clear()
+            for i in range(4):
+                self.reward_evaluator.reset((id(self), i))
+
+    def record_discard(self, who, state, discard):
+        """AI打出一张牌，训练模式下记录"""
+        if self.train:
+            self.collected_data[who].append([state, discard // 4])
+
+    def round_end(self, res, score_delta, scores):
+        """
+        一局结算后调用，训练模式下给本局还没有reward的数据补上reward
+        :param scores: 结算前四家的分数
+        """
+        if not self.train:
+            return
+        for i in range(4):
+            items = [item for item in self.collected_data[i] if len(item) == 2]
+            feature = self.game.get_game_feature(score_delta[i], scores[i])
+            self.reward_evaluator.submit((id(self), i), feature, partial(append_reward, items))
+        if self.flush_rewards:
+            self.reward_evaluator.flush()
+
+    async def play(self):
+        """打完一个半庄，返回最终排名"""
+        self.game_start = True
+        self.num_rounds = 0
+        while True:
+            self.start()
+            res = await self.game_loop()
+            scores = [p.score for p in self.agents]
+            game_over, score_delta = self.game_update(res)
+            self.num_rounds += 1
+            self.round_end(res, score_delta, scores)
+            if game_over:
+                self.game_start = False
+                return self.game.get_rank()
+
+    def begin(self):
+        """开始一个新的半庄，返回第一个Request"""
+        self.reset()
+        self.ranks = None
+        self.coroutine = self.play()
+        return self.step(None)
+
+    def step(self, result):
+        """
+        :param result: 上一个Request的决策结果
+        :return: 下一个Request，半庄结束时返回None，最终排名在self.ranks
+        """
+        try:
+            return self.coroutine.send(result)
+        except StopIteration as e:
+            self.coroutine = None
+            self.ranks = e.value
+            return None
+
+    def print_agari_info(self, who, from_who, action):
+        han = action['han']
+        fu = action['fu']
+        score = action['score']
+        ret = action['yaku']
+        yaku_list = action['yaku_list']
+        if who != from_who:
+            agari_info = f"「{self.player_name(from_who)}」放铳！「{self.player_name(who)}」荣和！役种: {'、'.join(yaku_list)}->"
+        else:
+            agari_info = f"「{self.player_name(who)}」自摸！役种: {'、'.join(yaku_list)}->"
+        if isinstance(ret, List):
+            if han >= 2:
+                agari_info += f'{han}倍役满！'
+            else:
+                agari_info += '役满！'
+        else:
+            agari_info += f'{han}番({fu}符)->基本点: {score}'
+        logging.info(cyan(agari_info))
+        self.agents[who].tiles.difference_update({action['machi']})
+        logging.info(cyan(self.agents[who].display_tiles('str') + '  ' + TENHOU_TILE_STRING_DICT[action['machi']]))
+        if self.agents[who].furo:
+            logging.info(cyan(self.agents[who].display_furo('str')))
+
+    def game_update(self, res):
+        change_oya = True
+        self.honba = honba = self.game.honba
+        self.riichi_ba = riichi_ba = self.game.riichi_ba
+        oya = self.game.oya
+        score_delta = [0, 0, 0, 0]
+        if isinstance(res, list):  # 和牌
+            first_winner = res[0]['who']
+            for action in res:
+                who = action['who']
+                from_who = action['from_who']
+                score = action['score']
+                if who == from_who:  # 自摸
+                    if who == oya:
+                        score = ((score * 2) + 90) // 100
+                        for i in range(4):
+                            if i != oya:
+                                self.agents[i].score -= score + honba
+                                score_delta[i] -= score + honba
+                        self.agents[who].score += score * 3 + honba * 3
+                        score_delta[who] += score * 3 + honba * 3
+                        change_oya = False
+                    else:
+                        score_oya = ((score * 2) + 90) // 100
+                        score = (score + 90) // 100
+                        for i in range(4):
+                            if i == who:
+                                self.agents[i].score += score_oya + score * 2 + honba * 3
+                                score_delta[i] += score_oya + score * 2 + honba * 3
+                            elif i == oya:
+                                self.agents[i].score -= score_oya + honba
+                                score_delta[i] -= score_oya + honba
+                            else:
+                                self.agents[i].score -= score + honba
+                                score_delta[i] -= score + honba
+                else:
+                    if who == oya:
+                        score = ((score * 6) + 90) // 100 + honba * 3
+                        change_oya = False
+                    else:
+                        score = ((score * 4) + 90) // 100 + honba * 3
+                    self.agents[from_who].score -= score
+                    self.agents[who].score += score
+                    score_delta[from_who] -= score
+                    score_delta[who] += score
+                self.print_agari_info(who, from_who, action)
+            if riichi_ba:
+                self.agents[first_winner].score += riichi_ba * 10
+                score_delta[first_winner] += riichi_ba * 10
+            self.riichi_ba = 0
+            if not change_oya:
+                self.honba += 1
+            else:
+                self.honba = 0
+        else:  # 流局
+            why = res['why']
+            if why == 'yama_end':  # 结算荒牌流局
+                logging.info(cyan('荒牌流局'))
+                nagashimangan = res['nagashimangan']
+                machi_state = res['machi_state']
+                for i in range(4):
+                    if i in machi_state:
+                        machi_tiles = machi_state[i][1]
+                        logging.info(cyan(f"「{self.player_name(i)}」听牌: {'、'.join(TILE_STRING_DICT[_] for _ in machi_tiles)}"))
+                change_oya = oya not in machi_state
+                if nagashimangan:  # 流满
+                    for i in nagashimangan:
+                        logging.info(cyan(f"「{self.player_name(i)}」流局满贯！"))
+                        for j in range(4):
+                            if j == i:
+                                if j == oya:
+                                    self.agents[j].score += 120
+                                    score_delta[j] += 120
+                                else:
+                                    self.agents[j].score += 80
+                                    score_delta[j] += 80
+                            else:
+                                if j == oya:
+                                    self.agents[j].score -= 40
+                                    score_delta[j] -= 40
+                                else:
+                                    self.agents[j].score -= 20
+                                    score_delta[j] -= 20
+                else:
+                    if 1 <= len(machi_state) < 4:
+                        score_get = 30 // len(machi_state)
+                        score_give = 30 // (4 - len(machi_state))
+                        for i in range(4):
+                            if i in machi_state:
+                                self.agents[i].score += score_get
+                                score_delta[i] += score_get
+                            else:
+                                self.agents[i].score -= score_give
+                                score_delta[i] -= score_give
+            else:
+                if why == 'yao9':
+                    who = res['who']
+                    logging.info(cyan(f'流局: 「{self.player_name(who)}」九种九牌'))
+                elif why == 'kaze4':
+                    logging.info(cyan('流局: 四风连打'))
+                elif why == 'kan4':
+                    logging.info(cyan('流局: 四杠散了'))
+                elif why == 'reach4':
+                    logging.info(cyan('流局: 四家立直'))
+                elif why == 'ron3':
+                    logging.info(cyan('流局: 三家和了'))
+                change_oya = False
+            self.honba += 1
+        if change_oya:
+            self.round += 1
+        if min(p.score for p in self.agents) * 100 < self.min_score:
+            return True, score_delta
+        if self.round > 11:
+            return True, score_delta
+        if self.round > 7 or (self.round == 7 and not change_oya):
+            if max(p.score for p in self.agents) < 300:
+                return False, score_delta
+            if change_oya:
+                if self.riichi_ba:
+                    winner = max(((i, p.score) for i, p in enumerate(self.agents)), key=lambda x: x[1])[0]
+                    self.agents[winner].score += self.riichi_ba * 10
+                    self.riichi_ba = 0
+                return True, score_delta
+            winner = self.game.get_rank()[0][0]
+            return winner == oya, score_delta
+        else:
+            return False, score_delta
+
+    async def check_draw(self, who, tile_id, where):
+        """
+        检查并响应当前是否能和牌、立直、暗杠、加杠等，生成一个可行的行为列表并选择
+
+        :return {
+            'type': 'agari' / 'riichi' / 'kan' / 'pass' / 'ryuukyoku'
+            'who': who,
+            'from_who': who,
+            'pattern'
+        }
+        """
+        player = self.agents[who]
+        actions = [{'type': 'pass'}]
+        can_agari = False
+        """判定和牌"""
+        agari = None
+        yaku = None
+        tenhou = False  # 天、地和
+        if tile_id // 4 in player.machi:
+            if where == -1:
+                tokusyu = 1
+            elif self.game.left_num == 0:
+                tokusyu = 3
+            else:
+                tokusyu = 0
+            yaku = Yaku(
+                hand_tiles=player.tiles,
+                furo=player.furo,
+                agarihai=tile_id,
+                dora=self.game.dora,
+                ura_dora=self.game.ura_dora,
+                bahai=self.game.round_wind,
+                menfon=player.menfon,
+                tsumo=True,
+                riichi=player.riichi_status,
+                ippatsu=player.ippatsu_status,
+                tokusyu=tokusyu,
+                aka=self.has_aka
+            )
+            agari = yaku.agari
+            if self.game.first_round:
+                tenhou = True
+                actions.append({'type': 'agari', 'who': who, 'from_who': who, 'machi': tile_id})
+                can_agari = True
+            elif yaku.naive_check_yaku():
+                actions.append({'type': 'agari', 'who': who, 'from_who': who, 'machi': tile_id})
+                can_agari = True
+            else:
+                if isinstance(agari, tuple):
+                    han, fu, score, ret = yaku.yaku(agari)
+                else:
+                    if yaku.counter[yaku.agarihai] == 2:
+                        ret = [YakuList.KOKUSHIJUSANMEN]
+                        han = 2
+                    else:
+                        ret = [YakuList.KOKUSHIMUSO]
+                        han = 1
+                    fu = 25
+                    score = han * 8000
+                if han > 0:
+                    actions.append({'type': 'agari', 'who': who, 'from_who': who, 'yaku': ret, 'han': han, 'fu': fu,
+                                    'score': score, 'machi': tile_id})
+                    can_agari = True
+        """判定九种九牌"""
+        if self.game.first_round:
+            kyuuhai_type_count = len({_ // 4 for _ in player.tiles}.intersection([0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]))
+            if kyuuhai_type_count >= 9:
+                actions.append({'type': 'ryuukyoku', 'who': who, 'why': 'yao9', 'kyuuhai_type_count': kyuuhai_type_count})
+        """判定立直"""
+        can_riichi = self.game.can_declare_riichi(who)
+        if can_riichi:
+            actions.append({'type': 'riichi', 'who': who, 'step': 1, 'double_riichi': self.game.first_round})
+
+        """判定杠"""
+        can_ankan, ankan_patterns = self.game.check_kan(who, tile_id, mode=0)
+        can_addkan, addkan_pattern = self.game.check_kan(who, tile_id, mode=2)
+        if can_ankan or can_addkan:
+            for ptn in ankan_patterns + addkan_pattern:
+                actions.append({'type': 'kan', 'pattern': ptn, 'who': who, 'from_who': who})
+        if len(actions) > 1:
+            action = await self.decide(who, actions, True)
+            if action['type'] == 'agari':
+                if 'yaku' not in action:
+                    if isinstance(agari, tuple):
+                        han, fu, score, ret = yaku.yaku(agari)
+                    else:
+                        if yaku.counter[yaku.agarihai] == 2:
+                            ret = [YakuList.KOKUSHIJUSANMEN]
+                            han = 2
+                        else:
+                            ret = [YakuList.KOKUSHIMUSO]
+                            han = 1
+                        fu = 25
+                        score = han * 8000
+                    if tenhou:
+                        han += 1
+                        if isinstance(ret, list):
+                            if who == self.game.oya:
+                                tenhou = YakuList.TENHOU
+                                if YakuList.KOKUSHIMUSO in ret:
+                                    ret.remove(YakuList.KOKUSHIMUSO)
+                                    ret.append(YakuList.KOKUSHIJUSANMEN)
+                                    han += 1
+                                elif YakuList.CHURENPOTO in ret:
+                                    ret.remove(YakuList.CHURENPOTO)
+                                    ret.append(YakuList.CHURENCHUMEN)
+                                    han += 1
+                                elif YakuList.SUANKO in ret:
+                                    ret.remove(YakuList.SUANKO)
+                                    ret.append(YakuList.SUANKOTANKI)
+                                    han += 1
+                            else:
+                                tenhou = YakuList.CHIHOU
+                            ret.append(tenhou)
+                            score += 8000
+                        else:
+                            ret = [YakuList.TENHOU if who == self.game.oya else YakuList.CHIHOU]
+                            han = 1
+                            score = 8000
+                    action['yaku'] = ret
+                    action['han'] = han
+                    action['fu'] = fu
+                    action['score'] = score
+                action['yaku_list'] = yaku.parse_yaku_ret(action['yaku'], True)
+                action['hai'] = yaku.hand_tiles
+                action['furo'] = list(yaku.furo.values())
+            elif can_agari:  # 见逃
+                if player.riichi_status:
+                    player.riichi_furiten = True
+                    self.update('furiten', True, who)
+        else:
+            action = None
+        return action
+
+    async def check_discard(self, who, from_who, is_next_player, tile_id, add_kan=False):
+        """
+        检查并响应别家打出的牌是否能和牌、吃、碰、明杠，返回一个可行的行为列表并选择，add_kan=True时只判断抢杠和牌
+
+        :return {
+            'type': 'agari' / 'chi' / 'pon' / 'kan' / 'pass'
+            'pattern': [int]
+        }
+        """
+        player = self.agents[who]
+        actions = [{'type': 'pass', 'who': who}]
+        can_agari = False
+        yaku = None
+        agari = None
+        if not player.furiten:
+            """判定和牌"""
+            if tile_id // 4 in player.machi:
+                if add_kan:
+                    tokusyu = 2
+                elif self.game.left_num == 0:
+                    tokusyu = 3
+                else:
+                    tokusyu = 0
+                yaku = Yaku(
+                    hand_tiles=player.tiles.union({tile_id}),
+                    furo=player.furo,
+                    agarihai=tile_id,
+                    dora=self.game.dora,
+                    ura_dora=self.game.ura_dora,
+                    bahai=self.game.round_wind,
+                    menfon=player.menfon,
+                    tsumo=False,
+                    riichi=player.riichi_status,
+                    ippatsu=player.ippatsu_status,
+                    tokusyu=tokusyu,
+                    aka=self.has_aka
+                )
+                agari = yaku.agari
+                if yaku.naive_check_yaku():
+                    actions.append({'type': 'agari', 'who': who, 'from_who': from_who, 'machi': tile_id})
+                    can_agari = True
+                else:
+                    if isinstance(agari, tuple):
+                        han, fu, score, ret = yaku.yaku(agari)
+                    else:
+                        if yaku.counter[yaku.agarihai] == 2:
+                            ret = [YakuList.KOKUSHIJUSANMEN]
+                            han = 2
+                        else:
+                            ret = [YakuList.KOKUSHIMUSO]
+                            han = 1
+                        fu = 25
+                        score = han * 8000
+                    if han > 0:
+                        actions.append(
+                            {'type': 'agari', 'who': who, 'from_who': from_who, 'yaku': ret, 'han': han, 'fu': fu,
+                             'score': score, 'machi': tile_id})
+                        can_agari = True
+                    else:
+                        player.round_furiten = True
+                        self.update('furiten', True, who)
+        if not add_kan:
+            """判断吃碰杠"""
+            if is_next_player:
+                can_chi, patterns = self.game.check_chi(who, tile_id)
+                for pattern in patterns:
+                    for furo in player.search_furo(0, pattern, tile_id):
+                        actions.append(
+                            {'type': 'chi', 'who': who, 'from_who': from_who, 'pattern': furo, 'kui': tile_id})
+            can_pon, pattern = self.game.check_pon(who, tile_id)
+            if can_pon:
+                for furo in player.search_furo(1, pattern, tile_id):
+                    actions.append({'type': 'pon', 'who': who, 'from_who': from_who, 'pattern': furo, 'kui': tile_id})
+            can_kan, pattern = self.game.check_kan(who, tile_id, mode=1)
+            if can_kan:
+                actions.append({'type': 'kan', 'who': who, 'from_who': from_who, 'pattern': pattern, 'kui': tile_id})
+        if len(actions) > 1:
+            action = await self.decide(who, actions, False)
+            if action['type'] == 'agari':
+                if 'yaku' not in action:
+                    if isinstance(agari, tuple):
+                        han, fu, score, ret = yaku.yaku(agari)
+                    else:
+                        if yaku.counter[yaku.agarihai] == 2:
+                            ret = [YakuList.KOKUSHIJUSANMEN]
+                            han = 2
+                        else:
+                            ret = [YakuList.KOKUSHIMUSO]
+                            han = 1
+                        fu = 25
+                        score = han * 8000
+                    action['yaku'] = ret
+                    action['han'] = han
+                    action['fu'] = fu
+                    action['score'] = score
+                action['yaku_list'] = yaku.parse_yaku_ret(action['yaku'], False)
+                action['hai'] = yaku.hand_tiles
+                action['furo'] = list(yaku.furo.values())
+            elif can_agari:  # 见逃
+                if player.riichi_status:
+                    player.riichi_furiten = True
+                player.round_furiten = True
+                self.update('furiten', True, who)
+        else:
+            action = None
+        return action
+
+    async def handle_draw(self, who, tile_id=None, where=0):
+        tile_id = self.game.draw(who=who, tile_id=tile_id, where=where)
+        self.send_seat(who, {'event': 'draw', 'who': who, 'tile_id': tile_id, 'where': where})
+        self.send_multiply({'event': 'draw', 'who': who, 'where': where}, exception=who, exception_ob=who)
+        self.update('left_num', self.game.left_num)
+        action = await self.check_draw(who, tile_id, where)
+        # if where == -1:
+        #     if action is None or action['type'] != 'agari':  # 如果没有杠上开花，需要翻新宝牌
+        #         self.game.new_dora()
+        #         self.update('dora_indicator', self.game.dora_indicator)
+        return tile_id, action
+
+    async def handle_discard(self, who, tile_id, mode, after_tsumo=True, is_riichi_tile=False):
+        """
+        who: 切牌者
+        tile_id: 切出的牌
+        mode: 是否为摸切
+        after_tsumo: 是否为摸牌以后的切牌（还可能是鸣牌之后的切牌）
+        is_riichi: 切出的是否为立直宣言牌
+        """
+        self.game.discard(who=who, tile_id=tile_id)
+        self.update('furiten', self.agents[who].furiten, who)
+        self.update('machi', list(sorted(self.agents[who].machi)), who)
+        self.send_multiply({'event': 'discard', 'who': who, 'tile_id': tile_id, 'mode': mode, 'after_tsumo': after_tsumo, 'is_riichi': is_riichi_tile}, exception=who)
+        agari_actions = []
+        pon_kan_action = None
+        chi_action = None
+        jobs = []
+        self.send_multiply({'event': 'wait', 'message': '等待他人响应...'})
+        for i in range(1, 4):
+            player_pos = (who + i) % 4
+            jobs.append(self.check_discard(player_pos, who, i == 1, tile_id))
+        actions = await self.gather(jobs)
+        for action in actions:
+            if isinstance(action, dict):
+                if action['type'] == 'agari':
+                    agari_actions.append(action)
+                elif action['type'] in ['pon', 'kan']:
+                    pon_kan_action = action
+                elif action['type'] == 'chi':
+                    chi_action = action
+        if agari_actions:
+            return agari_actions
+        if pon_kan_action:
+            return pon_kan_action
+        if chi_action:
+            return chi_action
+        await self.pause(0.4)
+
+    async def handle_tsumo_action(self, tile_id, action):
+        """玩家摸牌以后的行为"""
+        p = self.game.agents[self.current_player]
+        while action is not None:
+            if action['type'] == 'pass':
+                return tile_id, action
+            elif action['type'] == 'agari':
+                """处理和牌"""
+                return tile_id, action
+            elif action['type'] == 'riichi':
+                """处理立直宣言"""
+                logging.info(blue(f'「{self.player_name(self.current_player)}」「立直」!'))
+                p.declare_riichi = 1
+                return tile_id, action
+            elif action['type'] == 'ryuukyoku':
+                return tile_id, action
+            elif action['type'] == 'kan':
+                """处理杠"""
+                self.game.first_round = False  # 清除第一巡标记
+                for _ in self.agents:
+                    _.ippatsu_status = 0  # 清除所有玩家的一发标识
+
+                kan_type, pattern, add = action['pattern']
+                if kan_type == 0:
+                    kan_tile_list = p.search_furo(4, pattern, add)
+                    self.game.kan(self.current_player, kan_tile_list, from_who=self.current_player, mode=0)
+                    logging.info(blue(f"「{self.player_name(self.current_player)}」暗杠「{' '.join(TENHOU_TILE_STRING_DICT[_] for _ in kan_tile_list)}」"))
+                else:
+                    kan_tile_list = p.search_furo(2, pattern, add)
+                    agari_actions = []
+                    jobs = []
+                    self.send_multiply({'event': 'addkan', 'action': action})
+                    for i in range(1, 4):
+                        player_pos = (self.current_player + i) % 4
+                        jobs.append(self.check_discard(player_pos, self.current_player, i == 1, add, add_kan=True))
+                    actions = await self.gather(jobs)
+                    for act in actions:
+                        if act is None:
+                            continue
+                        if act['type'] == 'agari':
+                            agari_actions.append(act)
+                    if agari_actions:
+                        return tile_id, agari_actions
+                    self.game.kan(self.current_player, kan_tile_list, from_who=self.current_player, add=add, mode=2)
+                    logging.info(blue(f"「{self.player_name(self.current_player)}」加杠「{' '.join(TENHOU_TILE_STRING_DICT[_] for _ in kan_tile_list)}」"))
+                self.send_multiply({'event': 'kan', 'action': action})
+                self.game.new_dora()
+                self.update('dora_indicator', self.game.dora_indicator)
+                tile_id, action = await self.handle_draw(who=self.current_player, where=-1)
+        return tile_id, action
+
+    async def game_loop(self):
+        self.current_player = self.game.oya
+        p = self.agents[self.current_player]
+        tile_id, action = await self.handle_draw(who=self.current_player, where=0)
+        tile_id, res = await self.handle_tsumo_action(tile_id, action)
+        if res:  # 自摸和了或者加杠被人抢和
+            if isinstance(res, list):
+                if len(res) == 3:
+                    self.send_multiply({'event': 'ryuukyoku', 'why': 'ron3', 'action': res})  # 三家和
+                    return {'event': 'ryuukyoku', 'why': 'ron3', 'action': res}
+                self.send_multiply({'event': 'agari', 'action': res})
+                return res
+            event_type = res.get('type')
+            if event_type == 'agari':
+                self.send_multiply({'event': 'agari', 'action': [res]})
+                return [res]
+            if event_type == 'ryuukyoku':
+                self.send_multiply({'event': 'ryuukyoku', 'why': 'yao9', 'who': res.get('who'), 'hai': list(p.tiles)})
+                return res
+            if event_type != 'pass':
+                self.send_multiply({'event': event_type, 'action': res})
+        banned = []
+        after_tsumo = True
+        while 1:
+            is_riichi_tile = p.declare_riichi and p.riichi_tile == -1
+            """玩家选择一张牌"""
+            if not p.riichi_status:  # 没立直才能选牌
+                if p.declare_riichi:
+                    riichi_options = check_riichi(p.hand_tile_counter, return_riichi_hai=True)
+                    tile_id, mode = await self.select_tile(self.current_player, [_ for _ in p.tiles if _ // 4 in riichi_options],
+                                                           tsumo=tile_id, is_riichi_tile=is_riichi_tile)
+                else:
+                    tile_id, mode = await self.select_tile(self.current_player, "all", banned=banned, tsumo=tile_id, is_riichi_tile=is_riichi_tile)
+            else:
+                tile_id, mode = await self.select_tile(self.current_player, [tile_id], tsumo=tile_id,
+                                                       riichi=True, is_riichi_tile=is_riichi_tile)  # 立直时只能摸切，但还是发一个包过去并阻塞一会
+            if p.declare_riichi and p.riichi_tile == -1:  # 立直时设置横放牌
+                p.riichi_tile = tile_id
+            banned.clear()
+            actions = await self.handle_discard(self.current_player, tile_id=tile_id, mode=mode, after_tsumo=after_tsumo, is_riichi_tile=is_riichi_tile)  # pass时, actions=None
+            if not self.game_start:
+                return None
+            if isinstance(actions, list):  # 有人和了
+                if len(actions) == 3:
+                    self.send_multiply({'event': 'ryuukyoku', 'why': 'ron3', 'action': actions})  # 三家和
+                    return {'event': 'ryuukyoku', 'why': 'ron3', 'action': actions}
+                self.send_multiply({'event': 'agari', 'action': actions})
+                return actions
+
+            if self.game.first_round and p.menfon == 30 and 27 <= p.discard_tiles[0] // 4 <= 30:  # 第一巡四风连打判定
+                if all(_.discard_tiles and _.discard_tiles[0] // 4 == p.discard_tiles[0] // 4 for _ in self.agents):
+                    self.send_multiply({'event': 'ryuukyoku', 'why': 'kaze4'})
+                    return {'type': 'ryuukyoku', 'why': 'kaze4'}
+
+            if p.declare_riichi and not p.riichi_status:  # 没人和牌并且自己宣告立直的情况下，成功立个直
+                self.game.riichi(self.current_player, double_riichi=self.game.first_round)
+                self.send_multiply({'event': 'riichi', 'action': {'type': 'riichi', 'who': self.current_player, 'step': 2}})
+                if all(_.riichi_status for _ in self.agents):
+                    self.send_multiply({'event': 'ryuukyoku', 'why': 'reach4'})
+                    return {'type': 'ryuukyoku', 'why': 'reach4'}
+            if p.menfon == 30:
+                self.game.first_round = False
+            if actions is not None:  # 其他玩家的操作
+                p.river.pop()
+                if tile_id == p.riichi_tile:  # 立直宣言牌被鸣了，将其移除
+                    p.riichi_tile = -1
+                after_tsumo = False
+                p.nagashimangan = 0  # 清除被鸣牌玩家的流局满贯标识
+                self.game.first_round = False  # 清除第一巡标识
+                for _ in self.agents:
+                    _.ippatsu_status = 0  # 清除所有玩家的一发标识
+                player_id = actions['who']
+                self.current_player = player_id
+                p = self.agents[self.current_player]
+                ptn = actions['pattern']
+                if actions['type'] == 'chi':
+                    chi_ptn = min(ptn) // 4
+                    banned.append(tile_id // 4)
+                    if tile_id // 4 == chi_ptn and chi_ptn % 9 != 7:
+                        banned.append(chi_ptn + 3)
+                    elif tile_id // 4 == chi_ptn + 2 and chi_ptn % 9 != 0:
+                        banned.append(chi_ptn - 1)
+                    self.game.chi(player_id, ptn, kui_tile=tile_id, from_who=actions['from_who'])
+                    self.send_multiply({'event': actions['type'], 'action': actions})
+                    logging.info(blue(f"「{self.player_name(player_id)}」吃了「{' '.join(TENHOU_TILE_STRING_DICT[_] for _ in ptn)}」"))
+                elif actions['type'] == 'pon':
+                    banned.append(tile_id // 4)
+                    self.game.pon(player_id, ptn, kui_tile=tile_id, from_who=actions['from_who'])
+                    self.send_multiply({'event': actions['type'], 'action': actions})
+                    logging.info(blue(f"「{self.player_name(player_id)}」碰了「{' '.join(TENHOU_TILE_STRING_DICT[_] for _ in ptn)}」"))
+                elif actions['type'] == 'kan':
+                    ptn = [ptn[1] * 4 + i for i in range(4)]
+                    self.game.kan(player_id, ptn, mode=1, kui_tile=tile_id, from_who=actions['from_who'])
+                    self.send_multiply({'event': actions['type'], 'action': actions})
+                    self.game.new_dora()
+                    self.update('dora_indicator', self.game.dora_indicator)
+                    logging.info(blue(f"「{self.player_name(player_id)}」杠了「{' '.join(TENHOU_TILE_STRING_DICT[_] for _ in ptn)}」"))
+                    tile_id, action = await self.handle_draw(who=player_id, where=-1)
+                    tile_id, res = await self.handle_tsumo_action(tile_id, action)
+                    if res:  # 自摸和了或者加杠被人抢和
+                        if isinstance(res, list):
+                            if len(res) == 3:
+                                self.send_multiply({'event': 'ryuukyoku', 'why': 'ron3', 'action': res})  # 三家和
+                                return {'event': 'ryuukyoku', 'why': 'ron3', 'action': res}
+                            self.send_multiply({'event': 'agari', 'action': res})
+                            return res
+                        event_type = res.get('type')
+                        if event_type == 'agari':
+                            self.send_multiply({'event': 'agari', 'action': [res]})
+                            return [res]
+                        if event_type != 'pass':
+                            self.send_multiply({'event': event_type, 'action': res})
+                    after_tsumo = True
+                continue
+            else:
+                self.current_player = (self.current_player + 1) % 4
+                p = self.agents[self.current_player]
+
+            if sum(self.game.kang_num) == 4 and 4 not in self.game.kang_num:
+                self.send_multiply({'event': 'ryuukyoku', 'why': 'kan4'})
+                return {'type': 'ryuukyoku', 'why': 'kan4'}
+
+            if self.game.left_num == 0:
+                nagashimangan = [i for i in range(4) if self.agents[i].nagashimangan and all(
+                    _ % 9 == 0 or _ % 9 == 8 or 27 <= _ <= 33 for _ in self.agents[i].discard_tiles)]
+                machi_state = {i: [list(self.agents[i].tiles), list(self.agents[i].machi)] for i in range(4) if
+                               self.agents[i].machi}
+                self.send_multiply({'event': 'ryuukyoku', 'why': 'yama_end', 'nagashimangan': nagashimangan,
+                                    'machi_state': machi_state})
+                return {'type': 'ryuukyoku', 'why': 'yama_end', 'nagashimangan': nagashimangan,
+                        'machi_state': machi_state}
+
+            tile_id, action = await self.handle_draw(who=self.current_player, where=0)
+            tile_id, res = await self.handle_tsumo_action(tile_id, action)
+            if res:  # 自摸和了或者加杠被人抢和
+                if isinstance(res, list):
+                    if len(res) == 3:
+                        self.send_multiply({'event': 'ryuukyoku', 'why': 'ron3', 'action': res})  # 三家和
+                        return {'event': 'ryuukyoku', 'why': 'ron3', 'action': res}
+                    self.send_multiply({'event': 'agari', 'action': res})
+                    return res
+                event_type = res.get('type')
+                if event_type == 'agari':
+                    self.send_multiply({'event': 'agari', 'action': [res]})
+                    return [res]
+                if event_type == 'ryuukyoku':
+                    self.send_multiply({'event': 'ryuukyoku', 'why': 'yao9', 'who': res.get('who'), 'hai': list(p.tiles)})
+                    return res
+                if event_type != 'pass':
+                    self.send_multiply({'event': event_type, 'action': res})
+            p.ippatsu_status = 0  # 摸了牌没和，清除一发
+            after_tsumo = True
+
+
+def append_reward(items, reward):
+    for item in items:
+        item.append(reward)
+
+
+class AiPolicy(object):
+    """用AiAgent为四家做决策，选择方式与服务端的AI相同(没有思考时间)"""
+    def __init__(self, ai_agent=None):
+        self.ai_agent = ai_agent or AiAgent(max_delay=0)
+
+    def __call__(self, sim, request):
+        return self.batch([sim], [request])[0]
+
+    def batch(self, sims, requests):
+        """
+        多个对局的决策点一起推理：所有样本在调用者的线程中合成一个batch，每个模型只做一次前向
+        :param sims: 各Request所在的Simulator
+        :return: 各Request的决策结果
+        """
+        agent = self.ai_agent
+        has_discard_model = agent.model('discard')[0] is not None
+        answers = [None] * len(requests)
+        samples = []  # [(模型名, state, furo_feature), ...]
+        discards = []  # [(下标, tiles, state, 样本位置), ...]
+        decisions = []  # [(下标, action_score_dict, 候选行为, 各候选的(model, threshold), 样本起始位置), ...]
+        for k, (sim, request) in enumerate(zip(sims, requests)):
+            if request.kind == 'discard':
+                tiles = [_ for _ in request.options if _ // 4 not in request.banned] or request.options  # 手牌只剩食替的牌时只能打出
+                state = sim.game.get_feature(request.who)
+                if len(tiles) > 1 and has_discard_model:
+                    discards.append((k, tiles, state, len(samples)))
+                    samples.append(('discard', state, None))
+                else:  # 只有一张可选或者没有模型时不需要推理
+                    answers[k] = agent.discard(state, tiles)[0]
+                    sim.record_discard(request.who, state, answers[k])
+            else:
+                action_score_dict, candidates = agent.decision_requests(sim.game, request.who, request.options)
+                candidates = [(i, (name, state, furo_feature)) for i, name, state, furo_feature in candidates]
+                resolved, submitted = agent.resolve_decisions([candidate for _, candidate in candidates])
+                decisions.append((k, action_score_dict, candidates, resolved, len(samples)))
+                samples.extend(submitted)
+        outputs = agent.infer(samples) if samples else []
+        for k, tiles, state, start in discards:
+            answers[k] = agent.pick_discard(outputs[start], tiles)[0]
+            sims[k].record_discard(requests[k].who, state, answers[k])
+        for k, action_score_dict, candidates, resolved, start in decisions:
+            scores = agent.decision_scores([candidate for _, candidate in candidates], resolved, outputs[start:])
+            for (i, _), score in zip(candidates, scores):
+                action_score_dict[i] = score
+            answers[k] = agent.choose_action(requests[k].options, action_score_dict)
+        return answers
+
+
+class VectorEnv(object):
+    """
+    num_envs个对局同步推进：每一步收集所有进行中对局的决策点，交给policy.batch一起决策，
+    同一模型的样本合成一个(N, C, 34)的batch做一次前向，然后各对局推进到下一个决策点
+    """
+    def __init__(self, num_envs, policy=None, has_aka=True, min_score=0, train=False):
+        self.policy = policy or AiPolicy()
+        self.reward_evaluator = RewardEvaluator() if train else None  # 同一步中结算的各对局一起计算reward
+        self.envs = [Simulator(has_aka, min_score, train, self.reward_evaluator) for _ in range(num_envs)]
+        self.requests = [None] * num_envs  # 各对局当前的决策点，没有进行中的半庄时为None
+
+    def begin(self, i):
+        self.requests[i] = self.envs[i].begin()
+
+    def step(self):
+        """
+        所有进行中的对局各推进一个决策点
+        :return: 本步结束的对局[(下标, 最终排名, 局数), ...]，结束的对局需要begin(下标)才会开始新的半庄
+        """
+        active = [i for i, request in enumerate(self.requests) if request is not None]
+        answers = self.policy.batch([self.envs[i] for i in active], [self.requests[i] for i in active])
+        finished = []
+        for i, answer in zip(active, answers):
+            env = self.envs[i]
+            self.requests[i] = env.step(answer)
+            if self.requests[i] is None:
+                finished.append((i, env.ranks, env.num_rounds))
+        if self.reward_evaluator is not None:
+            self.reward_evaluator.flush()
+        return finished
+
+    def play(self, num_games):
+        """打完num_games个半庄，按完成顺序产生(最终排名, 局数)"""
+        started = 0
+        for i in range(min(num_games, len(self.envs))):
+            self.begin(i)
+            started += 1
+        while any(request is not None for request in self.requests):
+            for i, ranks, num_rounds in self.step():
+                yield ranks, num_rounds
+                if started < num_games:
+                    self.begin(i)
+                    started += 1
+
+
+def play_game(policy, sim=None):
+    """
+    :param policy: policy(sim, request) -> 决策结果，也可以是四家各自的policy组成的列表
+    :return: 最终排名[(座位, 分数), ...]
+    """
+    sim = sim or Simulator()
+    request = sim.begin()
+    while request is not None:
+        seat_policy = policy[request.who] if isinstance(policy, (list, tuple)) else policy
+        request = sim.step(seat_policy(sim, request))
+    return sim.ranks
+
+
+_worker = {}
+
+
+def init_worker(policy_factory, threads):
+    torch.set_num_threads(threads)
+    _worker['policy'] = policy_factory()
+    _worker['sim'] = Simulator()
+
+
+def play_one(_):
+    sim = _worker['sim']
+    ranks = play_game(_worker['policy'], sim)
+    return ranks, sim.num_rounds
+
+
+def play_vector(args):
+    num_games, num_envs = args
+    return list(VectorEnv(num_envs, _worker['policy']).play(num_games))
+
+
+def play_games(num_games, workers=None, policy_factory=AiPolicy, threads=1, num_envs=1):
+    """
+    在进程池中并行打num_games个半庄，每个进程创建一个policy并一直复用
+    :param policy_factory: 无参数的可pickle对象(例如类)，返回policy；num_envs大于1时policy需要有batch方法
+    :param threads: 每个进程的torch线程数
+    :param num_envs: 每个进程中用VectorEnv同步推进的对局数
+    :return: 产生(最终排名, 局数)
+    """
+    workers = workers or os.cpu_count()
+    with multiprocessing.Pool(workers, initializer=init_worker, initargs=(policy_factory, threads)) as pool:
+        if num_envs == 1:
+            yield from pool.imap_unordered(play_one, range(num_games))
+            return
+        shares = [num_games // workers + (i < num_games % workers) for i in range(workers)]
+        for results in pool.imap_unordered(play_vector, [(n, num_envs) for n in shares if n]):
+            yield from results
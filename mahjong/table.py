@@ -0,0 +1,88 @@
+"""
+只读查找表: 升序排列的键数组 + 打包的值数组，用mmap加载、二分查找
+多个进程加载同一个表时共享同一份物理内存，加载时不需要反序列化
+
+文件格式(小端):
+    表头16字节: 键个数n(uint64), 键类型(1字节), 值类型(1字节), 每个键对应的值个数w(uint16, 0表示不定长), 4字节填充
+    n个键, 升序
+    不定长时: n + 1个偏移(uint32), 第i个键的值为values[offsets[i]:offsets[i + 1]]
+    值数组, 定长时第i个键的值为values[i * w:(i + 1) * w]
+每一段都按8字节对齐
+"""
+
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+
+HEADER = struct.Struct('<QccH4x')
+
+
+def _pad(length):
+    return -length % 8
+
+
+class CompactTable(object):
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mmap)
+        n, key_fmt, value_fmt, width = HEADER.unpack_from(buf)
+        key_fmt, value_fmt = key_fmt.decode(), value_fmt.decode()
+        self.width = width
+        pos = HEADER.size
+        self.keys = buf[pos:pos + n * struct.calcsize(key_fmt)].cast(key_fmt)
+        pos += self.keys.nbytes + _pad(self.keys.nbytes)
+        if width:
+            self.offsets = None
+        else:
+            self.offsets = buf[pos:pos + (n + 1) * 4].cast('I')
+            pos += self.offsets.nbytes + _pad(self.offsets.nbytes)
+        self.values = buf[pos:].cast(value_fmt)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def index(self, key):
+        """返回键的下标，不存在时返回-1"""
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def __contains__(self, key):
+        return self.index(key) >= 0
+
+    def value(self, i):
+        if self.width:
+            return self.values[i * self.width:(i + 1) * self.width]
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def get(self, key, default=None):
+        """返回键对应的值(memoryview)，不存在时返回default"""
+        i = self.index(key)
+        if i < 0:
+            return default
+        return self.value(i)
+
+
+def save_table(path, table, key_fmt='Q', value_fmt='I', width=0):
+    """
+    :param table: {键: 值序列}
+    :param width: 每个键对应的值个数，0表示不定长
+    """
+    keys = array(key_fmt, sorted(table))
+    values = array(value_fmt)
+    offsets = array('I', [0])
+    for key in keys:
+        value = table[key]
+        if width:
+            assert len(value) == width
+        values.extend(value)
+        offsets.append(len(values))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(len(keys), key_fmt.encode(), value_fmt.encode(), width))
+        for section in [keys] if width else [keys, offsets]:
+            data = section.tobytes()
+            f.write(data + bytes(_pad(len(data))))
+        f.write(values.tobytes())
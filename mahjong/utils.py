@@ -1,16 +1,62 @@
-from typing import List, Iterable
-from copy import deepcopy, copy
-from collections import Counter
-
 YAKU_LIST = '門前清自摸和;立直;一發;槍槓;嶺上開花;海底摸月;河底撈魚;平和;斷么九;一盃口;自風 東;自風 南;自風 西;自風 北;場風 東;場風 南;場風 西;場風 北;役牌 白;役牌 發;役牌 中;兩立直;七對子;混全帶么九;一氣通貫;三色同順;三色同刻;三槓子;對對和;三暗刻;小三元;混老頭;二盃口;純全帶么九;混一色;清一色;人和;天和;地和;大三元;四暗刻;四暗刻單騎;字一色;綠一色;清老頭;九蓮寶燈;純正九蓮寶燈;國士無雙;國士無雙13面;大四喜;小四喜;四槓子;ドラ;裏ドラ;赤ドラ'.split(';')
 
 
-class AutoCleanCounter(Counter):
-    def __setitem__(self, key, value):
-        if value == 0:
-            del self[key]
-        else:
-            super(AutoCleanCounter, self).__setitem__(key, value)
+class TileCounter(bytearray):
+    """
+    定长34格的牌计数器，下标为牌的种类0-33，值为该种牌的张数
+    接口与Counter保持一致（items只返回张数不为0的项），可直接用作dict的键
+    """
+    __slots__ = ()
+
+    def __init__(self, tiles=()):
+        """tiles: 牌的种类(0-33)组成的可迭代对象"""
+        super(TileCounter, self).__init__(34)
+        for tile in tiles:
+            self[tile] += 1
+
+    @classmethod
+    def from_counts(cls, counts):
+        """由34个张数构造"""
+        counter = cls()
+        counter[:] = counts
+        return counter
+
+    def __copy__(self):
+        return self.from_counts(self)
+
+    def __deepcopy__(self, memo):
+        return self.from_counts(self)
+
+    def __reduce_ex__(self, protocol):
+        return self.from_counts, (bytes(self),)
+
+    def __hash__(self):
+        # 计数器是可变的，用作键时请先用bytes(counter)取快照
+        return hash(bytes(self))
+
+    def __repr__(self):
+        return f'TileCounter({dict(self.items())})'
+
+    __str__ = __repr__
+
+    def copy(self):
+        return self.from_counts(self)
+
+    def items(self):
+        return [(tile, c) for tile, c in enumerate(self) if c]
+
+    def keys(self):
+        return [tile for tile, c in enumerate(self) if c]
+
+    def values(self):
+        return [c for c in self if c]
+
+    def total(self):
+        return sum(self)
+
+    def update(self, tiles):
+        for tile in tiles:
+            self[tile] += 1
 
 
 def encode_shunzi(tile_id_list, kui_tile):
@@ -1,9 +1,9 @@
-from typing import List
-from collections import Counter
+from typing import List, Tuple
 
 import numpy as np
 
 from .check_agari import is_agari, parse_agari_info
+from .utils import TileCounter
 
 
 class YakuList:
@@ -69,7 +69,7 @@ class Yaku(object):
         """
         self.hand_tiles = list(hand_tiles)
         self.hand_tiles.sort()
-        self.counter = Counter([_ // 4 for _ in self.hand_tiles])
+        self.counter = TileCounter([_ // 4 for _ in self.hand_tiles])
         self.agari = is_agari(self.counter)
         self.furo = furo
         self.agarihai = agarihai // 4
@@ -105,7 +105,7 @@ class Yaku(object):
 
     def count_dora(self):
         total_tiles = self.hand_tiles + [_ for tiles in self.furo.values() for _ in tiles]
-        total_counter = Counter([_ // 4 for _ in total_tiles])
+        total_counter = TileCounter([_ // 4 for _ in total_tiles])
         for d in self.dora:
             self.dora_count += total_counter[d]
         if self.riichi:
@@ -119,18 +119,16 @@ class Yaku(object):
             return False
         if self.riichi or (self.tsumo and not self.kui) or self.tokusyu:
             return True
-        if isinstance(self.agari, str):
-            x_s = list(map(lambda _: int(_, 16), self.agari.split(',')))
-            for x in x_s:
+        if isinstance(self.agari, tuple):
+            for x in self.agari:
                 if x & 2080374784:
                     return True
             return False
         return True
 
     def calculate_yaku(self):
-        if isinstance(self.agari, str):
-            x = list(map(lambda _: int(_, 16), self.agari.split(',')))
-            han, fu, score, ret = self.yaku(x)
+        if isinstance(self.agari, tuple):
+            han, fu, score, ret = self.yaku(self.agari)
         elif self.agari:
             if self.counter[self.agarihai] == 2:
                 ret = [YakuList.KOKUSHIJUSANMEN]
@@ -144,7 +142,7 @@ class Yaku(object):
             return
         return self.parse_yaku_ret(ret, self.tsumo)
 
-    def yaku(self, xs: List[int]):
+    def yaku(self, xs: Tuple[int, ...]):
         self.count_dora()
         tiles_pos = [_[0] for _ in self.counter.items()]
         yakuman = []
@@ -168,22 +166,22 @@ class Yaku(object):
             num_pon = len(self.pon)
             info = parse_agari_info(x)
             mentsu = []
-            num_anko = info['num_kotsu']
-            num_shuntsu = info['num_shuntsu']
-            atama = info['atama']
+            num_anko = info.num_kotsu
+            num_shuntsu = info.num_shuntsu
+            atama = info.atama
             mentsu.append(tiles_pos[atama])
 
             num_kotsu = num_anko + num_pon + num_ankan + num_minkan
 
             for i in range(num_anko):  # 先把刻子放进去
-                mentsu.append(tiles_pos[info[f'm{i + 1}']])
+                mentsu.append(tiles_pos[info.mentsu[i]])
 
             mentsu.extend(self.pon)
             mentsu.extend(self.ankan)
             mentsu.extend(self.minkan)
 
             for i in range(num_shuntsu):  # 最后放顺子
-                mentsu.append(tiles_pos[info[f'm{num_anko + i + 1}']])
+                mentsu.append(tiles_pos[info.mentsu[num_anko + i]])
 
             mentsu.extend(self.chi)
             machi = 0
@@ -320,14 +318,14 @@ class Yaku(object):
                         ret |= YakuList.PINFU
                         han += 1
                         fu = 20 if self.tsumo else 30
-                    if info['ryanpeikou']:
+                    if info.ryanpeikou:
                         ret |= YakuList.RYANPEKO
                         han += 3
                 elif num_shuntsu + num_chi == 4:
                     if fu == 20:  # 副露平和形状的荣和补到30符
                         fu = 30
                 if num_shuntsu + num_chi >= 3:
-                    if info['ikki'] != 0:
+                    if info.ikki != 0:
                         ret |= YakuList.IKKITSUKAN
                         han += 2 - self.kui
                     else:
@@ -352,18 +350,18 @@ class Yaku(object):
                             if num_dojun >= 3:
                                 ret |= YakuList.SANSYOKUDOJUN
                                 han += 2 - self.kui
-                if info['cyuren']:
+                if info.cyuren:
                     if self.counter[self.agarihai] == 4 or self.counter[self.agarihai] == 2:
                         yakuman.append(YakuList.CHURENCHUMEN)  # 九莲九面听
                         han_yakuman += 2
                     else:
                         yakuman.append(YakuList.CHURENPOTO)  # 九莲宝灯
                         han_yakuman += 1
-                if info['ippeikou']:  # 一杯口
+                if info.ippeikou:  # 一杯口
                     ret |= YakuList.IPEKO
                     han += 1
             man = pin = sou = 0
-            if not info['chitoi']:
+            if not info.chitoi:
                 for i in range(num_shuntsu + num_chi):
                     if mentsu[4 - i] % 9 == 0 or mentsu[4 - i] % 9 == 6:
                         roto += 1
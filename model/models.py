@@ -1,5 +1,47 @@
+import math
 import torch
 from torch import nn
+from torch.nn import functional as F
+
+
+RIICHI_CHANNELS = (-8, -4)  # 四家的立直情况在局面特征中的通道(从末尾数起，之后是4个亲家通道)，见mahjong.game.FEATURE_LAYOUT
+
+
+def riichi_channels(shape):
+    """
+    (C, 34)的局面特征中四家立直情况的通道范围，这几个通道取值为0/1/2(两立直为2)，其他特征全部是0/1
+    鸣牌特征拼在局面特征前面，所以从末尾数起的位置不变
+    :return: (start, stop)，其他形状的特征为None
+    """
+    if len(shape) != 2:
+        return None
+    start = RIICHI_CHANNELS[0] % shape[0]
+    return start, start + RIICHI_CHANNELS[1] - RIICHI_CHANNELS[0]
+
+
+class Unpack(nn.Module):
+    """
+    把dataset.data.pack_features按位打包的uint8特征在设备上展开成float
+    输入(..., ceil((prod(shape) + 额外的bit数) / 8))，输出(..., *shape)
+    立直情况的通道多打包了一个bit(取值>=2的部分)，排在所有特征之后，展开时加回对应的通道
+    """
+    def __init__(self, shape):
+        super(Unpack, self).__init__()
+        self.shape = tuple(shape)
+        self.size = math.prod(self.shape)
+        self.start, self.stop = riichi_channels(self.shape) or (0, 0)
+        self.extra = (self.stop - self.start) * math.prod(self.shape[1:])
+        # 每个字节对应的8个bit(高位在前)，展开时直接查表
+        bits = (torch.arange(256).unsqueeze(-1) >> torch.arange(7, -1, -1)) & 1
+        self.register_buffer('table', bits.float(), persistent=False)
+
+    def forward(self, x):
+        bits = F.embedding(x.long(), self.table).flatten(-2)
+        out = bits[..., :self.size].reshape(list(x.shape[:-1]) + list(self.shape))  # 写成list相加以便TorchScript导出
+        if self.extra > 0:
+            high = bits[..., self.size:self.size + self.extra]
+            out[..., self.start:self.stop, :] += high.reshape(list(x.shape[:-1]) + [self.stop - self.start] + list(self.shape[1:]))
+        return out
 
 
 class ResBlock(nn.Module):
@@ -21,6 +63,7 @@ class ResBlock(nn.Module):
 class DiscardModel(nn.Module):
     def __init__(self, in_channels, num_layers=20):
         super(DiscardModel, self).__init__()
+        self.unpack = Unpack((in_channels, 34))  # 输入为打包的uint8特征时先展开
         self.in_conv = nn.Sequential(
             nn.Conv1d(in_channels, 256, kernel_size=3, padding='same'),
             nn.BatchNorm1d(256),
@@ -35,6 +78,8 @@ class DiscardModel(nn.Module):
         )
 
     def forward(self, x):
+        if x.dtype == torch.uint8:
+            x = self.unpack(x)
         x = self.in_conv(x)
         x = self.res_blocks(x)
         x = self.out_conv(x)
@@ -44,6 +89,7 @@ class DiscardModel(nn.Module):
 class RiichiModel(nn.Module):
     def __init__(self, in_channels, num_layers=20):
         super(RiichiModel, self).__init__()
+        self.unpack = Unpack((in_channels, 34))  # 输入为打包的uint8特征时先展开
         self.in_conv = nn.Sequential(
             nn.Conv1d(in_channels, 256, kernel_size=3, padding='same'),
             nn.BatchNorm1d(256),
@@ -70,6 +116,8 @@ class RiichiModel(nn.Module):
         )
 
     def forward(self, x):
+        if x.dtype == torch.uint8:
+            x = self.unpack(x)
         x = self.in_conv(x)
         x = self.res_blocks(x)
         x = self.out_conv(x)
@@ -80,6 +128,7 @@ class RiichiModel(nn.Module):
 class FuroModel(nn.Module):
     def __init__(self, in_channels, num_layers=20):
         super(FuroModel, self).__init__()
+        self.unpack = Unpack((in_channels, 34))  # 输入为打包的uint8特征时先展开
         self.in_conv = nn.Sequential(
             nn.Conv1d(in_channels, 256, kernel_size=3, padding='same'),
             nn.BatchNorm1d(256),
@@ -106,6 +155,8 @@ class FuroModel(nn.Module):
         )
 
     def forward(self, x):
+        if x.dtype == torch.uint8:
+            x = self.unpack(x)
         x = self.in_conv(x)
         x = self.res_blocks(x)
         x = self.out_conv(x)
@@ -125,4 +176,139 @@ class RewardPredictor(nn.Module):
 
     def forward(self, x):
         out, h_n = self.gru(x)
-        return self.fc(out[:, -1, :])
\ No newline at end of file
+        return self.fc(out[:, -1, :])
+
+    def step(self, x, h=None):
+        """
+        向后推进一局，结果与对整个序列调用forward相同
+        :param x: (B, input_dims)新一局的特征
+        :param h: (num_layers, B, hidden_dims)之前各局的隐状态，为None时表示这是第一局
+        :return: (新一局结束时的输出(B, 1), 新的隐状态)
+        """
+        out, h_n = self.gru(x[:, None, :], h)
+        return self.fc(out[:, -1, :]), h_n
+
+
+class DiscardHead(nn.Module):
+    def __init__(self):
+        super(DiscardHead, self).__init__()
+        self.out_conv = nn.Sequential(
+            nn.Conv1d(256, 1, kernel_size=1),
+            nn.BatchNorm1d(1)
+        )
+
+    def forward(self, x, extra=None):
+        return self.out_conv(x).squeeze(1)
+
+
+class DecisionHead(nn.Module):
+    """立直、鸣牌的二分类head，鸣牌的附加特征在这里才和主干输出拼接"""
+    def __init__(self, extra_channels=0, num_layers=2):
+        super(DecisionHead, self).__init__()
+        self.in_conv = nn.Sequential(
+            nn.Conv1d(256 + extra_channels, 256, kernel_size=3, padding='same'),
+            nn.BatchNorm1d(256),
+            nn.LeakyReLU(0.2)
+        )
+        self.res_blocks = nn.Sequential(
+            *(ResBlock() for _ in range(num_layers))
+        )
+        self.out_conv = nn.Sequential(
+            nn.Conv1d(256, 3, kernel_size=1),
+            nn.BatchNorm1d(3),
+            nn.LeakyReLU(0.2)
+        )
+        self.fc = nn.Sequential(
+            nn.Flatten(),
+            nn.Linear(3 * 34, 1024),
+            nn.BatchNorm1d(1024),
+            nn.LeakyReLU(0.2),
+            nn.Linear(1024, 256),
+            nn.BatchNorm1d(256),
+            nn.LeakyReLU(0.2),
+            nn.Linear(256, 1)
+        )
+
+    def forward(self, x, extra=None):
+        if extra is not None:
+            x = torch.cat([x, extra], dim=1)
+        x = self.in_conv(x)
+        x = self.res_blocks(x)
+        x = self.out_conv(x)
+        return self.fc(x)
+
+
+class MultiHeadModel(nn.Module):
+    """
+    弃牌、立直、吃、碰、杠共用一个主干，同一时刻的所有决策只需要算一次主干
+    鸣牌head的输入和FuroModel一致，为concatenate([furo_feature, state])，furo_feature在head里才加入
+    """
+    HEADS = ['discard', 'riichi', 'chi', 'pon', 'kan']
+    FURO_HEADS = ['chi', 'pon', 'kan']
+
+    def __init__(self, in_channels, furo_channels=22, num_layers=50, head_layers=2):
+        super(MultiHeadModel, self).__init__()
+        self.in_channels = in_channels
+        self.furo_channels = furo_channels
+        self.unpack = Unpack((in_channels, 34))
+        self.unpack_furo = Unpack((furo_channels + in_channels, 34))
+        self.in_conv = nn.Sequential(
+            nn.Conv1d(in_channels, 256, kernel_size=3, padding='same'),
+            nn.BatchNorm1d(256),
+            nn.LeakyReLU(0.2)
+        )
+        self.res_blocks = nn.Sequential(
+            *(ResBlock() for _ in range(num_layers))
+        )
+        self.heads = nn.ModuleDict({
+            'discard': DiscardHead(),
+            'riichi': DecisionHead(0, head_layers),
+            'chi': DecisionHead(furo_channels, head_layers),
+            'pon': DecisionHead(furo_channels, head_layers),
+            'kan': DecisionHead(furo_channels, head_layers)
+        })
+
+    def split(self, x, head):
+        """把输入拆成(state, furo_feature)，非鸣牌head的furo_feature为None"""
+        if head in self.FURO_HEADS:
+            if x.dtype == torch.uint8:
+                x = self.unpack_furo(x)
+            return x[:, self.furo_channels:], x[:, :self.furo_channels]
+        if x.dtype == torch.uint8:
+            x = self.unpack(x)
+        return x, None
+
+    def trunk(self, state):
+        return self.res_blocks(self.in_conv(state))
+
+    def forward(self, x, head='discard'):
+        state, furo = self.split(x, head)
+        return self.heads[head](self.trunk(state), furo)
+
+    def forward_heads(self, heads, states, extras):
+        """
+        不同head的样本拼在一起只算一次主干，同一个state对象(同一决策点的多个候选行为)只占主干的一行
+        :param heads: 每个样本对应的head名
+        :param states: 每个样本的state(不带batch维)
+        :param extras: 每个样本的furo_feature(不带batch维)，非鸣牌head为None
+        :return: 每个样本的输出
+        """
+        rows = {}  # id(state) -> 主干输出中的行号
+        unique = []
+        for state in states:
+            if id(state) not in rows:
+                rows[id(state)] = len(unique)
+                unique.append(state)
+        x = torch.stack(unique)
+        if x.dtype == torch.uint8:
+            x = self.unpack(x)
+        hidden = self.trunk(x)
+        groups = {}
+        for i, head in enumerate(heads):
+            groups.setdefault(head, []).append(i)
+        outputs = [None] * len(states)
+        for head, index in groups.items():
+            extra = torch.stack([extras[i] for i in index]) if head in self.FURO_HEADS else None
+            for i, output in zip(index, self.heads[head](hidden[[rows[id(states[i])] for i in index]], extra)):
+                outputs[i] = output
+        return outputs
@@ -10,6 +10,7 @@ import ast
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
 from mahjong.display import *
 from mahjong.yaku import Yaku
+from online_game.transport import LineReader
 
 
 class Mahjong(object):
@@ -17,6 +18,7 @@ class Mahjong(object):
     def __init__(self):
         super(Mahjong, self).__init__()
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.reader = None
         self.username = None
 
         self.seat = self.wind = None
@@ -389,6 +391,8 @@ class Mahjong(object):
             except KeyboardInterrupt:
                 self.send({'event': 'quit'})
                 break
+            except ConnectionError:
+                break
             except Exception as e:
                 self.send({'event': 'quit'})
                 tb = traceback.format_exc()
@@ -401,20 +405,16 @@ class Mahjong(object):
         self.client_socket.send(json.dumps(message).encode('utf-8') + b'\n')
 
     def recv(self):
-        buffer = []
-        while True:
-            data = self.client_socket.recv(1)
-            if len(data) == 0:
-                break
-            if data == b'\n':
-                break
-            buffer.append(data)
-        return json.loads(b''.join(buffer).decode('utf-8'))
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError('与服务器的连接已断开')
+        return json.loads(line)
 
-    def connect(self, host, port, username, observe):
+    def connect(self, host, port, username, observe, room=None):
         try:
             self.client_socket.connect((host, port))
-            self.send({'username': username, 'observe': observe})
+            self.reader = LineReader(self.client_socket)
+            self.send({'username': username, 'observe': observe, 'room': room})
             response = self.recv()
             if response['status'] != 0:
                 if response['status'] == -1:
@@ -437,6 +437,7 @@ if __name__ == '__main__':
     args.add_argument('--port', '-P', default=9999, type=int)
     args.add_argument('--username', '-U', default='', type=str)
     args.add_argument('--observe', '-ob', action='store_true', help='Observe mode')
+    args.add_argument('--room', '-R', default=None, type=str, help='Room id, match a room automatically if not given')
     args = args.parse_args()
     app = Mahjong()
-    app.connect(args.host, args.port, args.username, args.observe)
+    app.connect(args.host, args.port, args.username, args.observe, args.room)
@@ -5,32 +5,24 @@ import argparse
 import sys
 from typing import Union
 import random
-import numpy as np
 from collections import defaultdict, OrderedDict
 import json
-import threading
 import time
-from queue import Queue
 from uuid import uuid4
-import select
 
-import torch
-from quart.utils import run_sync
 import traceback
 import asyncio
 import logging
 
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
-from mahjong.game import MahjongGame
+from mahjong.simulator import Simulator
 from mahjong.agent import Agent, AiAgent
-from model.models import RewardPredictor
 from mahjong.utils import *
-from mahjong.yaku import Yaku, YakuList
-from mahjong.check_agari import *
 from mahjong.display import *
+from online_game.transport import MAX_FRAME_SIZE, MAX_WRITE_BUFFER, read_line, dumps, encode
 
 
-class ControlledQueue(Queue):
+class ControlledQueue(asyncio.Queue):
     def __init__(self, maxsize=0):
         super(ControlledQueue, self).__init__(maxsize)
         self._allow_put = True
@@ -38,134 +30,104 @@ class ControlledQueue(Queue):
     def allow_put(self):
         self._allow_put = True
 
-    def put(self, item, block: bool = ..., timeout=...) -> None:
+    def put_nowait(self, item) -> None:
         if self._allow_put:
             self._allow_put = False
-            super().put(item, block, timeout)
+            super().put_nowait(item)
 
 
 class Client(object):
     def __init__(self, client_socket, username):
-        if isinstance(client_socket, socket.SocketType):
-            client_socket.setblocking(False)
-        self.client_socket = client_socket
+        self.client_socket = client_socket  # 真人玩家为StreamWriter，AI为名字，断线后为'Disconnected'
+        self.reader = None  # 真人玩家的StreamReader
         self.username = username
         self.message_queue = ControlledQueue()
+        self.pending = []  # 本轮事件循环中待发送的消息
 
     def __eq__(self, username):
         return self.username == username
 
     def is_human(self):
-        return isinstance(self.client_socket, socket.SocketType)
+        return isinstance(self.client_socket, asyncio.StreamWriter)
 
     def is_ai(self):
         return not self.is_human() and self.client_socket != 'Disconnected'
 
     def send(self, msg):
+        """消息先攒起来，本轮事件循环结束时一次写出"""
         if self.is_human():
-            self.client_socket.send(msg)
+            self.pending.append(msg)
+            if len(self.pending) == 1:
+                asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if not self.is_human() or self.client_socket.is_closing():
+            return
+        self.client_socket.writelines(pending)
+        transport = self.client_socket.transport
+        if transport.get_write_buffer_size() > MAX_WRITE_BUFFER:  # 对端接收太慢，断开以免积压的数据占满内存
+            logging.info(f"{self.username} is too slow to receive, disconnected")
+            transport.abort()
 
     def close(self):
         if self.is_human():
+            self.flush()  # 先发出还没写出的消息
             self.client_socket.close()
 
-    def recv(self):
-        buffer = []
-        while True:
-            data = self.client_socket.recv(1)
-            if len(data) == 0:
-                break
-            if data == b'\n':
-                break
-            buffer.append(data)
-        return b''.join(buffer).decode('utf-8')
+    async def recv(self):
+        return await read_line(self.reader)
 
-    def fetch_message(self):
+    async def fetch_message(self):
         self.message_queue.allow_put()
-        return self.message_queue.get()
+        return await self.message_queue.get()
 
 
-class GameEnvironment(object):
+class GameEnvironment(Simulator):
+    """对局规则在Simulator中，这里把决策交给真人或AI，并把各事件发给客户端"""
 
-    def __init__(self, has_aka=True, AI_count=0, min_score=0, fast=False, allow_observe=True, train=False):
-        self.game = MahjongGame(has_aka, is_playback=False)
-        self.agents = self.game.agents
-        self.round = 0
-        self.honba = 0
-        self.riichi_ba = 0
-        self.has_aka = has_aka
+    def __init__(self, has_aka=True, AI_count=0, min_score=0, fast=False, allow_observe=True, train=False, ai_agent=None, room_id=None):
+        super().__init__(has_aka, min_score, train)
+        self.room_id = room_id
+        self.task = None  # 对局在事件循环中的task
 
         self.clients = []
         self.observe_info = defaultdict(list)  # {who: [observer_client]}
         self.observers = {}  # {username: (observe_who, observer_client)}
 
-        self.current_player = 0
-        self.game_start = False
         self.AI_count = AI_count
         if AI_count > 0:
-            self.ai_agent = AiAgent()
+            self.ai_agent = ai_agent or AiAgent()  # 多个牌桌共用一个AiAgent时推理请求会合并成batch
         else:
             self.ai_agent = None
-        self.min_score = min_score
         self.fast = fast
         self.allow_observe = allow_observe
-        self.train = train
-        if train:
-            self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-            params = torch.load('model/saved/reward-model/best.pt', map_location=self.device)
-            self.reward_model = RewardPredictor(74, params['hidden_dims'], params['num_layers'])
-            self.reward_model.load_state_dict(params['state_dict'])
-            self.reward_model.to(self.device)
-            self.collected_data = defaultdict(list)
-            self.reward_features = defaultdict(list)
         for i in range(AI_count):
             self.clients.append(Client(f'一姬{i + 1}(简单)', username=f'一姬{i + 1}(简单)'))
 
-    def reward(self, features, i):
-        """计算第i轮的reward"""
-        features = features.to(self.device)
-        if i == 0:
-            score0 = 250
-            score1 = self.reward_model(features[:, :1, :]).item() * 500
-        else:
-            score0 = self.reward_model(features[:, :i, :]).item() * 500
-            score1 = self.reward_model(features[:, :i + 1, :]).item() * 500
-        return score1 - score0
-
     def start(self):
         for conn in self.clients:
             if conn.is_human():
                 conn.message_queue = ControlledQueue()
-        self.game.new_game(self.round, self.honba, self.riichi_ba)
+        super().start()
 
     def reset(self):
         logging.info("Game is reset")
-        self.game = MahjongGame(self.has_aka, is_playback=False)
-        self.agents = self.game.agents
-        self.round = 0
-        self.honba = 0
-        self.riichi_ba = 0
-
+        super().reset()
         self.clients.clear()
         self.observe_info.clear()
         self.observers.clear()
-
-        self.current_player = 0
-        self.game_start = False
-        if self.train:
-            # self.collected_data.clear()
-            self.reward_features.clear()
         for i in range(self.AI_count):
             self.clients.append(Client(f'一姬{i + 1}(简单)', username=f'一姬{i + 1}(简单)'))
 
-    def update(self, key, value, client: Client = None):
-        if client is None:
+    def player_name(self, who):
+        return self.clients[who].username
+
+    def update(self, key, value, who=None):
+        if who is None:
             self.send_multiply({'event': 'update', 'key': key, 'value': value})
         else:
-            if client.is_human():
-                self.send_personal(client, {'event': 'update', 'key': key, 'value': value})
-            who = self.clients.index(client)
-            self.send_observers(who, {'event': 'update', 'key': key, 'value': value})
+            self.send_seat(who, {'event': 'update', 'key': key, 'value': value})
 
     def player_join(self, client_socket, username, observe):
         if observe:
@@ -215,7 +177,6 @@ class GameEnvironment(object):
                 #     return False, None
             if self.game_start and self.clients[idx].client_socket == 'Disconnected':
                 client = self.clients[idx]
-                client_socket.setblocking(False)
                 client.client_socket = client_socket
                 client.message_queue = ControlledQueue()
                 response = {'event': 'join', 'status': 1, 'message': '欢迎重新加入游戏！'}
@@ -272,12 +233,19 @@ class GameEnvironment(object):
             who, client = self.observers.pop(client.username)
             self.observe_info[who].remove(client)
 
-    def send_personal(self, client: Union[socket.SocketType, Client], message):
+    def send_personal(self, client: Union[asyncio.StreamWriter, Client], message):
+        """:param message: dict或已经编码好的bytes"""
         # logging.debug(yellow(f"Send {message}"))
-        message = json.dumps(message) + '\n'
-        client.send(message.encode('utf-8'))
+        if not isinstance(message, bytes):
+            message = encode(message)
+        if isinstance(client, asyncio.StreamWriter):  # 还没有加入房间的连接
+            client.write(message)
+        else:
+            client.send(message)
 
     def send_observers(self, who, message):
+        if not isinstance(message, bytes):
+            message = encode(message)
         observers = self.observe_info[who]
         for observer in list(observers):
             try:
@@ -285,9 +253,17 @@ class GameEnvironment(object):
             except Exception:
                 continue
 
+    def send_seat(self, who, message):
+        """发给座位上的玩家(真人时)和观战该座位的人，只序列化一次"""
+        message = encode(message)
+        client = self.clients[who]
+        if client.is_human():
+            self.send_personal(client, message)
+        self.send_observers(who, message)
+
     def send_multiply(self, message, exception=-1, exception_ob=-1):
         # logging.debug(yellow(f"Send multiply {message} except {exception}"))
-        message = json.dumps(message).encode('utf-8') + b'\n'
+        message = encode(message)
         for i, client in enumerate(self.clients):
             if i == exception or not client.is_human():
                 continue
@@ -300,256 +276,58 @@ class GameEnvironment(object):
             except Exception:
                 continue
 
-    def fetch_decision_message(self, client: Client, actions, after_tsumo):
+    async def fetch_decision_message(self, client: Client, actions, after_tsumo):
         if client.is_human():
-            message = client.fetch_message()
+            message = await client.fetch_message()
             logging.debug(yellow(f"fetch message from queue: {message}"))
             if 'action' in message:
                 return message['action']
         who = self.clients.index(client)
-        return self.decision_by_ai(who, actions, after_tsumo)
+        return await self.decision_by_ai(who, actions, after_tsumo)
 
-    def fetch_discard_message(self, who, client: Client, tiles, banned):
+    async def fetch_discard_message(self, who, client: Client, tiles, banned):
         if client.is_human():
-            message = client.fetch_message()
+            message = await client.fetch_message()
             logging.debug(yellow(f"fetch message from queue: {message}"))
             if 'tile_id' in message:
                 return message['tile_id']
         if tiles == 'all':
             tiles = list(self.agents[who].tiles)
-        return self.discard_by_ai(who, tiles, banned)
-
-    def decision_by_ai(self, who, actions, after_tsumo):
-        state = self.game.get_feature(who)
-        pon_action = None
-        chi_actions = {}
-        kan_actions = []
-        pon_feature = None
-        action_score_dict = {}
-
-        for i, action in enumerate(actions):
-            if action['type'] == 'agari':
-                if self.ai_agent.agari_decision(self.agents, action):
-                    action_score_dict[i] = 1
-            elif action['type'] == 'riichi':
-                score = self.ai_agent.riichi_decision(state)
-                logging.debug(yellow(f'「{self.clients[who].username}」「立直」行为意愿: {score:.3f}'))
+        return await self.discard_by_ai(who, tiles, banned)
+
+    async def think(self, started, delay):
+        """模拟AI的思考时间，从开始推理时算起，推理耗时计入其中；只挂起当前对局，不阻塞事件循环"""
+        await asyncio.sleep(max(0., started + delay - time.monotonic()))
+
+    async def decision_by_ai(self, who, actions, after_tsumo):
+        started = time.monotonic()
+        action_score_dict, requests = self.ai_agent.decision_requests(self.game, who, actions)
+        if requests:
+            scores = await self.ai_agent.decisions_async([request[1:] for request in requests])
+            names = {'riichi': '立直', 'pon': '碰', 'chi': '吃', 'kan': '杠'}
+            for (i, name, _, _), score in zip(requests, scores):
                 action_score_dict[i] = score
-            elif action['type'] == 'ryuukyoku':
-                if action['kyuuhai_type_count'] == 9:
-                    if self.agents[who].score >= 100:  # 只有9种9牌且分数没那么低时还是流了吧
-                        action_score_dict[i] = 1
-            elif action['type'] == 'pon':
-                pattern = action['pattern']
-                if pon_feature is None:
-                    pon_feature = self.game.get_pon_feature(who, pattern[0] // 4, action['kui'])
-                if pon_action is None:
-                    pon_action = i, pon_feature
-                else:  # 有多种碰的方法，则一定存在赤牌，方便起见，优先考虑将赤牌碰出去的操作
-                    if {16, 52, 88}.intersection(pattern):
-                        pon_action = i, pon_feature
-            elif action['type'] == 'chi':
-                pattern = action['pattern']
-                chi_ptn = min(pattern) // 4
-                chi_feature = chi_actions.get(chi_ptn, (i, self.game.get_chi_feature(who, chi_ptn, action['kui'])))[1]
-                if chi_ptn not in chi_actions:
-                    chi_actions[chi_ptn] = i, chi_feature
-                else:  # 同一种顺子pattern有多种吃的方法，则一定存在赤牌，方便起见，优先考虑将赤牌吃出去的操作
-                    if {16, 52, 88}.intersection(pattern):
-                        chi_actions[chi_ptn] = i, chi_feature
-            elif action['type'] == 'kan':
-                pattern = action['pattern']
-                kan_feature = self.game.get_kan_feature(who, pattern)
-                kan_actions.append((i, kan_feature))
-        if pon_action:
-            i, pon_feature = pon_action
-            pon_state = np.concatenate([pon_feature, state], axis=0)
-            action_score_dict[i] = score = self.ai_agent.pon_decision(pon_state)
-            logging.debug(yellow(f'「{self.clients[who].username}」「碰」行为意愿: {score:.3f}'))
-        if chi_actions:
-            for i, chi_feature in chi_actions.values():
-                chi_state = np.concatenate([chi_feature, state], axis=0)
-                action_score_dict[i] = score = self.ai_agent.chi_decision(chi_state)
-                logging.debug(yellow(f'「{self.clients[who].username}」「吃」行为意愿: {score:.3f}'))
-        if kan_actions:
-            for i, kan_feature in kan_actions:
-                kan_state = np.concatenate([kan_feature, state], axis=0)
-                action_score_dict[i] = score = self.ai_agent.kan_decision(kan_state)
-                logging.debug(yellow(f'「{self.clients[who].username}」「杠」行为意愿: {score:.3f}'))
-        if action_score_dict:
-            max_score_action, max_score = max(action_score_dict.items(), key=lambda x: x[1])
-            if max_score < 0.5:  # 行为意愿均低于阈值，选择pass
-                if not after_tsumo and not self.fast and random.random() < 0.7:
-                    time.sleep(1 + random.random() * 3)
-                return actions[0]
-            if not self.fast:
-                time.sleep(1 + random.random() * 3)
-            return actions[max_score_action]
-        return actions[0]
-
-    def discard_by_ai(self, who, tiles, banned):
-        if not self.fast:
-            time.sleep(1 + random.random() * 2)
+                logging.debug(yellow(f'「{self.clients[who].username}」「{names[name]}」行为意愿: {score:.3f}'))
+        if not action_score_dict:
+            return actions[0]
+        action = self.ai_agent.choose_action(actions, action_score_dict)
+        # 选择行动时思考一会儿，行为意愿均低于阈值而pass时，非自己回合大概率也思考一会儿
+        if not self.fast and (action is not actions[0] or not after_tsumo and random.random() < 0.7):
+            await self.think(started, 1 + random.random() * 3)
+        return action
+
+    async def discard_by_ai(self, who, tiles, banned):
+        started = time.monotonic()
         if banned:
-            tiles = [_ for _ in tiles if _ // 4 not in banned]
+            tiles = [_ for _ in tiles if _ // 4 not in banned] or tiles  # 手牌只剩食替的牌时只能打出
         state = self.game.get_feature(who)
-        discard, conf = self.ai_agent.discard(state, tiles)
+        discard, conf = await self.ai_agent.discard_async(state, tiles)
+        if not self.fast:
+            await self.think(started, 1 + random.random() * 2)
         logging.debug(yellow(f"「{self.clients[who].username}」以置信度:{conf:.3f} 切出「{TENHOU_TILE_STRING_DICT[discard]}」"))
-        if self.train:
-            self.collected_data[who].append([state, discard // 4])
+        self.record_discard(who, state, discard)
         return discard
 
-    def print_agari_info(self, who, from_who, action):
-        han = action['han']
-        fu = action['fu']
-        score = action['score']
-        ret = action['yaku']
-        yaku_list = action['yaku_list']
-        if who != from_who:
-            agari_info = f"「{self.clients[from_who].username}」放铳！「{self.clients[who].username}」荣和！役种: {'、'.join(yaku_list)}->"
-        else:
-            agari_info = f"「{self.clients[who].username}」自摸！役种: {'、'.join(yaku_list)}->"
-        if isinstance(ret, List):
-            if han >= 2:
-                agari_info += f'{han}倍役满！'
-            else:
-                agari_info += '役满！'
-        else:
-            agari_info += f'{han}番({fu}符)->基本点: {score}'
-        logging.info(cyan(agari_info))
-        self.agents[who].tiles.difference_update({action['machi']})
-        logging.info(cyan(self.agents[who].display_tiles('str') + '  ' + TENHOU_TILE_STRING_DICT[action['machi']]))
-        if self.agents[who].furo:
-            logging.info(cyan(self.agents[who].display_furo('str')))
-
-    def game_update(self, res):
-        change_oya = True
-        self.honba = honba = self.game.honba
-        self.riichi_ba = riichi_ba = self.game.riichi_ba
-        oya = self.game.oya
-        score_delta = [0, 0, 0, 0]
-        if isinstance(res, list):  # 和牌
-            first_winner = res[0]['who']
-            for action in res:
-                who = action['who']
-                from_who = action['from_who']
-                score = action['score']
-                if who == from_who:  # 自摸
-                    if who == oya:
-                        score = ((score * 2) + 90) // 100
-                        for i in range(4):
-                            if i != oya:
-                                self.agents[i].score -= score + honba
-                                score_delta[i] -= score + honba
-                        self.agents[who].score += score * 3 + honba * 3
-                        score_delta[who] += score * 3 + honba * 3
-                        change_oya = False
-                    else:
-                        score_oya = ((score * 2) + 90) // 100
-                        score = (score + 90) // 100
-                        for i in range(4):
-                            if i == who:
-                                self.agents[i].score += score_oya + score * 2 + honba * 3
-                                score_delta[i] += score_oya + score * 2 + honba * 3
-                            elif i == oya:
-                                self.agents[i].score -= score_oya + honba
-                                score_delta[i] -= score_oya + honba
-                            else:
-                                self.agents[i].score -= score + honba
-                                score_delta[i] -= score + honba
-                else:
-                    if who == oya:
-                        score = ((score * 6) + 90) // 100 + honba * 3
-                        change_oya = False
-                    else:
-                        score = ((score * 4) + 90) // 100 + honba * 3
-                    self.agents[from_who].score -= score
-                    self.agents[who].score += score
-                    score_delta[from_who] -= score
-                    score_delta[who] += score
-                self.print_agari_info(who, from_who, action)
-            if riichi_ba:
-                self.agents[first_winner].score += riichi_ba * 10
-                score_delta[first_winner] += riichi_ba * 10
-            self.riichi_ba = 0
-            if not change_oya:
-                self.honba += 1
-            else:
-                self.honba = 0
-        else:  # 流局
-            why = res['why']
-            if why == 'yama_end':  # 结算荒牌流局
-                logging.info(cyan('荒牌流局'))
-                nagashimangan = res['nagashimangan']
-                machi_state = res['machi_state']
-                for i in range(4):
-                    if i in machi_state:
-                        machi_tiles = machi_state[i][1]
-                        logging.info(cyan(f"「{self.clients[i].username}」听牌: {'、'.join(TILE_STRING_DICT[_] for _ in machi_tiles)}"))
-                change_oya = oya not in machi_state
-                if nagashimangan:  # 流满
-                    for i in nagashimangan:
-                        logging.info(cyan(f"「{self.clients[i].username}」流局满贯！"))
-                        for j in range(4):
-                            if j == i:
-                                if j == oya:
-                                    self.agents[j].score += 120
-                                    score_delta[j] += 120
-                                else:
-                                    self.agents[j].score += 80
-                                    score_delta[j] += 80
-                            else:
-                                if j == oya:
-                                    self.agents[j].score -= 40
-                                    score_delta[j] -= 40
-                                else:
-                                    self.agents[j].score -= 20
-                                    score_delta[j] -= 20
-                else:
-                    if 1 <= len(machi_state) < 4:
-                        score_get = 30 // len(machi_state)
-                        score_give = 30 // (4 - len(machi_state))
-                        for i in range(4):
-                            if i in machi_state:
-                                self.agents[i].score += score_get
-                                score_delta[i] += score_get
-                            else:
-                                self.agents[i].score -= score_give
-                                score_delta[i] -= score_give
-            else:
-                if why == 'yao9':
-                    who = res['who']
-                    logging.info(cyan(f'流局: 「{self.clients[who].username}」九种九牌'))
-                elif why == 'kaze4':
-                    logging.info(cyan(f'流局: 四风连打'))
-                elif why == 'kan4':
-                    logging.info(cyan(f'流局: 四杠散了'))
-                elif why == 'reach4':
-                    logging.info(cyan(f'流局: 四家立直'))
-                elif why == 'ron3':
-                    logging.info(cyan(f'流局: 三家和了'))
-                change_oya = False
-            self.honba += 1
-        if change_oya:
-            self.round += 1
-        if min(p.score for p in self.agents) * 100 < self.min_score:
-            return True, score_delta
-        if self.round > 11:
-            return True, score_delta
-        if self.round > 7 or (self.round == 7 and not change_oya):
-            if max(p.score for p in self.agents) < 300:
-                return False, score_delta
-            if change_oya:
-                if self.riichi_ba:
-                    winner = max(((i, p.score) for i, p in enumerate(self.agents)), key=lambda x: x[1])[0]
-                    self.agents[winner].score += self.riichi_ba * 10
-                    self.riichi_ba = 0
-                return True, score_delta
-            winner = self.game.get_rank()[0][0]
-            return winner == oya, score_delta
-        else:
-            return False, score_delta
-
     def get_game_info(self):
         return {
             'round': self.game.round,
@@ -589,748 +367,311 @@ class GameEnvironment(object):
     def send_player_score(self):
         self.send_multiply({'event': 'score', 'score': self.game.get_rank()})
 
-    @run_sync
-    def check_draw(self, who, tile_id, where):
-        """
-        检查并响应当前是否能和牌、立直、暗杠、加杠等，生成一个可行的行为列表并选择
-
-        :return {
-            'type': 'agari' / 'riichi' / 'kan' / 'pass' / 'ryuukyoku'
-            'who': who,
-            'from_who': who,
-            'pattern'
-        }
-        """
-        player = self.agents[who]
-        connection = self.clients[who]
-        actions = [{'type': 'pass'}]
-        can_agari = False
-        """判定和牌"""
-        agari = None
-        yaku = None
-        tenhou = False  # 天、地和
-        if tile_id // 4 in player.machi:
-            if where == -1:
-                tokusyu = 1
-            elif self.game.left_num == 0:
-                tokusyu = 3
-            else:
-                tokusyu = 0
-            yaku = Yaku(
-                hand_tiles=player.tiles,
-                furo=player.furo,
-                agarihai=tile_id,
-                dora=self.game.dora,
-                ura_dora=self.game.ura_dora,
-                bahai=self.game.round_wind,
-                menfon=player.menfon,
-                tsumo=True,
-                riichi=player.riichi_status,
-                ippatsu=player.ippatsu_status,
-                tokusyu=tokusyu,
-                aka=self.has_aka
-            )
-            agari = yaku.agari
-            if self.game.first_round:
-                tenhou = True
-                actions.append({'type': 'agari', 'who': who, 'from_who': who, 'machi': tile_id})
-                can_agari = True
-            elif yaku.naive_check_yaku():
-                actions.append({'type': 'agari', 'who': who, 'from_who': who, 'machi': tile_id})
-                can_agari = True
-            else:
-                if isinstance(agari, str):
-                    x = list(map(lambda _: int(_, 16), agari.split(',')))
-                    han, fu, score, ret = yaku.yaku(x)
-                else:
-                    if yaku.counter[yaku.agarihai] == 2:
-                        ret = [YakuList.KOKUSHIJUSANMEN]
-                        han = 2
-                    else:
-                        ret = [YakuList.KOKUSHIMUSO]
-                        han = 1
-                    fu = 25
-                    score = han * 8000
-                if han > 0:
-                    actions.append({'type': 'agari', 'who': who, 'from_who': who, 'yaku': ret, 'han': han, 'fu': fu,
-                                    'score': score, 'machi': tile_id})
-                    can_agari = True
-        """判定九种九牌"""
-        if self.game.first_round:
-            kyuuhai_type_count = len({_ // 4 for _ in player.tiles}.intersection([0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]))
-            if kyuuhai_type_count >= 9:
-                actions.append({'type': 'ryuukyoku', 'who': who, 'why': 'yao9', 'kyuuhai_type_count': kyuuhai_type_count})
-        """判定立直"""
-        can_riichi = self.game.can_declare_riichi(who)
-        if can_riichi:
-            actions.append({'type': 'riichi', 'who': who, 'step': 1, 'double_riichi': self.game.first_round})
-
-        """判定杠"""
-        can_ankan, ankan_patterns = self.game.check_kan(who, tile_id, mode=0)
-        can_addkan, addkan_pattern = self.game.check_kan(who, tile_id, mode=2)
-        if can_ankan or can_addkan:
-            for ptn in ankan_patterns + addkan_pattern:
-                actions.append({'type': 'kan', 'pattern': ptn, 'who': who, 'from_who': who})
-        if len(actions) > 1:
-            message = {'event': 'decision', 'actions': actions}
-            self.send_observers(who, message)
-            if connection.is_human():
-                self.send_personal(connection, message)
-                action = self.fetch_decision_message(connection, actions, True)
-            else:
-                action = self.decision_by_ai(who, actions, True)
-            if action['type'] == 'agari':
-                if 'yaku' not in action:
-                    if isinstance(agari, str):
-                        x = list(map(lambda _: int(_, 16), agari.split(',')))
-                        han, fu, score, ret = yaku.yaku(x)
-                    else:
-                        if yaku.counter[yaku.agarihai] == 2:
-                            ret = [YakuList.KOKUSHIJUSANMEN]
-                            han = 2
-                        else:
-                            ret = [YakuList.KOKUSHIMUSO]
-                            han = 1
-                        fu = 25
-                        score = han * 8000
-                    if tenhou:
-                        han += 1
-                        if isinstance(ret, list):
-                            if who == self.game.oya:
-                                tenhou = YakuList.TENHOU
-                                if YakuList.KOKUSHIMUSO in ret:
-                                    ret.remove(YakuList.KOKUSHIMUSO)
-                                    ret.append(YakuList.KOKUSHIJUSANMEN)
-                                    han += 1
-                                elif YakuList.CHURENPOTO in ret:
-                                    ret.remove(YakuList.CHURENPOTO)
-                                    ret.append(YakuList.CHURENCHUMEN)
-                                    han += 1
-                                elif YakuList.SUANKO in ret:
-                                    ret.remove(YakuList.SUANKO)
-                                    ret.append(YakuList.SUANKOTANKI)
-                                    han += 1
-                            else:
-                                tenhou = YakuList.CHIHOU
-                            ret.append(tenhou)
-                            score += 8000
-                        else:
-                            ret = [YakuList.TENHOU if who == self.game.oya else YakuList.CHIHOU]
-                            han = 1
-                            score = 8000
-                    action['yaku'] = ret
-                    action['han'] = han
-                    action['fu'] = fu
-                    action['score'] = score
-                action['yaku_list'] = yaku.parse_yaku_ret(action['yaku'], True)
-                action['hai'] = yaku.hand_tiles
-                action['furo'] = list(yaku.furo.values())
-            elif can_agari:  # 见逃
-                if player.riichi_status:
-                    player.riichi_furiten = True
-                    self.update('furiten', True, connection)
-        else:
-            action = None
-        return action
-
-    @run_sync
-    def check_discard(self, who, from_who, is_next_player, tile_id, add_kan=False):
-        """
-        检查并响应别家打出的牌是否能和牌、吃、碰、明杠，返回一个可行的行为列表并选择，add_kan=True时只判断抢杠和牌
-
-        :return {
-            'type': 'agari' / 'chi' / 'pon' / 'kan' / 'pass'
-            'pattern': [int]
-        }
-        """
-        player = self.agents[who]
-        connection = self.clients[who]
-        actions = [{'type': 'pass', 'who': who}]
-        can_agari = False
-        yaku = None
-        agari = None
-        if not player.furiten:
-            """判定和牌"""
-            if tile_id // 4 in player.machi:
-                if add_kan:
-                    tokusyu = 2
-                elif self.game.left_num == 0:
-                    tokusyu = 3
-                else:
-                    tokusyu = 0
-                yaku = Yaku(
-                    hand_tiles=player.tiles.union({tile_id}),
-                    furo=player.furo,
-                    agarihai=tile_id,
-                    dora=self.game.dora,
-                    ura_dora=self.game.ura_dora,
-                    bahai=self.game.round_wind,
-                    menfon=player.menfon,
-                    tsumo=False,
-                    riichi=player.riichi_status,
-                    ippatsu=player.ippatsu_status,
-                    tokusyu=tokusyu,
-                    aka=self.has_aka
-                )
-                agari = yaku.agari
-                if yaku.naive_check_yaku():
-                    actions.append({'type': 'agari', 'who': who, 'from_who': from_who, 'machi': tile_id})
-                    can_agari = True
-                else:
-                    if isinstance(agari, str):
-                        x = list(map(lambda _: int(_, 16), agari.split(',')))
-                        han, fu, score, ret = yaku.yaku(x)
-                    else:
-                        if yaku.counter[yaku.agarihai] == 2:
-                            ret = [YakuList.KOKUSHIJUSANMEN]
-                            han = 2
-                        else:
-                            ret = [YakuList.KOKUSHIMUSO]
-                            han = 1
-                        fu = 25
-                        score = han * 8000
-                    if han > 0:
-                        actions.append(
-                            {'type': 'agari', 'who': who, 'from_who': from_who, 'yaku': ret, 'han': han, 'fu': fu,
-                             'score': score, 'machi': tile_id})
-                        can_agari = True
-                    else:
-                        player.round_furiten = True
-                        self.update('furiten', True, connection)
-        if not add_kan:
-            """判断吃碰杠"""
-            if is_next_player:
-                can_chi, patterns = self.game.check_chi(who, tile_id)
-                for pattern in patterns:
-                    for furo in player.search_furo(0, pattern, tile_id):
-                        actions.append(
-                            {'type': 'chi', 'who': who, 'from_who': from_who, 'pattern': furo, 'kui': tile_id})
-            can_pon, pattern = self.game.check_pon(who, tile_id)
-            if can_pon:
-                for furo in player.search_furo(1, pattern, tile_id):
-                    actions.append({'type': 'pon', 'who': who, 'from_who': from_who, 'pattern': furo, 'kui': tile_id})
-            can_kan, pattern = self.game.check_kan(who, tile_id, mode=1)
-            if can_kan:
-                actions.append({'type': 'kan', 'who': who, 'from_who': from_who, 'pattern': pattern, 'kui': tile_id})
-        if len(actions) > 1:
-            message = {'event': 'decision', 'actions': actions}
-            self.send_observers(who, message)
-            if connection.is_human():
-                self.send_personal(connection, message)
-                action = self.fetch_decision_message(connection, actions, False)
-            else:
-                action = self.decision_by_ai(who, actions, False)
-            if action['type'] == 'agari':
-                if 'yaku' not in action:
-                    if isinstance(agari, str):
-                        x = list(map(lambda _: int(_, 16), agari.split(',')))
-                        han, fu, score, ret = yaku.yaku(x)
-                    else:
-                        if yaku.counter[yaku.agarihai] == 2:
-                            ret = [YakuList.KOKUSHIJUSANMEN]
-                            han = 2
-                        else:
-                            ret = [YakuList.KOKUSHIMUSO]
-                            han = 1
-                        fu = 25
-                        score = han * 8000
-                    action['yaku'] = ret
-                    action['han'] = han
-                    action['fu'] = fu
-                    action['score'] = score
-                action['yaku_list'] = yaku.parse_yaku_ret(action['yaku'], False)
-                action['hai'] = yaku.hand_tiles
-                action['furo'] = list(yaku.furo.values())
-            elif can_agari:  # 见逃
-                if player.riichi_status:
-                    player.riichi_furiten = True
-                player.round_furiten = True
-                self.update('furiten', True, connection)
-        else:
-            action = None
-        return action
-
-    async def handle_draw(self, who, tile_id=None, where=0):
-        tile_id = self.game.draw(who=who, tile_id=tile_id, where=where)
-        connection = self.clients[who]
-
-        message = {'event': 'draw', 'who': who, 'tile_id': tile_id, 'where': where}
-        if connection.is_human():
-            self.send_personal(connection, message)
-        self.send_observers(who, message)
-        self.send_multiply({'event': 'draw', 'who': who, 'where': where}, exception=who, exception_ob=who)
-        self.update('left_num', self.game.left_num)
-        action = await self.check_draw(who, tile_id, where)
-        # if where == -1:
-        #     if action is None or action['type'] != 'agari':  # 如果没有杠上开花，需要翻新宝牌
-        #         self.game.new_dora()
-        #         self.update('dora_indicator', self.game.dora_indicator)
-        return tile_id, action
-
     async def random_delay(self):
         if not self.fast and random.random() < 0.1:
             await asyncio.sleep(1 + random.random() * 3)
         return {'type': 'pass'}
 
-    async def handle_discard(self, who, tile_id, mode, after_tsumo=True, is_riichi_tile=False):
-        """
-        who: 切牌者
-        tile_id: 切出的牌
-        mode: 是否为摸切
-        after_tsumo: 是否为摸牌以后的切牌（还可能是鸣牌之后的切牌）
-        is_riichi: 切出的是否为立直宣言牌
-        """
-        self.game.discard(who=who, tile_id=tile_id)
-        connection = self.clients[who]
-        self.update('furiten', self.agents[who].furiten, connection)
-        self.update('machi', list(sorted(self.agents[who].machi)), connection)
-        self.send_multiply({'event': 'discard', 'who': who, 'tile_id': tile_id, 'mode': mode, 'after_tsumo': after_tsumo, 'is_riichi': is_riichi_tile}, exception=who)
-        agari_actions = []
-        pon_kan_action = None
-        chi_action = None
-        jobs = []
-        self.send_multiply({'event': 'wait', 'message': '等待他人响应...'})
-        for i in range(1, 4):
-            player_pos = (who + i) % 4
-            jobs.append(self.check_discard(player_pos, who, i == 1, tile_id))
-        jobs.append(self.random_delay())
-        actions = await asyncio.gather(*jobs)
-        for action in actions:
-            if isinstance(action, dict):
-                if action['type'] == 'agari':
-                    agari_actions.append(action)
-                elif action['type'] in ['pon', 'kan']:
-                    pon_kan_action = action
-                elif action['type'] == 'chi':
-                    chi_action = action
-        if agari_actions:
-            return agari_actions
-        if pon_kan_action:
-            return pon_kan_action
-        if chi_action:
-            return chi_action
+    async def decide(self, who, actions, after_tsumo):
+        self.send_seat(who, {'event': 'decision', 'actions': actions})
+        client = self.clients[who]
+        if client.is_human():
+            return await self.fetch_decision_message(client, actions, after_tsumo)
+        return await self.decision_by_ai(who, actions, after_tsumo)
+
+    async def gather(self, jobs):
+        """其他三家同时考虑，所有人都pass时也随机等待一会儿，不暴露是否有人可以鸣牌"""
+        actions = await asyncio.gather(*jobs, self.random_delay())
+        return actions[:-1]
+
+    async def pause(self, seconds):
         if not self.fast:
-            await asyncio.sleep(0.4)
-
-    async def handle_tsumo_action(self, tile_id, action):
-        """玩家摸牌以后的行为"""
-        p = self.game.agents[self.current_player]
-        while action is not None:
-            if action['type'] == 'pass':
-                return tile_id, action
-            elif action['type'] == 'agari':
-                """处理和牌"""
-                return tile_id, action
-            elif action['type'] == 'riichi':
-                """处理立直宣言"""
-                logging.info(blue(f'「{self.clients[self.current_player].username}」「立直」!'))
-                p.declare_riichi = 1
-                return tile_id, action
-            elif action['type'] == 'ryuukyoku':
-                return tile_id, action
-            elif action['type'] == 'kan':
-                """处理杠"""
-                self.game.first_round = False  # 清除第一巡标记
-                for _ in self.agents:
-                    _.ippatsu_status = 0  # 清除所有玩家的一发标识
-
-                kan_type, pattern, add = action['pattern']
-                if kan_type == 0:
-                    kan_tile_list = p.search_furo(4, pattern, add)
-                    self.game.kan(self.current_player, kan_tile_list, from_who=self.current_player, mode=0)
-                    logging.info(blue(f"「{self.clients[self.current_player].username}」暗杠「{' '.join(TENHOU_TILE_STRING_DICT[_] for _ in kan_tile_list)}」"))
-                else:
-                    kan_tile_list = p.search_furo(2, pattern, add)
-                    agari_actions = []
-                    jobs = []
-                    self.send_multiply({'event': 'addkan', 'action': action})
-                    for i in range(1, 4):
-                        player_pos = (self.current_player + i) % 4
-                        jobs.append(self.check_discard(player_pos, self.current_player, i == 1, add, add_kan=True))
-                    jobs.append(self.random_delay())
-                    actions = await asyncio.gather(*jobs)
-                    for act in actions:
-                        if act is None:
-                            continue
-                        if act['type'] == 'agari':
-                            agari_actions.append(act)
-                    if agari_actions:
-                        return tile_id, agari_actions
-                    self.game.kan(self.current_player, kan_tile_list, from_who=self.current_player, add=add, mode=2)
-                    logging.info(blue(f"「{self.clients[self.current_player].username}」加杠「{' '.join(TENHOU_TILE_STRING_DICT[_] for _ in kan_tile_list)}」"))
-                self.send_multiply({'event': 'kan', 'action': action})
-                self.game.new_dora()
-                self.update('dora_indicator', self.game.dora_indicator)
-                tile_id, action = await self.handle_draw(who=self.current_player, where=-1)
-        return tile_id, action
-
-    def select_tile(self, client, tiles, banned=None, tsumo=None, riichi=False, is_riichi_tile=False):
+            await asyncio.sleep(seconds)
+
+    async def select_tile(self, who, tiles, banned=None, tsumo=None, riichi=False, is_riichi_tile=False):
         banned = banned or []
-        who = self.clients.index(client)
+        client = self.clients[who]
 
-        message = {'event': 'select_tile', 'tiles': tiles, 'banned': banned, 'tsumo': tsumo, 'riichi': riichi, 'is_riichi_tile': is_riichi_tile}
-        self.send_observers(who, message)
+        self.send_seat(who, {'event': 'select_tile', 'tiles': tiles, 'banned': banned, 'tsumo': tsumo, 'riichi': riichi, 'is_riichi_tile': is_riichi_tile})
         if client.is_human():
-            self.send_personal(client, message)
-            tile_id = self.fetch_discard_message(who, client, tiles, banned)
+            tile_id = await self.fetch_discard_message(who, client, tiles, banned)
         else:
             if tiles == 'all':
                 tiles = list(self.agents[who].tiles)
-            tile_id = self.discard_by_ai(who, tiles, banned)
+            tile_id = await self.discard_by_ai(who, tiles, banned)
         mode = tile_id == tsumo  # 是否为摸切。如果banned为空，则tsumo为自摸的牌，否则tsumo为被鸣的牌，则必定不是摸切
         return tile_id, mode
 
+    def start_message(self, game_info, who):
+        """
+        start消息 = 四家共用的game_info + 该座位的player_info
+        game_info传入序列化好的bytes，各座位只需要序列化自己的部分
+        """
+        return b'{"event":"start","game":' + game_info + b',"self":' + dumps(self.get_player_info(who)) + b'}\n'
+
     def send_all_game_info(self, client: Client = None):
-        game_info = self.get_game_info()
+        game_info = dumps(self.get_game_info())
         if client is None:
             for i in range(4):
-                player_info = self.get_player_info(i)
-                client = self.clients[i]
-                if client.is_human():
-                    self.send_personal(client, {'event': 'start', 'game': game_info, 'self': player_info})
-                for observer in self.observe_info[i]:
-                    self.send_personal(observer, {'event': 'start', 'game': game_info, 'self': player_info})
+                message = self.start_message(game_info, i)
+                if self.clients[i].is_human():
+                    self.send_personal(self.clients[i], message)
+                self.send_observers(i, message)
         elif client in self.clients:
             who = self.clients.index(client)
-            player_info = self.get_player_info(who)
-            self.send_personal(client, {'event': 'start', 'game': game_info, 'self': player_info})
+            self.send_personal(client, self.start_message(game_info, who))
         elif client.username in self.observers:
             who, client = self.observers[client.username]
-            player_info = self.get_player_info(who)
             try:
-                self.send_personal(client, {'event': 'start', 'game': game_info, 'self': player_info})
+                self.send_personal(client, self.start_message(game_info, who))
             except Exception:
                 pass
 
-    async def game_loop(self):
-        self.current_player = self.game.oya
-        p = self.agents[self.current_player]
-        connection = self.clients[self.current_player]
-        tile_id, action = await self.handle_draw(who=self.current_player, where=0)
-        tile_id, res = await self.handle_tsumo_action(tile_id, action)
-        if res:  # 自摸和了或者加杠被人抢和
-            if isinstance(res, list):
-                if len(res) == 3:
-                    self.send_multiply({'event': 'ryuukyoku', 'why': 'ron3', 'action': res})  # 三家和
-                    return {'event': 'ryuukyoku', 'why': 'ron3', 'action': res}
-                self.send_multiply({'event': 'agari', 'action': res})
-                return res
-            event_type = res.get('type')
-            if event_type == 'agari':
-                self.send_multiply({'event': 'agari', 'action': [res]})
-                return [res]
-            if event_type == 'ryuukyoku':
-                self.send_multiply({'event': 'ryuukyoku', 'why': 'yao9', 'who': res.get('who'), 'hai': list(p.tiles)})
-                return res
-            if event_type != 'pass':
-                self.send_multiply({'event': event_type, 'action': res})
-        banned = []
-        after_tsumo = True
-        while 1:
-            is_riichi_tile = p.declare_riichi and p.riichi_tile == -1
-            """玩家选择一张牌"""
-            if not p.riichi_status:  # 没立直才能选牌
-                if p.declare_riichi:
-                    riichi_options = check_riichi(p.hand_tile_counter, return_riichi_hai=True)
-                    tile_id, mode = self.select_tile(connection, [_ for _ in p.tiles if _ // 4 in riichi_options],
-                                                     tsumo=tile_id, is_riichi_tile=is_riichi_tile)
-                else:
-                    tile_id, mode = self.select_tile(connection, "all", banned=banned, tsumo=tile_id, is_riichi_tile=is_riichi_tile)
-            else:
-                tile_id, mode = self.select_tile(connection, [tile_id], tsumo=tile_id,
-                                                 riichi=True, is_riichi_tile=is_riichi_tile)  # 立直时只能摸切，但还是发一个包过去并阻塞一会
-            if p.declare_riichi and p.riichi_tile == -1:  # 立直时设置横放牌
-                p.riichi_tile = tile_id
-            banned.clear()
-            actions = await self.handle_discard(self.current_player, tile_id=tile_id, mode=mode, after_tsumo=after_tsumo, is_riichi_tile=is_riichi_tile)  # pass时, actions=None
-            if not self.game_start:
-                return None
-            if isinstance(actions, list):  # 有人和了
-                if len(actions) == 3:
-                    self.send_multiply({'event': 'ryuukyoku', 'why': 'ron3', 'action': actions})  # 三家和
-                    return {'event': 'ryuukyoku', 'why': 'ron3', 'action': actions}
-                self.send_multiply({'event': 'agari', 'action': actions})
-                return actions
-
-            if self.game.first_round and p.menfon == 30 and 27 <= p.discard_tiles[0] // 4 <= 30:  # 第一巡四风连打判定
-                if all(_.discard_tiles and _.discard_tiles[0] // 4 == p.discard_tiles[0] // 4 for _ in self.agents):
-                    self.send_multiply({'event': 'ryuukyoku', 'why': 'kaze4'})
-                    return {'type': 'ryuukyoku', 'why': 'kaze4'}
-
-            if p.declare_riichi and not p.riichi_status:  # 没人和牌并且自己宣告立直的情况下，成功立个直
-                self.game.riichi(self.current_player, double_riichi=self.game.first_round)
-                self.send_multiply({'event': 'riichi', 'action': {'type': 'riichi', 'who': self.current_player, 'step': 2}})
-                if all(_.riichi_status for _ in self.agents):
-                    self.send_multiply({'event': 'ryuukyoku', 'why': 'reach4'})
-                    return {'type': 'ryuukyoku', 'why': 'reach4'}
-            if p.menfon == 30:
-                self.game.first_round = False
-            if actions is not None:  # 其他玩家的操作
-                p.river.pop()
-                if tile_id == p.riichi_tile:  # 立直宣言牌被鸣了，将其移除
-                    p.riichi_tile = -1
-                after_tsumo = False
-                p.nagashimangan = 0  # 清除被鸣牌玩家的流局满贯标识
-                self.game.first_round = False  # 清除第一巡标识
-                for _ in self.agents:
-                    _.ippatsu_status = 0  # 清除所有玩家的一发标识
-                player_id = actions['who']
-                self.current_player = player_id
-                p = self.agents[self.current_player]
-                connection = self.clients[self.current_player]
-                ptn = actions['pattern']
-                if actions['type'] == 'chi':
-                    chi_ptn = min(ptn) // 4
-                    banned.append(tile_id // 4)
-                    if tile_id // 4 == chi_ptn and chi_ptn % 9 != 7:
-                        banned.append(chi_ptn + 3)
-                    elif tile_id // 4 == chi_ptn + 2 and chi_ptn % 9 != 0:
-                        banned.append(chi_ptn - 1)
-                    self.game.chi(player_id, ptn, kui_tile=tile_id, from_who=actions['from_who'])
-                    self.send_multiply({'event': actions['type'], 'action': actions})
-                    logging.info(blue(f"「{self.clients[player_id].username}」吃了「{' '.join(TENHOU_TILE_STRING_DICT[_] for _ in ptn)}」"))
-                elif actions['type'] == 'pon':
-                    banned.append(tile_id // 4)
-                    self.game.pon(player_id, ptn, kui_tile=tile_id, from_who=actions['from_who'])
-                    self.send_multiply({'event': actions['type'], 'action': actions})
-                    logging.info(blue(f"「{self.clients[player_id].username}」碰了「{' '.join(TENHOU_TILE_STRING_DICT[_] for _ in ptn)}」"))
-                elif actions['type'] == 'kan':
-                    ptn = [ptn[1] * 4 + i for i in range(4)]
-                    self.game.kan(player_id, ptn, mode=1, kui_tile=tile_id, from_who=actions['from_who'])
-                    self.send_multiply({'event': actions['type'], 'action': actions})
-                    self.game.new_dora()
-                    self.update('dora_indicator', self.game.dora_indicator)
-                    logging.info(blue(f"「{self.clients[player_id].username}」杠了「{' '.join(TENHOU_TILE_STRING_DICT[_] for _ in ptn)}」"))
-                    tile_id, action = await self.handle_draw(who=player_id, where=-1)
-                    tile_id, res = await self.handle_tsumo_action(tile_id, action)
-                    if res:  # 自摸和了或者加杠被人抢和
-                        if isinstance(res, list):
-                            if len(res) == 3:
-                                self.send_multiply({'event': 'ryuukyoku', 'why': 'ron3', 'action': res})  # 三家和
-                                return {'event': 'ryuukyoku', 'why': 'ron3', 'action': res}
-                            self.send_multiply({'event': 'agari', 'action': res})
-                            return res
-                        event_type = res.get('type')
-                        if event_type == 'agari':
-                            self.send_multiply({'event': 'agari', 'action': [res]})
-                            return [res]
-                        if event_type != 'pass':
-                            self.send_multiply({'event': event_type, 'action': res})
-                    after_tsumo = True
-                continue
-            else:
-                self.current_player = (self.current_player + 1) % 4
-                p = self.agents[self.current_player]
-                connection = self.clients[self.current_player]
-
-            if sum(self.game.kang_num) == 4 and 4 not in self.game.kang_num:
-                self.send_multiply({'event': 'ryuukyoku', 'why': 'kan4'})
-                return {'type': 'ryuukyoku', 'why': 'kan4'}
-
-            if self.game.left_num == 0:
-                nagashimangan = [i for i in range(4) if self.agents[i].nagashimangan and all(
-                    _ % 9 == 0 or _ % 9 == 8 or 27 <= _ <= 33 for _ in self.agents[i].discard_tiles)]
-                machi_state = {i: [list(self.agents[i].tiles), list(self.agents[i].machi)] for i in range(4) if
-                               self.agents[i].machi}
-                self.send_multiply({'event': 'ryuukyoku', 'why': 'yama_end', 'nagashimangan': nagashimangan,
-                                    'machi_state': machi_state})
-                return {'type': 'ryuukyoku', 'why': 'yama_end', 'nagashimangan': nagashimangan,
-                        'machi_state': machi_state}
-
-            tile_id, action = await self.handle_draw(who=self.current_player, where=0)
-            tile_id, res = await self.handle_tsumo_action(tile_id, action)
-            if res:  # 自摸和了或者加杠被人抢和
-                if isinstance(res, list):
-                    if len(res) == 3:
-                        self.send_multiply({'event': 'ryuukyoku', 'why': 'ron3', 'action': res})  # 三家和
-                        return {'event': 'ryuukyoku', 'why': 'ron3', 'action': res}
-                    self.send_multiply({'event': 'agari', 'action': res})
-                    return res
-                event_type = res.get('type')
-                if event_type == 'agari':
-                    self.send_multiply({'event': 'agari', 'action': [res]})
-                    return [res]
-                if event_type == 'ryuukyoku':
-                    self.send_multiply({'event': 'ryuukyoku', 'why': 'yao9', 'who': res.get('who'), 'hai': list(p.tiles)})
-                    return res
-                if event_type != 'pass':
-                    self.send_multiply({'event': event_type, 'action': res})
-            p.ippatsu_status = 0  # 摸了牌没和，清除一发
-            after_tsumo = True
-
 
 class Server:
-    def __init__(self, host, port, AI_count, min_score, fast, allow_observe, train=False):
+    """
+    大厅：一个事件循环里同时运行多个房间的对局，每个房间是一个GameEnvironment，对局是一个task
+    加入时可以指定房间号，不指定时自动匹配人数未满的房间；对局结束或房间无人后回收房间
+    """
+    def __init__(self, host, port, AI_count, min_score, fast, allow_observe, train=False, tables=1):
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((host, port))
-        self.server_socket.listen(5)
-        self.ROOM_ID_LOCK = 0
-        signal.signal(signal.SIGINT, self.close_server)
-        signal.signal(signal.SIGTERM, self.close_server)
+        self.server_socket.listen(1024)
         train = train and os.path.isfile('model/saved/reward-model/best.pt')
         AI_count = 4 if train else AI_count  # 训练模式下必须4个AI
         self.AI_count = AI_count
+        self.min_score = min_score
+        self.fast = fast
+        self.allow_observe = allow_observe
         self.train = train
-        self.game = GameEnvironment(has_aka=True, AI_count=AI_count, min_score=min_score, fast=fast, allow_observe=allow_observe, train=train)
+        self.tables = tables  # 4个AI时同时进行的对局数
+        self.rooms = {}  # {房间号: GameEnvironment}
+        self.ai_agent = AiAgent() if AI_count > 0 else None  # 所有房间共用，推理请求合并成batch
+        self.closed = False
+        self.connections = {}  # {handle_connection的task: StreamWriter}，关闭服务时断开
         logging.info(red(f"Server running at {host}:{port} with {self.AI_count} AI..."))
 
-    def close_server(self, signum, frame):
-        self.server_socket.close()
+    def close_server(self, server):
+        """SIGINT、SIGTERM时停止接受新连接、结束所有对局并断开所有连接，serve_forever随之返回"""
+        self.closed = True
+        server.close()
+        for game in self.rooms.values():
+            if game.task is not None:
+                game.task.cancel()
+        for writer in self.connections.values():
+            writer.close()
         logging.info(red("Server shutdown"))
-        exit(0)
 
-    def recv_socket(self, client_socket):
-        buffer = []
-        while True:
-            data = client_socket.recv(1)
-            if len(data) == 0:
-                break
-            if data == b'\n':
-                break
-            buffer.append(data)
-        return b''.join(buffer).decode('utf-8')
+    def create_room(self, room_id=None):
+        room_id = room_id or uuid4().hex[:6]
+        game = GameEnvironment(has_aka=True, AI_count=self.AI_count, min_score=self.min_score, fast=self.fast,
+                               allow_observe=self.allow_observe, train=self.train, ai_agent=self.ai_agent, room_id=room_id)
+        self.rooms[room_id] = game
+        logging.info(green(f"房间「{room_id}」已创建，当前房间数: {len(self.rooms)}"))
+        self.start_room(game)
+        return game
 
-    def handle_client(self, client: Client):
+    def match_room(self, room_id, username, observe):
+        """
+        指定房间号时进入该房间(不存在则新建，观战时不新建)
+        否则依次匹配: 该用户名所在的进行中的房间(断线重连或观战该玩家) > 观战时任一进行中的房间 > 人数未满的房间 > 新房间
+        """
+        if room_id:
+            if room_id not in self.rooms and not observe:
+                return self.create_room(room_id)
+            return self.rooms.get(room_id)
+        for game in self.rooms.values():
+            if username and game.game_start and username in game.clients:
+                return game
+        if observe or self.AI_count == 4:  # 4个AI的房间没有空位，只能观战
+            started = [game for game in self.rooms.values() if game.game_start]
+            return random.choice(started) if started else None
+        for game in self.rooms.values():
+            if not game.game_start and len(game.clients) < 4:
+                return game
+        return self.create_room()
+
+    def join(self, reader, writer, message):
+        """:return: (client, game)，加入失败时client为None"""
+        observe = message.get('observe')
+        game = self.match_room(message.get('room'), message.get('username'), observe)
+        if game is None:
+            writer.write(encode({'event': 'join', 'status': 0, 'message': '没有可以加入的房间'}))
+            writer.close()
+            return None, None
+        success, client = game.player_join(writer, message.get('username'), observe)
+        if not success:
+            writer.close()
+            self.check_room(game)
+            return None, game
+        client.reader = reader
+        game.send_personal(client, {'event': 'room', 'room': game.room_id, 'message': f'房间号: {game.room_id}'})
+        self.start_room(game)
+        return client, game
+
+    def start_room(self, game):
+        if len(game.clients) == 4 and not game.game_start:
+            game.game_start = True
+            game.task = asyncio.create_task(self.game_main_loop(game))
+            game.task.add_done_callback(lambda task: self.close_room(game, task))
+
+    def check_room(self, game):
+        """
+        没有真人玩家时回收房间：还没开始的房间直接关闭；
+        已开始的房间在真人玩家全部断线、也没有观战者时取消对局task，由task的done回调关闭房间
+        """
+        if any(client.is_human() for client in game.clients):
+            return
+        if not game.game_start and game.task is None:
+            self.close_room(game)
+        elif game.task is not None and not game.task.done() and not game.observers and \
+                any(client.client_socket == 'Disconnected' for client in game.clients):  # 4个AI的房间没有真人，不回收
+            logging.info(yellow(f"房间「{game.room_id}」的玩家都已断线"))
+            game.task.cancel()
+
+    def close_room(self, game, task=None):
+        if task is not None and not task.cancelled() and task.exception() is not None:
+            e = task.exception()
+            tb = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+            logging.debug(red(f"An exception occurred: {e}"))
+            logging.debug(red(f"Traceback info:\n{tb}"))
+        if self.rooms.get(game.room_id) is not game:
+            return
+        del self.rooms[game.room_id]
+        for client in game.clients:
+            client.close()
+        for _, client in list(game.observers.values()):
+            client.close()
+        logging.info(green(f"房间「{game.room_id}」已关闭，当前房间数: {len(self.rooms)}"))
+        self.fill_tables()
+
+    def fill_tables(self):
+        """4个AI时始终保持tables个对局在进行"""
+        if self.AI_count == 4 and not self.closed:
+            while len(self.rooms) < self.tables:
+                self.create_room()
+
+    async def handle_client(self, client: Client, game: GameEnvironment):
         while 1:
             try:
-                ready_to_read, _, _ = select.select([client.client_socket], [], [])
-                if not ready_to_read:
-                    time.sleep(0.1)
-                    continue
-                data = self.recv_socket(client.client_socket)
+                data = await client.recv()
                 if len(data) == 0:
-                    client.message_queue.put({'event': 'quit'})
+                    client.message_queue.put_nowait({'event': 'quit'})
                     break
                 data = json.loads(data)
                 logging.debug(yellow(f"Recv: {data}"))
                 event = data.get('event')
                 if event in ['quit', 'discard', 'decision', 'ready']:
-                    client.message_queue.put(data)
+                    client.message_queue.put_nowait(data)
                 if event == 'quit':
                     break
                 if event == 'change_ob':
-                    if client.username not in self.game.observers:
+                    if client.username not in game.observers:
                         continue
                     username = data.get('username')
-                    if username not in self.game.clients:
+                    if username not in game.clients:
                         continue
-                    target = self.game.clients.index(username)
-                    who, _ = self.game.observers[client.username]
-                    self.game.observers[client.username] = (target, client)
-                    self.game.observe_info[who].remove(client)
-                    self.game.observe_info[target].append(client)
-                    self.game.send_all_game_info(client)
+                    target = game.clients.index(username)
+                    who, _ = game.observers[client.username]
+                    game.observers[client.username] = (target, client)
+                    game.observe_info[who].remove(client)
+                    game.observe_info[target].append(client)
+                    game.send_all_game_info(client)
             except Exception as e:
-                client.message_queue.put({'event': 'quit'})
+                client.message_queue.put_nowait({'event': 'quit'})
                 tb = traceback.format_exc()
                 logging.debug(red(f"An exception occurred: {e}"))
                 logging.debug(red(f"Traceback info:\n{tb}"))
                 break
-        self.game.player_disconnect(client)
+        game.player_disconnect(client)
+        self.check_room(game)
 
-    @run_sync
-    def recv_continue_message(self, client: Client):
-        message = client.fetch_message()
+    async def recv_continue_message(self, client: Client):
+        message = await client.fetch_message()
         if message['event'] == 'ready':
             logging.info(f"{client.username} is ready")
 
-    async def game_main_loop(self):
-        self.game.game_start = True
-        random.shuffle(self.game.clients)
-        while self.game.game_start:
-            self.game.start()
-            self.game.send_all_game_info()
-            wind = ['東', '南', '西', '北'][self.game.round // 4]
-            wind_round = self.game.round % 4 + 1
-            logging.info(green(f'{wind}{wind_round}局 - {self.game.honba}本场------场供: {self.game.riichi_ba * 1000}'))
-            res = await self.game.game_loop()
+    async def game_main_loop(self, game: GameEnvironment):
+        game.game_start = True
+        random.shuffle(game.clients)
+        while game.game_start:
+            game.start()
+            game.send_all_game_info()
+            wind = ['東', '南', '西', '北'][game.round // 4]
+            wind_round = game.round % 4 + 1
+            logging.info(green(f'{wind}{wind_round}局 - {game.honba}本场------场供: {game.riichi_ba * 1000}'))
+            res = await game.game_loop()
             if res is None:
                 logging.debug(yellow("游戏中断..."))
                 break
-            if self.train:
-                scores = [p.score for p in self.game.agents]
-            game_over, score_delta = self.game.game_update(res)
-            if self.train:
-                for i in range(4):
-                    self.game.reward_features[i].append(torch.from_numpy(self.game.game.get_game_feature(score_delta[i], scores[i])))
-                    for item in self.game.collected_data[i]:
-                        if len(item) == 3:
-                            continue
-                        features = torch.stack(self.game.reward_features[i])[None].float()
-                        reward = self.game.reward(features, len(self.game.reward_features[i]) - 1)
-                        item.append(reward)
-            if not self.game.fast:
+            scores = [p.score for p in game.agents]
+            game_over, score_delta = game.game_update(res)
+            game.round_end(res, score_delta, scores)
+            if not game.fast:
                 await asyncio.sleep(2)
-            self.game.send_multiply({'event': 'settlement', 'res': res, 'score': score_delta, 'ura_dora': self.game.game.ura_dora_indicator})
+            game.send_multiply({'event': 'settlement', 'res': res, 'score': score_delta, 'ura_dora': game.game.ura_dora_indicator})
             wait_jobs = []
-            for client in self.game.clients:
+            for client in game.clients:
                 if client.is_human():
                     wait_jobs.append(self.recv_continue_message(client))
-            if not self.game.fast and all([not _.is_human() for _ in self.game.clients]):
+            if not game.fast and all([not _.is_human() for _ in game.clients]):
                 wait_jobs.append(asyncio.sleep(15))
             await asyncio.gather(*wait_jobs)
             logging.info(green("Continue..."))
             if game_over:
                 logging.info(green('游戏结束！'))
-                for i, score in self.game.game.get_rank():
-                    logging.info(green(f"「{self.game.clients[i].username}」积分「{score * 100}」"))
-                self.game.game_start = False
-                if not self.game.fast:
+                for i, score in game.game.get_rank():
+                    logging.info(green(f"「{game.clients[i].username}」积分「{score * 100}」"))
+                game.game_start = False
+                if not game.fast:
                     await asyncio.sleep(0.1)
-                self.game.send_player_score()
+                game.send_player_score()
                 wait_jobs = []
-                for client in self.game.clients:
+                for client in game.clients:
                     if client.is_human():
                         wait_jobs.append(self.recv_continue_message(client))
-                if not self.game.fast and all([not _.is_human() for _ in self.game.clients]):
+                if not game.fast and all([not _.is_human() for _ in game.clients]):
                     wait_jobs.append(asyncio.sleep(10))
                 await asyncio.gather(*wait_jobs)
-                self.game.send_multiply({'event': 'end', 'message': '游戏结束！请重新加入房间～'})
-                if not self.game.fast:
+                game.send_multiply({'event': 'end', 'message': '游戏结束！请重新加入房间～'})
+                if not game.fast:
                     await asyncio.sleep(0.1)
-                for conn in self.game.clients:
+                for conn in game.clients:
                     conn.close()
-                self.game.reset()
-                break
+                break  # 房间由task的done回调关闭，观战者在那里断开
 
-    def game_thread(self):
+    async def handle_connection(self, reader, writer):
+        """每个连接一个协程：先读握手消息加入房间，之后在这里接收该玩家的消息"""
+        task = asyncio.current_task()
+        self.connections[task] = writer
         try:
-            asyncio.run(self.game_main_loop())
-        except Exception as e:
-            tb = traceback.format_exc()
-            logging.debug(red(f"An exception occurred: {e}"))
-            logging.debug(red(f"Traceback info:\n{tb}"))
-            pass
-
-    def handle_connection(self):
-        while 1:
             try:
-                client_socket, addr = self.server_socket.accept()
-                ready_to_read, _, _ = select.select([client_socket], [], [])
-                if ready_to_read:
-                    message = json.loads(self.recv_socket(client_socket))
-                    username = message.get('username')
-                    observe = message.get('observe')
-                    success, client = self.game.player_join(client_socket, username, observe)
-                    if success:
-                        threading.Thread(target=self.handle_client, args=(client,), daemon=True).start()
+                message = json.loads(await read_line(reader))
+                client, game = self.join(reader, writer, message)
             except Exception:
-                continue
+                writer.close()
+                return
+            if client is not None:
+                await self.handle_client(client, game)
+        finally:
+            del self.connections[task]
 
     async def run(self):
-        threading.Thread(target=self.handle_connection, daemon=True).start()
-        while True:
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_socket, limit=MAX_FRAME_SIZE)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.close_server, server)
+        self.fill_tables()
+        async with server:
             try:
-                if len(self.game.clients) == 4 and not self.game.game_start:
-                    thread = threading.Thread(target=self.game_thread, daemon=True)
-                    thread.start()
-                    thread.join()
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                tb = traceback.format_exc()
-                logging.debug(red(f"An exception occurred: {e}"))
-                logging.debug(red(f"Traceback info:\n{tb}"))
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                if not self.closed:
+                    raise
+        # 等连接断开后各协程自行结束，不留给asyncio.run取消
+        rooms = [game.task for game in self.rooms.values() if game.task is not None]
+        await asyncio.gather(*self.connections, *rooms, return_exceptions=True)
 
 
 if __name__ == '__main__':
@@ -1343,10 +684,11 @@ if __name__ == '__main__':
     args.add_argument('--debug', '-d', action='store_true', help='Print more details')
     args.add_argument('--fast', '-f', action='store_true', help='Cancel AI thinking time')
     args.add_argument('--train', '-t', action='store_true', help='Collect playing data')
+    args.add_argument('--tables', '-T', default=1, type=int, help='Number of concurrent tables when all players are AI')
     args = args.parse_args()
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
     else:
         logging.basicConfig(level=logging.INFO)
-    server = Server(args.host, args.port, args.AI, args.min_score, args.fast, args.allow_observe, args.train)
+    server = Server(args.host, args.port, args.AI, args.min_score, args.fast, args.allow_observe, args.train, args.tables)
     asyncio.run(server.run())
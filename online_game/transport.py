@@ -0,0 +1,97 @@
+"""
+服务端与客户端共用的消息分帧：每条消息是一行JSON，以'\n'结尾
+网页客户端经websockify转发的也是同样的字节流
+服务端用asyncio的StreamReader(read_line)，命令行客户端用阻塞socket(LineReader)
+"""
+import json
+import select
+import asyncio
+
+try:
+    import orjson  # 见requirements.txt，序列化快一个数量级，输出仍是JSON(UTF-8，不转义非ASCII字符)；没有安装时退回json
+except ImportError:
+    orjson = None
+
+MAX_FRAME_SIZE = 1 << 20  # 一条消息最多1MB，超过时认为对端异常
+MAX_WRITE_BUFFER = 1 << 22  # 发往一个连接、尚未发出的数据超过4MB时认为对端太慢，断开连接
+CHUNK_SIZE = 1 << 16
+
+
+def dumps(value):
+    """序列化成bytes，不带换行"""
+    if orjson is not None:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(value).encode('utf-8')
+
+
+def encode(message):
+    """一条完整的消息"""
+    return dumps(message) + b'\n'
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+async def read_line(reader: asyncio.StreamReader):
+    """
+    :param reader: limit应设为MAX_FRAME_SIZE
+    :return: 一条消息(不含'\n')，连接断开时返回空字符串，断开前不完整的消息丢弃
+    """
+    while True:
+        try:
+            line = await reader.readuntil(b'\n')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return ''
+        except asyncio.LimitOverrunError as e:
+            raise FrameTooLarge('frame exceeds the reader limit') from e
+        line = line[:-1].decode('utf-8')
+        if line:  # 跳过空行
+            return line
+
+
+class LineReader(object):
+    """
+    带缓冲的按行读取：一次recv读入尽可能多的数据，从缓冲区中切出完整的行，
+    一次读到的多条消息或者分几次到达的一条消息都能正确处理
+    """
+    def __init__(self, sock, max_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.scanned = 0  # buffer中已经确认没有'\n'的长度
+
+    def readline(self):
+        """
+        :return: 一条消息(不含'\n')，连接断开时返回空字符串，断开前不完整的消息丢弃
+        """
+        while True:
+            line = self.pop_line()
+            if line is not None:
+                if line:
+                    return line
+                continue  # 跳过空行
+            try:
+                data = self.sock.recv(CHUNK_SIZE)
+            except BlockingIOError:  # 非阻塞socket，等待可读后再读
+                select.select([self.sock], [], [])
+                continue
+            if not data:
+                self.buffer.clear()
+                self.scanned = 0
+                return ''
+            self.buffer += data
+
+    def pop_line(self):
+        i = self.buffer.find(b'\n', self.scanned)
+        if i < 0:
+            self.scanned = len(self.buffer)
+            i = len(self.buffer)
+        if i > self.max_size:
+            raise FrameTooLarge(f'frame exceeds {self.max_size} bytes')
+        if i == len(self.buffer):
+            return None
+        line = self.buffer[:i].decode('utf-8')
+        del self.buffer[:i + 1]
+        self.scanned = 0
+        return line
@@ -1,5 +1,6 @@
 let ws;
 let buffer = "";
+let decoder;
 let intervalId;
 
 function send(data){
@@ -50,6 +51,8 @@ function connectWebSocket() {
     } catch (error){
         alert(error);
     }
+    ws.binaryType = 'arraybuffer';
+    decoder = new TextDecoder('utf-8');
 
     ws.addEventListener('open', function(event) {
         console.log('WebSocket connection opened:', event);
@@ -68,14 +71,8 @@ function connectWebSocket() {
     });
 
     ws.addEventListener('message', function(event) {
-        const reader = new FileReader();
-
-        reader.onload = function() {
-            const text = reader.result;
-            buffer += text;
-        };
-
-        reader.readAsText(event.data);
+        // 服务端可能不转义中文，一个字符的UTF-8字节可能分在两帧里，用stream模式解码
+        buffer += typeof event.data === 'string' ? event.data : decoder.decode(event.data, {stream: true});
     });
 
     ws.addEventListener('close', function(event) {
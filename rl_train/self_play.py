@@ -0,0 +1,216 @@
+"""
+多进程自我对局，收集训练数据
+1. 每个worker进程用VectorEnv同步推进多个对局(train模式)，AI的每次弃牌记为[state, 打出的牌种, 该局的reward]
+2. 数据按dataset/preprocess.py的格式写成分片(打包的特征 + 标签，另加-rewards.npy)，分片写完后通过队列通知learner
+3. learner(主进程)登记分片、更新manifest.json，并统计games/s、samples/s；
+   output_dir中已有manifest.json时接着登记，各worker的分片编号接着已有的文件往后排，不会覆盖之前的数据；
+   TenhouShardDataset(output_dir, mode='discard', split='selfplay', packed=True)可以直接读取已经写出的分片
+learner不做参数更新，只登记分片，并统计吞吐以及读入样本的reward均值/标准差、打出牌种的分布
+
+$ python rl_train/self_play.py -n 1000 -w 8 -e 16 -o selfplay
+"""
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import argparse
+import multiprocessing
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import numpy as np
+import torch
+from dataset.data import MANIFEST, pack_features
+from mahjong.game import FEATURE_CHANNELS
+from mahjong.registry import registry, load_reward_model
+from mahjong.simulator import VectorEnv
+
+TASK = 'discard'
+SPLIT = 'selfplay'
+
+
+def shard_prefix(rank):
+    return f'{TASK}-{SPLIT}-w{rank:02d}-'
+
+
+def next_shard_index(output_dir, rank):
+    """该worker已经写过的分片之后的编号"""
+    prefix = shard_prefix(rank)
+    indices = [int(f[len(prefix):len(prefix) + 4]) for f in os.listdir(output_dir)
+               if f.startswith(prefix) and f.endswith('-features.npy')]
+    return max(indices, default=-1) + 1
+
+
+class SelfPlayWriter(object):
+    """攒够shard_size个样本写一个分片，分片名带上worker编号，多个worker写同一个目录不会冲突"""
+    def __init__(self, output_dir, rank, shard_size, messages, first_shard=0):
+        self.output_dir = output_dir
+        self.rank = rank
+        self.shard_size = shard_size
+        self.messages = messages
+        self.samples = []
+        self.num_shards = first_shard
+
+    def add(self, samples):
+        self.samples.extend(samples)
+        while len(self.samples) >= self.shard_size:
+            self.flush(self.samples[:self.shard_size])
+            self.samples = self.samples[self.shard_size:]
+
+    def flush(self, samples):
+        if not samples:
+            return
+        name = f'{shard_prefix(self.rank)}{self.num_shards:04d}'
+        path = os.path.join(self.output_dir, name)
+        states, labels, rewards = zip(*samples)
+        np.save(path + '-features.npy', pack_features(np.stack(states)))
+        np.save(path + '-labels.npy', np.array(labels, dtype=np.int32))
+        np.save(path + '-rewards.npy', np.array(rewards, dtype=np.float32))
+        self.num_shards += 1
+        self.messages.put(('shard', {'name': name, 'length': len(samples)}))  # 文件都写完才通知，learner不会读到不完整的分片
+
+    def close(self):
+        self.flush(self.samples)
+        self.samples = []
+
+
+def worker(rank, num_games, first_shard, args, messages):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # 由主进程处理Ctrl-C
+    torch.set_num_threads(args.threads)
+    env = VectorEnv(args.envs, train=True)
+    writer = SelfPlayWriter(args.output_dir, rank, args.shard_size, messages, first_shard)
+    started = 0
+    for i in range(min(num_games, args.envs)):
+        env.begin(i)
+        started += 1
+    while any(request is not None for request in env.requests):
+        for i, ranks, num_rounds in env.step():
+            sim = env.envs[i]
+            samples = [item for seat in range(4) for item in sim.collected_data[seat]]
+            sim.collected_data.clear()  # 每个半庄结束后交给writer，进程内不再保留
+            writer.add(samples)
+            messages.put(('game', {'rounds': num_rounds, 'samples': len(samples)}))
+            if started < num_games:
+                env.begin(i)
+                started += 1
+    writer.close()
+    messages.put(('done', rank))
+
+
+class Learner(object):
+    """消费worker写出的分片：登记到manifest(已有时接着登记)，统计吞吐和样本的reward、牌种分布"""
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.manifest = self.load_manifest()
+        self.start = time.perf_counter()
+        self.games = 0
+        self.rounds = 0
+        self.samples = 0
+        self.consumed = 0  # learner读入的样本数
+        self.reward_sum = 0.
+        self.reward_sq_sum = 0.
+        self.label_counts = np.zeros(34, dtype=np.int64)
+
+    def on_game(self, info):
+        self.games += 1
+        self.rounds += info['rounds']
+        self.samples += info['samples']
+
+    def on_shard(self, shard):
+        path = os.path.join(self.output_dir, shard['name'])
+        labels = np.load(path + '-labels.npy', mmap_mode='r')
+        rewards = np.load(path + '-rewards.npy', mmap_mode='r').astype(np.float64)
+        self.consumed += len(labels)
+        self.reward_sum += rewards.sum()
+        self.reward_sq_sum += (rewards ** 2).sum()
+        self.label_counts += np.bincount(labels, minlength=34)
+        self.manifest['tasks'][TASK][SPLIT].append(shard)
+        self.save_manifest()
+
+    def load_manifest(self):
+        path = os.path.join(self.output_dir, MANIFEST)
+        if not os.path.exists(path):
+            return {
+                'shape': {TASK: (FEATURE_CHANNELS, 34)},
+                'tasks': {TASK: {SPLIT: []}},
+            }
+        with open(path) as f:
+            manifest = json.load(f)
+        shape = manifest['shape'].setdefault(TASK, [FEATURE_CHANNELS, 34])
+        if tuple(shape) != (FEATURE_CHANNELS, 34):
+            raise ValueError(f'{path}: {TASK} features have shape {shape}, expected {(FEATURE_CHANNELS, 34)}')
+        manifest['tasks'].setdefault(TASK, {}).setdefault(SPLIT, [])
+        return manifest
+
+    def save_manifest(self):
+        path = os.path.join(self.output_dir, MANIFEST)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def report(self):
+        elapsed = time.perf_counter() - self.start
+        ret = (f'{self.games} games, {self.rounds} rounds, {self.samples} samples ({self.consumed} consumed) in {elapsed:.1f}s: '
+               f'{self.games / elapsed:.2f} games/s, {self.samples / elapsed:.1f} samples/s')
+        if self.consumed:
+            mean = self.reward_sum / self.consumed
+            std = max(self.reward_sq_sum / self.consumed - mean ** 2, 0.) ** 0.5
+            top = ', '.join(f'{tile}: {self.label_counts[tile] / self.consumed:.1%}' for tile in self.label_counts.argsort()[::-1][:3])
+            ret += f'\nreward {mean:.2f} ± {std:.2f}, most discarded tiles {top}'
+        return ret
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_games', '-n', default=100, type=int)
+    parser.add_argument('--workers', '-w', default=os.cpu_count(), type=int)
+    parser.add_argument('--envs', '-e', default=16, type=int)  # 每个worker同步推进的对局数
+    parser.add_argument('--threads', '-t', default=1, type=int)  # 每个worker的torch线程数
+    parser.add_argument('--output_dir', '-o', default='selfplay', type=str)
+    parser.add_argument('--shard_size', '-s', default=50000, type=int)
+    parser.add_argument('--log_interval', default=10., type=float)  # 每隔多少秒输出一次吞吐
+    args = parser.parse_args()
+
+    if registry.get('model/saved/reward-model/best.pt', load_reward_model)[0] is None:
+        raise FileNotFoundError('model/saved/reward-model/best.pt (train mode needs the reward model)')
+    os.makedirs(args.output_dir, exist_ok=True)
+    learner = Learner(args.output_dir)
+    learner.save_manifest()
+    messages = multiprocessing.Queue()
+    shares = [args.num_games // args.workers + (i < args.num_games % args.workers) for i in range(args.workers)]
+    processes = [multiprocessing.Process(target=worker, args=(rank, n, next_shard_index(args.output_dir, rank), args, messages),
+                                         daemon=True)
+                 for rank, n in enumerate(shares) if n]
+    for p in processes:
+        p.start()
+
+    running = len(processes)
+    last_report = time.perf_counter()
+    try:
+        while running:
+            try:
+                kind, info = messages.get(timeout=1)
+            except queue.Empty:
+                failed = [p.exitcode for p in processes if p.exitcode not in (None, 0)]
+                if failed:  # worker异常退出时不会再发'done'
+                    raise RuntimeError(f'{len(failed)} self-play worker(s) died, exit code {failed[0]}')
+                continue
+            if kind == 'game':
+                learner.on_game(info)
+            elif kind == 'shard':
+                learner.on_shard(info)
+            else:
+                running -= 1
+            if time.perf_counter() - last_report >= args.log_interval:
+                last_report = time.perf_counter()
+                print(learner.report(), flush=True)
+    except (KeyboardInterrupt, RuntimeError):
+        for p in processes:
+            p.terminate()
+        raise
+    finally:
+        for p in processes:
+            p.join()
+    print(learner.report())
+    print(f'{len(learner.manifest["tasks"][TASK][SPLIT])} shards -> {os.path.join(args.output_dir, MANIFEST)}')
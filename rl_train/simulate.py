@@ -0,0 +1,39 @@
+"""
+不经过网络、不等待思考时间，在多个进程中并行自我对局，统计对局速度
+规则与online_game/server.py完全相同(共用mahjong/simulator.py)，AI的选择方式也与服务端相同
+
+$ python rl_train/simulate.py -n 1000 -w 8
+$ python rl_train/simulate.py -n 1000 -w 8 -e 32  # 每个进程同步推进32个对局，推理合并成batch
+"""
+import os
+import sys
+import time
+import argparse
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import numpy as np
+from tqdm import tqdm
+from mahjong.simulator import play_games
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_games', '-n', default=100, type=int)
+    parser.add_argument('--workers', '-w', default=None, type=int)  # 默认为CPU核数
+    parser.add_argument('--threads', '-t', default=1, type=int)  # 每个进程的torch线程数
+    parser.add_argument('--envs', '-e', default=1, type=int)  # 每个进程中用VectorEnv同步推进的对局数
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    rounds = []
+    final_scores = np.zeros((args.num_games, 4))
+    games = play_games(args.num_games, args.workers, threads=args.threads, num_envs=args.envs)
+    for i, (ranks, num_rounds) in enumerate(tqdm(games, total=args.num_games)):
+        rounds.append(num_rounds)
+        for seat, score in ranks:
+            final_scores[i, seat] = score * 100
+    elapsed = time.perf_counter() - start
+
+    print(f'{args.num_games} games, {sum(rounds)} rounds in {elapsed:.1f}s: '
+          f'{args.num_games / elapsed * 60:.1f} games/min, {sum(rounds) / elapsed:.1f} rounds/s')
+    print('average final score by seat: ' + ', '.join(f'{score:.0f}' for score in final_scores.mean(0)))
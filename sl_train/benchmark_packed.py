@@ -0,0 +1,71 @@
+"""
+对比float32特征和按位打包的uint8特征两条数据通路的吞吐量
+测量范围: DataLoader读取、整理batch、拷贝到设备、展开成float(模型第一层的输入)
+
+$ python sl_train/benchmark_packed.py --cache_dir cache --mode discard
+"""
+import os
+import sys
+import time
+import argparse
+from functools import partial
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import torch
+from torch.utils.data import DataLoader
+from model.models import Unpack
+from dataset.data import TenhouShardDataset, collate_fn_binary
+
+
+def run(dataset, packed, args, device):
+    loader = DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        shuffle=True,
+        num_workers=args.num_workers,
+        collate_fn=partial(collate_fn_binary, packed=packed),
+        pin_memory=device.type == 'cuda'
+    )
+    if len(loader) <= args.warmup:
+        raise ValueError(f'{args.cache_dir}中{args.mode}任务只有{len(loader)}个batch，需要多于--warmup({args.warmup})个才能计时')
+    unpack = Unpack(dataset.shape).to(device)
+    num_samples = 0
+    start = None
+    with torch.no_grad():
+        for i, (features, labels) in enumerate(loader):
+            if i == args.warmup:  # 跳过worker启动
+                if device.type == 'cuda':
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+            if i == args.warmup + args.batches:
+                break
+            sample_bytes = features.nbytes / len(features)  # collate后、拷贝到设备前每个样本的大小
+            features = features.to(device, non_blocking=True)
+            if packed:
+                features = unpack(features)
+            if start is not None:
+                num_samples += len(features)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    return num_samples / elapsed, sample_bytes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--cache_dir', '-c', default='cache', type=str)
+    parser.add_argument('--mode', '-m', default='discard', type=str)
+    parser.add_argument('--batch_size', '-b', default=512, type=int)
+    parser.add_argument('--batches', '-n', default=50, type=int)
+    parser.add_argument('--warmup', default=5, type=int)
+    parser.add_argument('--num_workers', '-j', default=4, type=int)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    results = {}
+    for packed in [False, True]:
+        dataset = TenhouShardDataset(args.cache_dir, mode=args.mode, split='train', packed=packed)
+        results[packed] = run(dataset, packed, args, device)
+        name = 'packed uint8' if packed else 'float32'
+        print(f'{name:>12}: {results[packed][0]:10.1f} samples/s, {results[packed][1] / 1024:8.2f} KB/sample per batch')
+    print(f'speedup: {results[True][0] / results[False][0]:.2f}x')
@@ -0,0 +1,180 @@
+"""
+把训练好的弃牌、立直、鸣牌模型导出成CPU推理用的TorchScript(quantized.pt)，AiAgent在CPU上运行时优先加载
+1. BatchNorm折叠进前面的Conv1d/Linear
+2. 量化方式: fold只折叠BN不量化; dynamic只把全连接层量化成int8; static用训练集特征校准，卷积和全连接层都量化成int8
+3. 在测试集上对比原模型的弃牌准确率/决策F1，以及batch为1时单次决策的CPU延迟
+
+$ python sl_train/quantize_model.py --mode discard --checkpoint model/saved/discard-model/best.pt --cache_dir cache
+"""
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+from functools import partial
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from torch.utils.data import DataLoader
+from sklearn.metrics import precision_recall_fscore_support
+from model.models import DiscardModel, RiichiModel, FuroModel
+from dataset.data import TenhouShardDataset, collate_fn_discard, collate_fn_binary
+
+MODELS = {
+    'discard': DiscardModel,
+    'riichi': RiichiModel,
+    'chi': FuroModel,
+    'pon': FuroModel,
+    'kan': FuroModel,
+}
+# 量化的子模块，模型的forward(包括打包特征的展开)保持不变，子模块之间以float传递
+SUBMODULES = ['in_conv', 'res_blocks', 'out_conv', 'fc']
+
+
+def fold_bn(module):
+    """把nn.Sequential中紧跟在Conv1d/Linear后面的BatchNorm1d折叠进去(eval模式)"""
+    for child in module.children():
+        fold_bn(child)
+    if not isinstance(module, nn.Sequential):
+        return module
+    for i in range(len(module) - 1):
+        layer, bn = module[i], module[i + 1]
+        if not isinstance(bn, nn.BatchNorm1d):
+            continue
+        if isinstance(layer, nn.Conv1d):
+            layer = fuse_conv_bn_eval(layer, bn)
+            if layer.padding == 'same':  # 量化卷积不支持'same'，stride为1、卷积核为奇数时等价于两侧各补k // 2
+                layer.padding = (layer.kernel_size[0] // 2,)
+        elif isinstance(layer, nn.Linear):
+            layer = fuse_linear_bn_eval(layer, bn)
+        else:
+            continue
+        module[i], module[i + 1] = layer, nn.Identity()
+    return module
+
+
+def quantize_static(model, loader, num_batches, engine):
+    """各子模块分别做FX静态量化，用loader的前num_batches个batch校准"""
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    features, _ = next(iter(loader))
+    example = model.unpack(features) if features.dtype == torch.uint8 else features
+    for name in SUBMODULES:
+        if hasattr(model, name):
+            module = getattr(model, name)
+            setattr(model, name, prepare_fx(module, qconfig_mapping, example_inputs=(example,)))
+            with torch.no_grad():
+                example = module(example)
+    with torch.no_grad():
+        for i, (features, _) in enumerate(loader):
+            if i == num_batches:
+                break
+            model(features)
+    for name in SUBMODULES:
+        if hasattr(model, name):
+            setattr(model, name, convert_fx(getattr(model, name)))
+    return model
+
+
+@torch.no_grad()
+def evaluate(model, loader, task, threshold):
+    """弃牌任务返回准确率，其他任务返回checkpoint阈值下的F1"""
+    if task == 'discard':
+        acc = total = 0
+        for features, labels in loader:
+            output = model(features).softmax(1)
+            unpacked = model.unpack(features) if features.dtype == torch.uint8 else features
+            available = unpacked[:, :4].sum(1) != 0
+            acc += ((output * available).argmax(1) == labels).sum().item()
+            total += len(labels)
+        return {'test_acc': acc / total}
+    y_true = []
+    y_pred = []
+    for features, labels in loader:
+        y_true.extend(labels.tolist())
+        y_pred.extend((model(features).sigmoid().flatten() > threshold).int().tolist())
+    _, _, f_score, _ = precision_recall_fscore_support(y_true=y_true, y_pred=y_pred, average='binary', zero_division=0)
+    return {'test_f1': f_score}
+
+
+@torch.inference_mode()
+def latency(model, dataset, runs, warmup=10):
+    """batch为1时单次决策的延迟中位数(ms)"""
+    x = torch.from_numpy(np.array(dataset[0][0]))[None]
+    if x.dtype != torch.uint8:
+        x = x.float()
+    for _ in range(warmup):
+        model(x)
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model(x)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1000)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mode', '-m', default='discard', choices=list(MODELS), type=str)
+    parser.add_argument('--checkpoint', default=None, type=str)  # 默认model/saved/{mode}-model/best.pt
+    parser.add_argument('--output', '-o', default=None, type=str)  # 默认与checkpoint同目录的quantized.pt
+    parser.add_argument('--quantize', '-q', default='static', choices=['fold', 'dynamic', 'static'], type=str)
+    parser.add_argument('--cache_dir', '-c', default='cache', type=str)  # dataset/preprocess.py的输出目录
+    parser.add_argument('--batch_size', '-b', default=256, type=int)
+    parser.add_argument('--calibration_batches', default=32, type=int)
+    parser.add_argument('--runs', default=200, type=int)
+    parser.add_argument('--threads', '-t', default=None, type=int)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    engine = 'x86' if 'x86' in torch.backends.quantized.supported_engines else 'qnnpack'
+    torch.backends.quantized.engine = engine
+    checkpoint = args.checkpoint or f'model/saved/{args.mode}-model/best.pt'
+    output = args.output or os.path.join(os.path.dirname(checkpoint), 'quantized.pt')
+
+    params = torch.load(checkpoint, map_location='cpu')
+    model = MODELS[args.mode](num_layers=params['num_layers'], in_channels=params['in_channels'])
+    model.load_state_dict(params['state_dict'])
+    model.eval()
+    threshold = params.get('threshold')
+
+    collate_fn = partial(collate_fn_discard if args.mode == 'discard' else collate_fn_binary, packed=True)
+    train_set = TenhouShardDataset(args.cache_dir, mode=args.mode, split='train', packed=True)
+    test_set = TenhouShardDataset(args.cache_dir, mode=args.mode, split='test', packed=True)
+    train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, collate_fn=collate_fn)
+    test_loader = DataLoader(test_set, batch_size=args.batch_size, collate_fn=collate_fn)
+
+    quantized = fold_bn(copy.deepcopy(model))
+    if args.quantize == 'dynamic':
+        quantized = quantize_dynamic(quantized, {nn.Linear}, dtype=torch.qint8)
+    elif args.quantize == 'static':
+        quantized = quantize_static(quantized, train_loader, args.calibration_batches, engine)
+    meta = {
+        'task': args.mode,
+        'quantize': args.quantize,
+        'engine': engine,
+        'in_channels': params['in_channels'],
+        'num_layers': params['num_layers'],
+        'threshold': threshold,
+    }
+    torch.jit.save(torch.jit.script(quantized), output, _extra_files={'meta.json': json.dumps(meta)})
+
+    # 评估的是重新加载的导出文件，即AiAgent实际使用的模型；先测batch为1的延迟，避免JIT按测试集的batch大小特化
+    exported = torch.jit.load(output)
+    report = {}
+    for name, m in [('fp32', model), (args.quantize, exported)]:
+        report[name] = {'latency_ms': latency(m, test_set, args.runs), **evaluate(m, test_loader, args.mode, threshold)}
+    base, new = report['fp32'], report[args.quantize]
+    report['delta'] = {key: new[key] - base[key] for key in base}
+    meta['report'] = report
+    torch.jit.save(exported, output, _extra_files={'meta.json': json.dumps(meta)})
+
+    print(f'{args.mode} model -> {output} ({args.quantize}, {engine}, {torch.get_num_threads()} threads)')
+    for name, result in report.items():
+        print(f'{name:>8}: ' + ', '.join(f'{key} {value:+.4f}' if name == 'delta' else f'{key} {value:.4f}' for key, value in result.items()))
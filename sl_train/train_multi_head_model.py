@@ -0,0 +1,182 @@
+"""
+弃牌、立直、吃、碰、杠五个head共用一个主干联合训练
+每一步从各任务各取一个batch，拼在一起只算一次主干，损失求和
+弃牌数据最多，一个epoch以弃牌数据遍历一遍为准，其他任务循环使用
+"""
+import os
+import torch
+from torch.optim import Adam
+import wandb
+import argparse
+from functools import partial
+from torch.nn import CrossEntropyLoss, BCEWithLogitsLoss
+from torch.utils.data import DataLoader
+from sklearn.metrics import roc_curve, precision_recall_fscore_support
+import tqdm
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+from model.models import MultiHeadModel
+from dataset.data import TenhouShardDataset, collate_fn_discard, collate_fn_binary
+
+
+def cycle(loader):
+    while True:
+        empty = True
+        for batch in loader:
+            empty = False
+            yield batch
+        if empty:  # 否则会一直空转
+            raise ValueError('cannot cycle over an empty loader')
+
+
+def forward(model, batches):
+    """
+    :param batches: {head: features}
+    :return: {head: output}
+    """
+    states, furo = {}, {}
+    for head, features in batches.items():
+        states[head], furo[head] = model.split(features, head)
+    hidden = model.trunk(torch.cat(list(states.values())))
+    outputs = {}
+    start = 0
+    for head, state in states.items():
+        outputs[head] = model.heads[head](hidden[start:start + len(state)], furo[head])
+        start += len(state)
+    return outputs
+
+
+@torch.no_grad()
+def model_test(model, loaders, heads):
+    """
+    :param heads: 训练过的决策head，只给其中有测试数据的head计算阈值
+    :return: (metrics, {head: threshold})
+    """
+    acc = 0
+    total = 0
+    for features, labels in loaders['discard']:
+        features, labels = features.to(device), labels.to(device)
+        output = model(features, 'discard').softmax(1)
+        available = model.unpack(features)[:, :4].sum(1) != 0
+        pred = (output * available).argmax(1)
+        acc += (pred == labels).sum().item()
+        total += len(labels)
+    metrics = {'test_acc': acc / total}
+    thresholds = {}
+    for head in heads:
+        if not len(loaders[head].dataset):
+            continue
+        y_true = []
+        y_score = []
+        for features, labels in loaders[head]:
+            output = model(features.to(device), head).sigmoid().flatten()
+            y_true.extend(labels.tolist())
+            y_score.extend(output.tolist())
+        fpr, tpr, roc_thresholds = roc_curve(y_true, y_score)
+        threshold = roc_thresholds[(tpr - fpr).argmax()]
+        y_pred = [int(score > threshold) for score in y_score]
+        _, _, f_score, _ = precision_recall_fscore_support(y_true=y_true, y_pred=y_pred, average='binary')
+        metrics[f'test_{head}_f1'] = f_score
+        thresholds[head] = float(threshold)
+    return metrics, thresholds
+
+
+def head_weight(value):
+    """--pos_weight的一项，如riichi=5"""
+    head, _, weight = value.partition('=')
+    if head not in MultiHeadModel.HEADS[1:]:
+        raise argparse.ArgumentTypeError(f'unknown head: {head}')
+    return head, float(weight)
+
+
+mode = 'multi-head'
+parser = argparse.ArgumentParser()
+parser.add_argument('--num_layers', '-n', default=50, type=int)
+parser.add_argument('--head_layers', '-hl', default=2, type=int)
+parser.add_argument('--epochs', '-e', default=10, type=int)
+parser.add_argument('--batch_size', '-b', default=256, type=int)
+parser.add_argument('--pos_weight', '-w', default=[], type=head_weight, nargs='*')  # 各决策head的正样本权重，如riichi=5 chi=3，与单独训练时各自的--pos_weight对应
+parser.add_argument('--cache_dir', '-c', default='cache', type=str)  # dataset/preprocess.py的输出目录
+args = parser.parse_args()
+
+experiment = wandb.init(project='Mahjong', resume='allow', anonymous='must', name=f'train-{mode}-sl')
+train_loaders = {}
+test_loaders = {}
+for head in MultiHeadModel.HEADS:
+    collate_fn = partial(collate_fn_discard if head == 'discard' else collate_fn_binary, packed=True)
+    train_set = TenhouShardDataset(args.cache_dir, mode=head, split='train', packed=True)
+    test_set = TenhouShardDataset(args.cache_dir, mode=head, split='test', packed=True)
+    train_loaders[head] = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, num_workers=2, collate_fn=collate_fn, pin_memory=True)
+    test_loaders[head] = DataLoader(test_set, batch_size=args.batch_size, num_workers=2, collate_fn=collate_fn)
+
+num_layers = args.num_layers
+head_layers = args.head_layers
+in_channels = 291
+furo_channels = 22
+model = MultiHeadModel(in_channels=in_channels, furo_channels=furo_channels, num_layers=num_layers, head_layers=head_layers)
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+model.to(device)
+optim = Adam(model.parameters())
+scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optim, mode='max', patience=1)
+discard_loss_fcn = CrossEntropyLoss()
+pos_weight = dict(args.pos_weight)
+decision_loss_fcns = {}
+for head in MultiHeadModel.HEADS[1:]:  # 各任务正负样本的比例相差很大，分别设置正样本权重
+    if head in pos_weight:
+        decision_loss_fcns[head] = BCEWithLogitsLoss(pos_weight=torch.tensor(pos_weight[head], device=device))
+    else:
+        decision_loss_fcns[head] = BCEWithLogitsLoss()
+epochs = args.epochs
+
+os.makedirs(f'output/{mode}-model/checkpoints', exist_ok=True)
+max_acc = 0
+iterators = {}
+for head in MultiHeadModel.HEADS[1:]:
+    if len(train_loaders[head].dataset):
+        iterators[head] = cycle(train_loaders[head])
+    else:  # 该任务没有训练数据，不训练这个head
+        print(f'no {head} training data in {args.cache_dir}, skipping the {head} head')
+for epoch in range(epochs):
+    for features, labels in tqdm.tqdm(train_loaders['discard']):
+        batches = {'discard': (features, labels)}
+        for head, iterator in iterators.items():
+            batches[head] = next(iterator)
+        batches = {head: (f.to(device, non_blocking=True), lb.to(device, non_blocking=True)) for head, (f, lb) in batches.items()}
+        outputs = forward(model, {head: f for head, (f, _) in batches.items()})
+        losses = {'discard': discard_loss_fcn(outputs['discard'], batches['discard'][1])}
+        for head in iterators:
+            losses[head] = decision_loss_fcns[head](outputs[head].flatten(), batches[head][1])
+        loss = sum(losses.values())
+        optim.zero_grad()
+        loss.backward()
+        optim.step()
+        experiment.log({
+            'train loss': loss.item(),
+            **{f'train {head} loss': value.item() for head, value in losses.items()},
+            'epoch': epoch + 1
+        })
+
+    model.eval()
+    metrics, thresholds = model_test(model, test_loaders, list(iterators))
+    checkpoint = {
+        "state_dict": model.state_dict(),
+        "num_layers": num_layers,
+        "head_layers": head_layers,
+        "in_channels": in_channels,
+        "furo_channels": furo_channels,
+        "thresholds": thresholds,
+        "heads": ['discard', *thresholds]  # 没有训练或测试数据的head没有阈值，AiAgent改用对应的单独模型
+    }
+    torch.save(checkpoint, f'output/{mode}-model/checkpoints/epoch_{epoch + 1}.pt')
+    if metrics['test_acc'] > max_acc:
+        max_acc = metrics['test_acc']
+        torch.save(checkpoint, f'output/{mode}-model/checkpoints/best.pt')
+    model.train()
+
+    experiment.log({
+        'epoch': epoch + 1,
+        **metrics,
+        'lr': optim.param_groups[0]['lr'],
+        **{f'{head}_threshold': value for head, value in thresholds.items()}
+    })
+    scheduler.step(metrics['test_acc'])
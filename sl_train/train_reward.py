@@ -6,45 +6,39 @@ import wandb
 import os
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
-from dataset.data import process_reward_data, TenhouDataset
+from torch.utils.data import DataLoader
+from dataset.data import process_reward_data, TenhouShardDataset
 from model.models import RewardPredictor
 
 
 @torch.no_grad()
-def model_test(model, dataset: TenhouDataset):
+def model_test(model, loader: DataLoader):
     total_error = 0
     total = 0
-    length = len(dataset)
-    while len(dataset) > 0:
-        data = dataset()
-        if len(data) == 0:
-            break
-        features, labels = process_reward_data(data)
+    for i, (features, labels) in enumerate(loader):
         features, labels = features.to(device), labels.to(device)
         output = model(features)
         error = (output - labels).pow(2).sum()
         total_error += error
         total += len(labels)
-        print(f"Testing {length - len(dataset)} / {length} Error: {error:.3f}".center(50, '-'), end='\r')
-    dataset.reset()
+        print(f"Testing {i + 1} / {len(loader)} Error: {error:.3f}".center(50, '-'), end='\r')
     return total_error / total
 
 mode = 'reward'
 experiment = wandb.init(project='Mahjong', resume='allow', anonymous='must', name=f'train-{mode}')
 
-
-train_set = TenhouDataset(data_dir='data', batch_size=128, mode=mode, target_length=4)
-test_set = TenhouDataset(data_dir='data', batch_size=128, mode=mode, target_length=4)
-length = len(train_set)
-len_train = int(0.8 * length)
-train_set.data_files, test_set.data_files = train_set.data_files[:len_train], train_set.data_files[len_train:]
-
 parser = argparse.ArgumentParser()
 parser.add_argument('--hidden_dims', '-hd', default=50, type=int)
 parser.add_argument('--num_layers', '-n', default=2, type=int)
 parser.add_argument('--epochs', '-e', default=10, type=int)
+parser.add_argument('--cache_dir', '-c', default='cache', type=str)  # dataset/preprocess.py的输出目录
 args = parser.parse_args()
 
+train_set = TenhouShardDataset(args.cache_dir, mode=mode, split='train')
+test_set = TenhouShardDataset(args.cache_dir, mode=mode, split='test')
+train_loader = DataLoader(train_set, batch_size=128, shuffle=True, num_workers=4, collate_fn=process_reward_data)
+test_loader = DataLoader(test_set, batch_size=128, num_workers=4, collate_fn=process_reward_data)
+
 hidden_dims = args.hidden_dims
 epochs = args.epochs
 num_layers = args.num_layers
@@ -59,11 +53,7 @@ os.makedirs(f'output/{mode}-model/checkpoints', exist_ok=True)
 min_mse = torch.inf
 global_step = 0
 for epoch in range(epochs):
-    while len(train_set) > 0:
-        data = train_set()
-        if len(data) == 0:
-            break
-        features, labels = process_reward_data(data)
+    for i, (features, labels) in enumerate(train_loader):
         features, labels = features.to(device), labels.to(device)
         output = model(features)
         loss = loss_fcn(output, labels)
@@ -71,17 +61,15 @@ for epoch in range(epochs):
         loss.backward()
         optim.step()
         global_step += 1
-        print(f"Epoch-{epoch + 1}: {len_train - len(train_set)} / {len_train} loss={loss.item():.3f}".center(50, '-'), end='\r')
+        print(f"Epoch-{epoch + 1}: {i + 1} / {len(train_loader)} loss={loss.item():.3f}".center(50, '-'), end='\r')
         experiment.log({
             'train loss': loss.item(),
             'epoch': epoch + 1
         })
 
-    train_set.reset()
-
     torch.save({"state_dict": model.state_dict(), "num_layers": num_layers, "hidden_dims": hidden_dims}, f'output/{mode}-model/checkpoints/epoch_{epoch + 1}.pt')
     model.eval()
-    mse = model_test(model, test_set)
+    mse = model_test(model, test_loader)
     if mse < min_mse:
         min_mse = mse
         torch.save({"state_dict": model.state_dict(), "num_layers": num_layers, "hidden_dims": hidden_dims}, f'output/{mode}-model/checkpoints/best.pt')
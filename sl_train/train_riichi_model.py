@@ -3,6 +3,7 @@ import torch
 from torch.optim import Adam
 import wandb
 import argparse
+from functools import partial
 from torch.nn import CrossEntropyLoss, BCEWithLogitsLoss
 from sklearn.metrics import roc_curve, auc, accuracy_score, precision_recall_fscore_support
 import matplotlib
@@ -11,25 +12,20 @@ from matplotlib import pyplot as plt
 import sys
 sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
 from model.models import RiichiModel
-from dataset.data import TenhouDataset, process_data
+from torch.utils.data import DataLoader
+from dataset.data import TenhouShardDataset, collate_fn_binary
 
 
 @torch.no_grad()
-def model_test(model, dataset: TenhouDataset, epoch):
-    length = len(dataset)
+def model_test(model, loader: DataLoader, epoch):
     y_true = []
     y_score = []
-    while len(dataset) > 0:
-        data = dataset()
-        if len(data) == 0:
-            break
-        features, labels = process_data(data, label_trans=lambda x: x.float())
+    for i, (features, labels) in enumerate(loader):
         features, labels = features.to(device), labels.to(device)
         output = model(features).sigmoid().flatten()
         y_true.extend(labels.tolist())
         y_score.extend(output.tolist())
-        print(f"Testing {length - len(dataset)} / {length}".center(50, '-'), end='\r')
-    dataset.reset()
+        print(f"Testing {i + 1} / {len(loader)}".center(50, '-'), end='\r')
     fpr, tpr, thresholds = roc_curve(y_true, y_score)
     roc_auc = auc(fpr, tpr)
     maxindex = (tpr - fpr).tolist().index(max(tpr - fpr))
@@ -54,14 +50,14 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--num_layers', '-n', default=20, type=int)
 parser.add_argument('--epochs', '-e', default=10, type=int)
 parser.add_argument('--pos_weight', '-w', default=None, type=int)
+parser.add_argument('--cache_dir', '-c', default='cache', type=str)  # dataset/preprocess.py的输出目录
 args = parser.parse_args()
 mode = 'riichi'
 experiment = wandb.init(project='Mahjong', resume='allow', anonymous='must', name=f'train-{mode}-sl')
-train_set = TenhouDataset(data_dir='data', batch_size=128, mode=mode, target_length=2)
-test_set = TenhouDataset(data_dir='data', batch_size=128, mode=mode, target_length=2)
-length = len(train_set)
-len_train = int(0.8 * length)
-train_set.data_files, test_set.data_files = train_set.data_files[:len_train], train_set.data_files[len_train:]
+train_set = TenhouShardDataset(args.cache_dir, mode=mode, split='train', packed=True)
+test_set = TenhouShardDataset(args.cache_dir, mode=mode, split='test', packed=True)
+train_loader = DataLoader(train_set, batch_size=128, shuffle=True, num_workers=4, collate_fn=partial(collate_fn_binary, packed=True))
+test_loader = DataLoader(test_set, batch_size=128, num_workers=4, collate_fn=partial(collate_fn_binary, packed=True))
 
 
 num_layers = args.num_layers
@@ -81,11 +77,7 @@ os.makedirs(f'output/{mode}-model/checkpoints', exist_ok=True)
 max_f1 = 0
 global_step = 0
 for epoch in range(epochs):
-    while len(train_set) > 0:
-        data = train_set()
-        if len(data) == 0:
-            break
-        features, labels = process_data(data, label_trans=lambda x: x.float())
+    for i, (features, labels) in enumerate(train_loader):
         features, labels = features.to(device), labels.to(device)
         output = model(features).flatten()
         loss = loss_fcn(output, labels)
@@ -93,16 +85,14 @@ for epoch in range(epochs):
         loss.backward()
         optim.step()
         global_step += 1
-        print(f"Epoch-{epoch + 1}: {len_train - len(train_set)} / {len_train} loss={loss.item():.3f}".center(50, '-'), end='\r')
+        print(f"Epoch-{epoch + 1}: {i + 1} / {len(train_loader)} loss={loss.item():.3f}".center(50, '-'), end='\r')
         experiment.log({
             'train loss': loss.item(),
             'epoch': epoch + 1
         })
 
-    train_set.reset()
-
     model.eval()
-    recall, precision, acc, f_score, threshold = model_test(model, test_set, epoch + 1)
+    recall, precision, acc, f_score, threshold = model_test(model, test_loader, epoch + 1)
     torch.save({
         "state_dict": model.state_dict(),
         "num_layers": num_layers,
@@ -0,0 +1,45 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import torch
+
+from model.models import FuroModel, MultiHeadModel
+from mahjong.agent import AiAgent
+from mahjong.registry import ModelRegistry
+
+
+def test_multi_head_without_threshold_falls_back(tmp_path):
+    """测试集为空的head没有阈值，不使用多head模型中未经检验的head，改用单独的模型，没有单独的模型时当作没有模型"""
+    model = MultiHeadModel(in_channels=291, furo_channels=22, num_layers=1, head_layers=1)
+    os.makedirs(tmp_path / 'multi-head-model')
+    torch.save({
+        'state_dict': model.state_dict(),
+        'num_layers': 1,
+        'head_layers': 1,
+        'in_channels': 291,
+        'furo_channels': 22,
+        'thresholds': {'riichi': 0.3},
+        'heads': ['discard', 'riichi']
+    }, tmp_path / 'multi-head-model' / 'best.pt')
+    chi_model = FuroModel(in_channels=291 + 22, num_layers=1)
+    os.makedirs(tmp_path / 'chi-model')
+    torch.save({
+        'state_dict': chi_model.state_dict(),
+        'num_layers': 1,
+        'in_channels': 291 + 22,
+        'threshold': 0.4
+    }, tmp_path / 'chi-model' / 'best.pt')
+
+    agent = AiAgent(model_dir=str(tmp_path), registry=ModelRegistry(device=torch.device('cpu')))
+    try:
+        assert isinstance(agent.model('discard')[0], MultiHeadModel)
+        riichi_model, riichi_threshold = agent.model('riichi')
+        assert isinstance(riichi_model, MultiHeadModel) and riichi_threshold == 0.3
+        chi_model, chi_threshold = agent.model('chi')
+        assert isinstance(chi_model, FuroModel) and chi_threshold == 0.4
+        assert agent.model('pon') == (None, None)
+        scores = agent.decision_scores([('pon', None, None)], [agent.model('pon')], [])
+        assert 0 <= scores[0] < 1
+    finally:
+        agent.server.close()
@@ -0,0 +1,45 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import numpy as np
+import pytest
+import torch
+
+from dataset.data import pack_features, unpack_features
+from mahjong.game import FEATURE_CHANNELS, FEATURE_OFFSET
+from model.models import RIICHI_CHANNELS, Unpack
+
+
+def random_features(shape, n=8):
+    """随机的0/1特征，立直情况的通道整行取0/1/2"""
+    features = np.random.randint(0, 2, size=(n, *shape)).astype(np.float64)
+    start = shape[0] + RIICHI_CHANNELS[0]
+    features[:, start:start + 4] = np.random.randint(0, 3, size=(n, 4, 1))
+    return features
+
+
+def test_riichi_channels_match_feature_layout():
+    assert FEATURE_OFFSET['riichi'] == FEATURE_CHANNELS + RIICHI_CHANNELS[0]
+    assert FEATURE_OFFSET['riichi'] + 4 == FEATURE_CHANNELS + RIICHI_CHANNELS[1]
+
+
+@pytest.mark.parametrize('shape', [(FEATURE_CHANNELS, 34), (FEATURE_CHANNELS + 22, 34)])
+def test_pack_keeps_double_riichi(shape):
+    """两立直的2原样保留，numpy和模型中的Unpack展开结果一致"""
+    features = random_features(shape)
+    packed = pack_features(features)
+    assert np.array_equal(unpack_features(packed, shape), features)
+    assert np.array_equal(unpack_features(packed[0], shape), features[0])
+    unpacked = torch.jit.script(Unpack(shape))(torch.from_numpy(packed))
+    assert torch.equal(unpacked, torch.from_numpy(features).float())
+
+
+def test_pack_rejects_non_binary_features():
+    features = random_features((FEATURE_CHANNELS, 34))
+    features[:, 0, 0] = 2
+    with pytest.raises(ValueError):
+        pack_features(features)
+    with pytest.raises(ValueError):
+        pack_features(np.full((3, 74), 2))
+    assert np.array_equal(unpack_features(pack_features(np.ones((3, 74))), (74,)), np.ones((3, 74)))
@@ -0,0 +1,33 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import numpy as np
+import pytest
+import torch
+
+from mahjong.inference import InferenceServer
+
+
+def test_failed_model_load_does_not_kill_server():
+    """热更新时加载模型出错，只让这一批的请求失败，推理线程继续运行，checkpoint修好后恢复"""
+    model = torch.nn.Linear(4, 2)
+    broken = {'discard': True}
+
+    def get_model(name):
+        if broken[name]:
+            raise RuntimeError('Error(s) in loading state_dict')
+        return model
+
+    server = InferenceServer(get_model, torch.device('cpu'), max_delay=0.)
+    state = np.ones(4, dtype=np.float32)
+    try:
+        with pytest.raises(RuntimeError):
+            server.submit('discard', state).result(timeout=5)
+        assert server.thread.is_alive()
+
+        broken['discard'] = False
+        output = server.submit('discard', state).result(timeout=5)
+        assert torch.allclose(output, model(torch.from_numpy(state)).detach())
+    finally:
+        server.close()
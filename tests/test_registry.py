@@ -0,0 +1,54 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import torch
+
+from mahjong import registry as registry_module
+from mahjong.registry import ModelRegistry
+
+
+def test_failed_reload_keeps_old_model(tmp_path):
+    """热更新的checkpoint加载出错时继续使用旧模型，同一版本不再重试，文件再次修改后重新加载"""
+    path = tmp_path / 'best.pt'
+    torch.save({'state_dict': {}}, path)
+    model = torch.nn.Linear(4, 2)
+    calls = []
+
+    def loader(snapshot_path, device):
+        calls.append(snapshot_path)
+        if len(calls) == 2:
+            raise RuntimeError('Error(s) in loading state_dict')
+        return model, {}
+
+    registry = ModelRegistry(device=torch.device('cpu'), check_interval=0.)
+    assert registry.get(str(path), loader)[0] is model
+    torch.save({'state_dict': {}, 'changed': True}, path)
+    os.utime(path, ns=(1, 1))
+    assert registry.get(str(path), loader)[0] is model
+    assert registry.get(str(path), loader)[0] is model
+    assert len(calls) == 2
+    assert not os.path.exists(calls[1])
+
+    os.utime(path, ns=(2, 2))
+    assert registry.get(str(path), loader)[0] is model
+    assert len(calls) == 3
+
+
+def test_snapshots_are_pruned(tmp_path, monkeypatch):
+    """同一checkpoint只保留最新版本的快照，close后全部删除"""
+    snapshot_dir = tmp_path / 'snapshots'
+    monkeypatch.setattr(registry_module, 'SNAPSHOT_DIR', str(snapshot_dir))
+    path = tmp_path / 'best.pt'
+    torch.save({'state_dict': {}}, path)
+    registry = ModelRegistry(device=torch.device('cpu'), check_interval=0.)
+
+    def loader(snapshot_path, device):
+        return torch.nn.Linear(4, 2), {}
+
+    registry.get(str(path), loader)
+    os.utime(path, ns=(1, 1))
+    registry.get(str(path), loader)
+    assert len(os.listdir(snapshot_dir)) == 1
+    registry.close()
+    assert os.listdir(snapshot_dir) == []
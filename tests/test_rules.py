@@ -0,0 +1,221 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import random
+
+import pytest
+
+from mahjong.check_agari import is_agari, parse_agari_info, check_machi, check_riichi, machi, riichi_machi
+from mahjong.shanten import shanten, discard_shanten
+from mahjong.table import CompactTable, save_table
+from mahjong.utils import TileCounter
+
+YAOCHU = [0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]
+SHUNTSU_STARTS = [k * 9 + i for k in range(3) for i in range(7)]
+
+
+def counter_of(tiles):
+    counts = [0] * 34
+    for tile in tiles:
+        counts[tile] += 1
+    return TileCounter.from_counts(counts)
+
+
+def random_hand(rng, size):
+    return counter_of(tile // 4 for tile in rng.sample(range(136), size))
+
+
+def complete_hand(rng):
+    """随机的一般形和牌: 4个面子加1个雀头，每种牌不超过4张"""
+    while True:
+        counts = [0] * 34
+        for _ in range(4):
+            if rng.random() < 0.5:
+                start = rng.choice(SHUNTSU_STARTS)
+                for tile in range(start, start + 3):
+                    counts[tile] += 1
+            else:
+                counts[rng.randrange(34)] += 3
+        counts[rng.randrange(34)] += 2
+        if max(counts) <= 4:
+            return TileCounter.from_counts(counts)
+
+
+def brute_agari(counts):
+    """逐张拆解的和牌判断: 一般形、七对子、国士无双"""
+    counts = list(counts)
+
+    def mentsu(rest):
+        for i, c in enumerate(rest):
+            if c:
+                break
+        else:
+            return True
+        if c >= 3:
+            rest[i] -= 3
+            ok = mentsu(rest)
+            rest[i] += 3
+            if ok:
+                return True
+        if i < 27 and i % 9 <= 6 and rest[i + 1] and rest[i + 2]:
+            for tile in range(i, i + 3):
+                rest[tile] -= 1
+            ok = mentsu(rest)
+            for tile in range(i, i + 3):
+                rest[tile] += 1
+            return ok
+        return False
+
+    if sum(counts) % 3 != 2:
+        return False
+    for i in range(34):
+        if counts[i] >= 2:
+            counts[i] -= 2
+            ok = mentsu(counts)
+            counts[i] += 2
+            if ok:
+                return True
+    if sum(counts) == 14:
+        if counts.count(2) == 7:
+            return True
+        if all(counts[i] for i in YAOCHU) and sum(counts[i] for i in YAOCHU) == 14:
+            return True
+    return False
+
+
+def brute_standard_shanten(counts):
+    """
+    按定义求一般形向听数: 补齐手牌凑成n个面子加1个雀头最少需要摸的张数减1
+    只枚举与手牌有重叠的面子，其余面子、雀头各需摸3、2张
+    """
+    counts = list(counts)
+    num_mentsu = sum(counts) // 3
+    blocks = [[i] * 3 for i in range(34) if counts[i]]
+    blocks += [[i, i + 1, i + 2] for i in SHUNTSU_STARTS if counts[i] or counts[i + 1] or counts[i + 2]]
+    target = [0] * 34
+    best = [99]
+
+    def pair_cost():
+        ret = 2
+        for i in range(34):
+            if target[i] + 2 <= 4:
+                ret = min(ret, max(0, target[i] + 2 - counts[i]) - max(0, target[i] - counts[i]))
+        return ret
+
+    def search(start, left, cost):
+        best[0] = min(best[0], cost + 3 * left + pair_cost())
+        if not left:
+            return
+        for b in range(start, len(blocks)):
+            extra = 0
+            for tile in blocks[b]:
+                extra += target[tile] >= counts[tile]
+                target[tile] += 1
+            if max(target[tile] for tile in blocks[b]) <= 4 and cost + extra < best[0]:
+                search(b, left - 1, cost + extra)
+            for tile in blocks[b]:
+                target[tile] -= 1
+
+    search(0, num_mentsu, 0)
+    return best[0] - 1
+
+
+def brute_shanten(counts):
+    ret = brute_standard_shanten(counts)
+    if sum(counts) >= 13:
+        pairs = sorted((min(c, 2) for c in counts), reverse=True)[:7]
+        ret = min(ret, 14 - sum(pairs) - 1)
+        yaochu = [counts[i] for i in YAOCHU]
+        ret = min(ret, yaochu.count(0) + (max(yaochu) < 2) - 1)
+    return ret
+
+
+@pytest.mark.parametrize('size', [4, 7, 10, 13, 14])
+def test_shanten_matches_brute_force(size):
+    rng = random.Random(size)
+    for _ in range(60):
+        counter = random_hand(rng, size)
+        assert shanten(counter) == brute_shanten(counter), bytes(counter)
+
+
+def test_discard_shanten_matches_shanten():
+    rng = random.Random(0)
+    for _ in range(100):
+        counter = random_hand(rng, 14)
+        expected = {}
+        for tile, c in enumerate(counter):
+            if c:
+                counter[tile] -= 1
+                expected[tile] = shanten(counter)
+                counter[tile] += 1
+        assert discard_shanten(counter) == expected, bytes(counter)
+
+
+def test_is_agari_matches_brute_force():
+    rng = random.Random(1)
+    hands = [complete_hand(rng) for _ in range(300)] + [random_hand(rng, 14) for _ in range(300)]
+    hands.append(counter_of([0, 0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33]))  # 国士无双
+    hands.append(counter_of([0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5, 6, 6]))  # 七对子兼二杯口
+    for counter in hands:
+        value = is_agari(counter)
+        assert (value is not None) == brute_agari(counter), bytes(counter)
+        if isinstance(value, tuple):
+            for info in map(parse_agari_info, value):
+                assert info.chitoi or info.num_kotsu + info.num_shuntsu == 4
+
+
+def test_machi_matches_agari_table():
+    """听牌与逐张加入后查和牌表的结果一致，立直可打的牌与查听牌表的结果一致"""
+    rng = random.Random(2)
+    hands = []
+    for _ in range(200):
+        counter = complete_hand(rng)
+        tile = rng.choice([t for t, c in enumerate(counter) if c])
+        counter[tile] -= 1
+        hands.append(counter)
+    hands += [random_hand(rng, 13) for _ in range(100)]
+    for counter in hands:
+        expected = set()
+        for tile in range(34):
+            if counter[tile] < 4:
+                counter[tile] += 1
+                if is_agari(counter) is not None:
+                    expected.add(tile)
+                counter[tile] -= 1
+        assert machi(counter) == expected, bytes(counter)
+
+    for counter in hands:
+        counter = counter.copy()
+        counter[rng.randrange(34) if max(counter) < 4 else counter.index(min(counter))] += 1
+        riichi_hai = []
+        for tile, c in enumerate(counter):
+            if c:
+                counter[tile] -= 1
+                if check_machi(counter):
+                    riichi_hai.append(tile)
+                counter[tile] += 1
+        assert sorted(check_riichi(counter, return_riichi_hai=True)) == riichi_hai, bytes(counter)
+        assert check_riichi(counter) == bool(riichi_hai)
+        for tile, waits in riichi_machi(counter).items():
+            counter[tile] -= 1
+            assert waits == machi(counter)
+            counter[tile] += 1
+
+
+@pytest.mark.parametrize('width', [0, 3])
+def test_compact_table_round_trip(tmp_path, width):
+    rng = random.Random(width)
+    table = {}
+    while len(table) < 500:
+        table[rng.getrandbits(60)] = [rng.getrandbits(32) for _ in range(width or rng.randrange(5))]
+    path = str(tmp_path / 'table.bin')
+    save_table(path, table, width=width)
+    loaded = CompactTable(path)
+    assert len(loaded) == len(table)
+    for key, value in table.items():
+        assert key in loaded
+        assert list(loaded.get(key)) == value
+    missing = max(table) + 1
+    assert missing not in loaded
+    assert loaded.get(missing, 'missing') == 'missing'
@@ -0,0 +1,40 @@
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.abspath(os.path.dirname(__file__))))
+
+import json
+import asyncio
+
+from mahjong.agent import AiAgent
+from mahjong.simulator import Simulator
+from online_game.server import Server, GameEnvironment
+from online_game.transport import encode
+
+
+def test_observer_disconnected_when_game_ends(tmp_path, monkeypatch):
+    """对局正常结束、房间关闭时观战者的连接也被关闭"""
+    monkeypatch.setattr(GameEnvironment, 'game_update', lambda self, res: (True, Simulator.game_update(self, res)[1]))  # 一局后结束
+
+    async def main():
+        server = Server('127.0.0.1', 0, 4, 0, True, True)
+        server.ai_agent = AiAgent(model_dir=str(tmp_path))
+        task = asyncio.create_task(server.run())
+        try:
+            await asyncio.sleep(0.1)
+            reader, writer = await asyncio.open_connection(*server.server_socket.getsockname())
+            writer.write(encode({'username': '', 'observe': True}))
+            events = []
+            while line := await asyncio.wait_for(reader.readline(), 30):
+                events.append(json.loads(line)['event'])
+            writer.close()
+            return events
+        finally:
+            server.closed = True  # 不再补开新的对局
+            tasks = [task] + [game.task for game in server.rooms.values() if game.task is not None]
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            server.ai_agent.server.close()
+
+    events = asyncio.run(main())
+    assert events[-1] == 'end'